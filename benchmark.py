@@ -0,0 +1,191 @@
+#! /usr/bin/env python3
+
+# Benchmarks a full run() of the driver against fake_rtorrent, at scales
+# beyond what is convenient to set up with a real rtorrent.  For every
+# scenario it reports the wall time, the number of SCGI round trips and
+# rtorrent commands, and the peak memory allocated by Python.
+#
+# Usage: benchmark.py [--scenario small|large] [--torrents N ...] [--files N ...]
+
+import argparse
+import collections
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import driver
+import fake_rtorrent
+
+Result = collections.namedtuple(
+    'Result', ['scenario', 'scale', 'seconds', 'requests', 'calls', 'peak_bytes']
+)
+
+MiB = 2**20
+
+
+def make_driver(workdir, fake, metadata_service, space_limit, **cfg):
+    """Builds a driver talking to the fake rtorrent and a fake remote."""
+    managed = os.path.join(workdir, 'managed')
+    cfg = dict({
+        'managed_torrents_directory': managed,
+        'space_limit': str(space_limit),
+        'required_ratio': '1',
+        'socket_url': fake.url,
+        'rsync_host': 'unused',
+        'rsync_path': '/unused',
+        'remote_sync_service': 'rsync',
+    }, **cfg)
+    driver_ = driver.RtorrentLowSpaceDriver(metadata_service, cfg)
+    driver_.remote_sync_service = fake_rtorrent.FakeRemoteSync(
+        manifest_file=os.path.join(workdir, 'manifest.json')
+    )
+    return driver_
+
+
+def add_managed_torrent(workdir, metadata_service, infohash, name, size):
+    path = os.path.join(workdir, 'managed', name + '.torrent')
+    open(path, 'w').close()
+    metadata_service.add(path, infohash, name, size)
+    return path
+
+
+def small_strategy(workdir, torrents, seed=0):
+    """Many managed torrents: a tenth seeded enough to be purged, a tenth
+    still downloading, and the rest waiting to be loaded.
+
+    Returns:
+        (driver, FakeRtorrent) tuple.
+    """
+    rng = random.Random(seed)
+    data = os.path.join(workdir, 'data')
+    os.makedirs(os.path.join(workdir, 'managed'))
+    os.makedirs(data)
+    metadata_service = fake_rtorrent.FakeMetadataService()
+    fake = fake_rtorrent.FakeRtorrent(os.path.join(workdir, 'rpc.socket'), data, metadata_service)
+
+    for i in range(torrents):
+        infohash = '%040X' % i
+        name = 'torrent-%06d' % i
+        size = rng.randint(1, 64) * MiB
+        add_managed_torrent(workdir, metadata_service, infohash, name, size)
+        if i % 10 in (0, 1):
+            complete = i % 10 == 0
+            if complete:
+                open(os.path.join(data, name), 'w').close()
+            fake.add_download(fake_rtorrent.FakeDownload(
+                infohash, name, data, [fake_rtorrent.FakeFile(name, size, MiB, complete)], MiB,
+                complete=complete, ratio=2.0 if complete else 0.0
+            ))
+
+    # Room for about a tenth of the torrents on top of the loaded ones.
+    space_limit = torrents * 32 * MiB // 5
+    fake.start()
+    return make_driver(workdir, fake, metadata_service, space_limit), fake
+
+
+def large_strategy(workdir, files, mode='pipelined', seed=0):
+    """A single loaded torrent with many files, too large to fit.  A tenth of
+    the files are complete, and another tenth are downloading.
+
+    Returns:
+        (driver, FakeRtorrent) tuple.
+    """
+    rng = random.Random(seed)
+    data = os.path.join(workdir, 'data')
+    name = 'large'
+    directory = os.path.join(data, name)
+    os.makedirs(os.path.join(workdir, 'managed'))
+    os.makedirs(directory)
+    metadata_service = fake_rtorrent.FakeMetadataService()
+    fake = fake_rtorrent.FakeRtorrent(os.path.join(workdir, 'rpc.socket'), data, metadata_service)
+
+    fake_files = []
+    for i in range(files):
+        path = 'dir-%03d/file-%06d' % (i // 1000, i)
+        complete = i % 10 == 0
+        fake_files.append(fake_rtorrent.FakeFile(
+            path, rng.randint(1, 8 * MiB), MiB, complete, priority=1 if i % 10 < 2 else 0
+        ))
+        if complete:
+            os.makedirs(os.path.join(directory, os.path.dirname(path)), exist_ok=True)
+            open(os.path.join(directory, path), 'w').close()
+    download = fake_rtorrent.FakeDownload('%040X' % 1, name, directory, fake_files, MiB)
+    fake.add_download(download)
+    add_managed_torrent(workdir, metadata_service, download.hash, name, download.size_bytes())
+
+    fake.start()
+    driver_ = make_driver(workdir, fake, metadata_service, files // 4 * 4 * MiB,
+                          large_strategy_mode=mode)
+    return driver_, fake
+
+
+SCENARIOS = {
+    'small': small_strategy,
+    'large': large_strategy,
+}
+
+
+def measure(scenario, scale, **kwargs):
+    """Runs the driver once in a fresh scenario, and once more traced.
+
+    Memory is traced in a separate run, so that tracemalloc's overhead
+    doesn't show in the wall time.
+
+    Returns:
+        A Result.
+    """
+    with tempfile.TemporaryDirectory() as workdir:
+        driver_, fake = SCENARIOS[scenario](workdir, scale, **kwargs)
+        try:
+            start = time.perf_counter()
+            driver_.run()
+            seconds = time.perf_counter() - start
+            requests, calls = fake.requests, sum(fake.calls.values())
+        finally:
+            fake.stop()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        driver_, fake = SCENARIOS[scenario](workdir, scale, **kwargs)
+        tracemalloc.start()
+        try:
+            driver_.run()
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            fake.stop()
+
+    return Result(scenario, scale, seconds, requests, calls, peak_bytes)
+
+
+def format_result(result):
+    return "%-6s %8d %9.3f %9d %9d %10.1f" % (
+        result.scenario, result.scale, result.seconds, result.requests, result.calls,
+        result.peak_bytes / MiB)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the driver against a fake rtorrent.")
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), action='append',
+                        help='Scenario to run, repeatable.  Default: all.')
+    parser.add_argument('--torrents', type=int, nargs='+', default=[1000, 10000],
+                        help='Managed torrents in the small scenario.')
+    parser.add_argument('--files', type=int, nargs='+', default=[50000],
+                        help='Files of the torrent in the large scenario.')
+    parser.add_argument('--large-mode', choices=['stop_and_sync', 'pipelined'], default='pipelined',
+                        help='large_strategy_mode of the large scenario.')
+    args = parser.parse_args()
+
+    print("%-6s %8s %9s %9s %9s %10s" % ('', 'scale', 'seconds', 'requests', 'commands', 'peak MiB'))
+    for scenario in args.scenario or sorted(SCENARIOS):
+        if scenario == 'small':
+            for torrents in args.torrents:
+                print(format_result(measure('small', torrents)))
+        else:
+            for files in args.files:
+                print(format_result(measure('large', files, mode=args.large_mode)))
+
+
+if __name__ == "__main__":
+    main()
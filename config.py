@@ -5,6 +5,8 @@ from logging import debug, info, error, warning, critical
 import os
 import sys
 
+DEFAULT_CACHE_DIRECTORY = "~/.cache/rtorrent_low_space_driver"
+
 
 def parse_arguments(args):
     """Parses arguments and returns a dict with the result.
@@ -19,6 +21,9 @@ def parse_arguments(args):
     parser.add_argument('--config', metavar="FILE", type=str, help='Config file.')
     parser.add_argument('--log-systemd', action='store_true', help='Format logger to run under a systemd unit.')
     parser.add_argument('--log-file', metavar='FILE', type=str, help='Log everything to this file')
+    parser.add_argument('--daemon', action='store_true', help='Keep running and re-plan whenever state changes.')
+    parser.add_argument('--profile-rpc', action='store_true',
+                        help='Log a summary of the rtorrent calls made by every run.')
     parser.add_argument('rest_args', metavar="ARGS", nargs='*')
     ns = parser.parse_args(args)
     return vars(ns)
@@ -0,0 +1,107 @@
+import asyncio
+from logging import debug, info, error
+import time
+
+
+class DriverDaemon:
+    """Keeps one RtorrentLowSpaceDriver warm and re-plans when state changes.
+
+    Every poll_interval seconds the daemon takes a cheap fingerprint of
+    rtorrent and of the managed directory.  The full rotator algorithm only
+    runs when the fingerprint changed, and at least every full_run_interval
+    seconds regardless, as progress inside a large torrent doesn't show up
+    in the fingerprint.  Other components can register file descriptors with
+    add_reader(), or call wake(), to trigger a poll straight away.
+    """
+    DEFAULT_POLL_INTERVAL = 60
+    DEFAULT_FULL_RUN_INTERVAL = 3600
+
+    def __init__(self, driver, cfg):
+        """Inits DriverDaemon.
+
+        Args:
+            driver: A RtorrentLowSpaceDriver.
+            cfg: configs in dictionary form.
+        """
+        self.driver = driver
+        # Lets the driver leave uploads running between runs.
+        driver.wake = self.wake
+        self.poll_interval = float(cfg.get('poll_interval', self.DEFAULT_POLL_INTERVAL))
+        self.full_run_interval = float(cfg.get('full_run_interval', self.DEFAULT_FULL_RUN_INTERVAL))
+        self.loop = None
+        self._wakeup = None
+        self._readers = []
+        self._force_run = False
+        self._last_fingerprint = None
+        self._last_run = None
+
+    def add_reader(self, fd, callback, force_run=False):
+        """Calls callback whenever fd becomes readable, then polls.
+
+        Args:
+            fd: File descriptor, integer.
+            callback: Function without arguments.  It must drain fd.
+            force_run: Whether readable data means something changed, so
+              that the next poll runs the driver even if the fingerprint
+              looks the same.  Either a bool, or a function that tells from
+              what callback returned.
+        """
+        self._readers.append((fd, callback, force_run))
+
+    def wake(self):
+        """Triggers a poll as soon as possible.  Safe to call from any thread."""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._wakeup.set)
+
+    def run_forever(self):
+        """Runs the daemon until interrupted."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        info("Starting daemon, polling every %d seconds." % self.poll_interval)
+        try:
+            self.loop.run_until_complete(self._main())
+        except KeyboardInterrupt:
+            info("Interrupted, stopping daemon.")
+        finally:
+            self.loop.close()
+            self.loop = None
+
+    async def _main(self):
+        self._wakeup = asyncio.Event()
+        for fd, callback, force_run in self._readers:
+            self.loop.add_reader(fd, self._on_readable, callback, force_run)
+
+        while True:
+            await self._tick()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def _on_readable(self, callback, force_run):
+        result = callback()
+        if callable(force_run):
+            force_run = force_run(result)
+        if force_run:
+            self._force_run = True
+        self._wakeup.set()
+
+    async def _tick(self):
+        # Driver calls block, so they run in the default executor to keep
+        # the loop responsive to wake-ups in the meantime.
+        try:
+            fingerprint = await self.loop.run_in_executor(None, self.driver.state_fingerprint)
+            due = self._last_run is None or self._force_run \
+                or time.monotonic() - self._last_run >= self.full_run_interval
+            if fingerprint == self._last_fingerprint and not due:
+                debug("Nothing changed since the last run.")
+                return
+
+            self._force_run = False
+            await self.loop.run_in_executor(None, self.driver.run)
+            self._last_run = time.monotonic()
+            # The run itself changes the state, so fingerprint it again.
+            self._last_fingerprint = await self.loop.run_in_executor(None, self.driver.state_fingerprint)
+        except Exception:
+            error("Run failed, retrying at the next poll.", exc_info=True)
@@ -0,0 +1,46 @@
+import os
+
+
+def allocated_bytes(path):
+    """Returns the bytes actually allocated on disk for a file or tree.
+
+    Unlike the nominal size, this counts sparse and partially downloaded
+    files for the blocks they occupy, and truncated files for nothing.
+    Missing paths count as zero.
+    """
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return 0
+
+    total = st.st_blocks * 512
+    if os.path.isdir(path) and not os.path.islink(path):
+        for root, dirs, names in os.walk(path):
+            for name in dirs + names:
+                try:
+                    total += os.lstat(os.path.join(root, name)).st_blocks * 512
+                except FileNotFoundError:
+                    pass
+    return total
+
+
+def existing_ancestor(path):
+    """Returns path, or its closest parent that exists."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def volume_of(path):
+    """Returns an identifier of the filesystem holding path."""
+    return os.stat(existing_ancestor(path)).st_dev
+
+
+def free_bytes(path):
+    """Returns the bytes available to unprivileged users on path's volume."""
+    st = os.statvfs(existing_ancestor(path))
+    return st.f_bavail * st.f_frsize
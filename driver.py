@@ -1,4 +1,7 @@
 from logging import debug, info, error, warning, critical
+import collections
+import concurrent.futures
+import heapq
 import os
 import os.path
 from pprint import pformat
@@ -7,30 +10,19 @@ import tempfile
 import time
 import shutil
 import sys
+import xmlrpc.client
 
+import diskusage
+import metrics
+import packing
+import pieces
+import policies
 import rtorrent_xmlrpc
 import remotesync
-
-
-def splitter(data, pred):
-    """Split items to two lists according to an evaluating function.
-
-    Args:
-        data: List, or any other iterable.
-        pred: Evaluating function. When applied to items in 'data' it must
-          return either False or True.
-
-    Returns:
-        A nested list [[yes], [no]], where [yes] contains all objects that
-          evaluated to True, and [no] to False.
-    """
-    yes, no = [], []
-    for d in data:
-        if pred(d):
-            yes.append(d)
-        else:
-            no.append(d)
-    return [yes, no]
+import retry
+import rpcprofile
+import snapshot
+import swarm
 
 
 class RtorrentLowSpaceDriver(object):
@@ -59,21 +51,101 @@ class RtorrentLowSpaceDriver(object):
             critical(f'Missing key {e} from the config file. Exiting!')
             sys.exit(1)
 
-        self.server = rtorrent_xmlrpc.SCGIServerProxy(self.SOCKET_URL)
+        packing_mode = cfg.get('packing_mode', 'smallest_first')
+        if packing_mode not in packing.PACKING_MODES:
+            critical(f'Unknown packing_mode {packing_mode!r}, use one of {sorted(packing.PACKING_MODES)}. Exiting!')
+            sys.exit(1)
+        self.pack = packing.PACKING_MODES[packing_mode]
+
+        scheduling_policy = cfg.get('scheduling_policy', 'smallest_first')
+        if scheduling_policy not in policies.SCHEDULING_POLICIES:
+            critical(f'Unknown scheduling_policy {scheduling_policy!r}, '
+                     f'use one of {sorted(policies.SCHEDULING_POLICIES)}. Exiting!')
+            sys.exit(1)
+        self.policy = policies.SCHEDULING_POLICIES[scheduling_policy]()
+        if packing_mode == 'optimal' and scheduling_policy != 'smallest_first':
+            warning(f'packing_mode optimal only follows scheduling_policy {scheduling_policy!r} '
+                    f'between torrents of the same size')
+        self.AGING_PERIOD = float(cfg.get('aging_period', 86400))
+        self.ROTATION_OVERHEAD = float(cfg.get('rotation_overhead', 3600))
+        # Time as the policies see it, replaced by the simulator.
+        self.clock = time.time
+
+        # Incomplete managed downloads that made no progress for this many
+        # seconds are parked or evicted.  Zero disables it.
+        self.STALL_WINDOW = float(cfg.get('stall_window', 0))
+        self.STALL_ACTION = cfg.get('stall_action', 'park')
+        if self.STALL_ACTION not in ('park', 'evict'):
+            critical(f'Unknown stall_action {self.STALL_ACTION!r}, use park or evict. Exiting!')
+            sys.exit(1)
+        self.STALLED_TORRENTS_DIRECTORY = cfg.get('stalled_torrents_directory')
+        if self.STALL_WINDOW and self.STALL_ACTION == 'evict' and not self.STALLED_TORRENTS_DIRECTORY:
+            critical('stall_action = evict needs a stalled_torrents_directory. Exiting!')
+            sys.exit(1)
+        # Swarm statistics of the managed downloads, replaced by a persistent
+        # one when running from cron.
+        self.swarm = swarm.SwarmHistory()
+
+        self.SPACE_ACCOUNTING = cfg.get('space_accounting', 'nominal')
+        if self.SPACE_ACCOUNTING not in ('nominal', 'allocated'):
+            critical(f'Unknown space_accounting {self.SPACE_ACCOUNTING!r}, '
+                     f'use nominal or allocated. Exiting!')
+            sys.exit(1)
+
+        self.LARGE_STRATEGY_MODE = cfg.get('large_strategy_mode', 'stop_and_sync')
+        if self.LARGE_STRATEGY_MODE not in ('stop_and_sync', 'pipelined'):
+            critical(f'Unknown large_strategy_mode {self.LARGE_STRATEGY_MODE!r}, '
+                     f'use stop_and_sync or pipelined. Exiting!')
+            sys.exit(1)
+
+        self.METRICS_TEXTFILE = cfg.get('metrics_textfile')
+        if self.METRICS_TEXTFILE:
+            metrics.REGISTRY.restore_textfile(os.path.expanduser(self.METRICS_TEXTFILE))
+
+        # Enabled with --profile-rpc, reports the calls of every run.
+        self.profiler = rpcprofile.RpcProfiler()
+        self.server = rtorrent_xmlrpc.SCGIServerProxy(self.SOCKET_URL, observer=self.observe_rpc)
+        self.snapshot = None
+        # Optional watcher.ManagedTorrentIndex, kept up to date incrementally
+        # instead of listing and stat'ing the directory on every run.
+        self.managed_index = None
+        # Background uploads of the pipelined large strategy, as a dict of
+        # file path to Future.  In daemon mode they outlive the run, and
+        # 'wake' is called whenever one of them finishes.
+        self.large_uploads = {}
+        self.upload_pool = None
+        self.wake = None
 
     def run(self):
         """Runs the torrent rotator algorithm."""
+        try:
+            with metrics.RUN_DURATION.time():
+                self._rotate()
+        finally:
+            metrics.LAST_RUN.set(time.time())
+            if self.METRICS_TEXTFILE:
+                metrics.REGISTRY.write_textfile(os.path.expanduser(self.METRICS_TEXTFILE))
+            if self.profiler.enabled:
+                info(self.profiler.report())
+                self.profiler.reset()
+
+    def _rotate(self):
+        with self.profiler.phase('snapshot'):
+            self.snapshot = self.take_snapshot()
+        self.swarm.observe(self.snapshot.downloads.values(), self.clock())
         large_torrent = self.check_for_large_managed_torrents()
 
         if large_torrent is not None:
             info("Detected incomplete & already loaded large torrent.  Switching to large strategy.")
             info("Torrent is \n%s" % pformat(large_torrent, width=120))
-            load_new_p = self.handle_large_torrent_strategy(large_torrent)
+            with self.profiler.phase('large_strategy'):
+                load_new_p = self.handle_large_torrent_strategy(large_torrent)
             if load_new_p:
                 # Although we *could* load a new torrent here, it's easier for
                 # algorithmic purposes to just not and wait until the next run.
                 info("Detected completed large torrent.  Clearing until next run.")
-                self.purge_torrent(large_torrent)
+                with self.profiler.phase('purge'):
+                    self.purge_torrent(large_torrent)
 
             info("Large strategy completed successfully.")
         else:
@@ -89,19 +161,22 @@ class RtorrentLowSpaceDriver(object):
                         by_size = sorted(load_candidates, key=lambda t: t['size'])
 
                         # slice off just the first item
-                        self.load_torrents(by_size[:1])
-                        self.handle_large_torrent_strategy(by_size[0])
+                        with self.profiler.phase('load'):
+                            self.load_torrents(by_size[:1])
+                        with self.profiler.phase('large_strategy'):
+                            self.handle_large_torrent_strategy(by_size[0])
                         info("First run of large strategy completed successfully.")
                 else:
                     info(
                         "No candidates to load.  Either all torrents are already loaded, or there are no torrents in "
                         "the managed directory.")
                     info("For you to verify, said managed torrent list is \n%s" % pformat(
-                        self.build_managed_torrents_list(), width=120))
+                        self.snapshot.managed, width=120))
                     info("Now quietly exiting successfully.")
             else:
                 info("Small strategy succeeded.  See you next time!")
 
+        self.swarm.commit(self.snapshot.managed)
         info("Done.")
 
     # SMALL TORRENT STRATEGY
@@ -122,12 +197,7 @@ class RtorrentLowSpaceDriver(object):
             return None
 
     def insufficiently_seeded_managed_torrents_exist(self):
-        managed_torrents = self.build_managed_torrents_list()
-        rt_complete, rt_incomplete = self.get_torrents_from_rtorrent()
-        managed_and_complete = [
-            managed_torrents[t] for t in rt_complete
-            if t in managed_torrents
-        ]
+        managed_and_complete = self.snapshot.managed_in(self.snapshot.complete())
 
         for t in managed_and_complete:
             ratio = self.get_ratio_of_torrent(t['hash'])
@@ -145,79 +215,122 @@ class RtorrentLowSpaceDriver(object):
         return False
 
     def get_incomplete_managed_torrents(self):
-        managed_torrents = self.build_managed_torrents_list()
-        rt_complete, rt_incomplete = self.get_torrents_from_rtorrent()
-
-        managed_torrents_in_client = [
-            managed_torrents[t] for t in rt_incomplete
-            if t in managed_torrents
-        ]
+        managed_torrents_in_client = self.snapshot.managed_in(self.snapshot.incomplete())
 
         debug("Managed torrents in client: \n%s" % pformat(managed_torrents_in_client, width=120))
 
         return managed_torrents_in_client
 
     def handle_small_torrents_strategy(self):
-        managed_torrents = self.build_managed_torrents_list()
-        rt_complete, rt_incomplete = self.get_torrents_from_rtorrent()
-        self.sync_and_remove(
-            [managed_torrents[t] for t in rt_complete
-             if t in managed_torrents]
-        )
-
-        # Update the list of torrents to account for removals.  Effective
-        # space should consider both completed and incomplete torrents,
-        # because torrents that didn't seed yet sit around consuming space
-        # for quite a while.
-        rt_complete, rt_incomplete = self.get_torrents_from_rtorrent()
-        effective_space = self.compute_effective_available_space(
-            [managed_torrents[t] for t in (rt_incomplete + rt_complete)
-             if t in managed_torrents]
-        )
+        with self.profiler.phase('sync_and_remove'):
+            self.sync_and_remove(
+                self.snapshot.managed_in(self.snapshot.complete())
+            )
+        if self.STALL_WINDOW:
+            with self.profiler.phase('stalls'):
+                self.handle_stalled_torrents()
+
+        # The snapshot already accounts for removals.  Effective space should
+        # consider both completed and incomplete torrents, because torrents
+        # that didn't seed yet sit around consuming space for quite a while.
+        rt_complete = self.snapshot.complete()
+        rt_incomplete = self.snapshot.incomplete()
+        with self.profiler.phase('plan'):
+            effective_space = self.compute_effective_available_space(
+                self.snapshot.managed_in(rt_incomplete + rt_complete)
+            )
         info("Available size to load is %d", effective_space)
 
         load_candidates = self.filter_out_managed_items_already_in_client(
-            managed_torrents, rt_incomplete, rt_complete
+            self.snapshot.managed, rt_incomplete, rt_complete
         )
+        now = self.clock()
+        load_candidates = [t for t in load_candidates if not self.swarm.parked(t['hash'], now)]
         load_choices = self.build_next_load_group(
             load_candidates, effective_space
         )
 
         info("Decided to load these torrents: \n%s" % pformat(load_choices, width=120))
-        self.load_torrents(load_choices)
+        with self.profiler.phase('load'):
+            self.load_torrents(load_choices)
 
         return load_candidates, load_choices
 
+    # Feeds every rtorrent call to the metrics, and to the profiler when it
+    # is enabled.
+    def observe_rpc(self, method, seconds, exception, request_bytes, response_bytes):
+        metrics.observe_rpc(method, seconds, exception, request_bytes, response_bytes)
+        self.profiler.record(method, seconds, request_bytes, response_bytes)
+
+    # Cheap summary of everything that should trigger a new run in daemon
+    # mode: which managed torrent files exist, which downloads are loaded,
+    # whether they completed or reached the required ratio, and which failed
+    # transfers are due for another attempt.
+    def state_fingerprint(self):
+        if self.managed_index is not None:
+            self.managed_index.refresh()
+            managed_files = self.managed_index.stamps()
+        else:
+            managed_files = sorted(
+                (entry.name, entry.stat().st_mtime_ns)
+                for entry in os.scandir(self.MANAGED_TORRENTS_DIRECTORY)
+            )
+        with self.profiler.phase('fingerprint'):
+            records = self.server.download_states()
+        downloads = sorted(
+            (d.hash, d.complete, d.ratio >= self.REQUIRED_RATIO)
+            for d in records
+        )
+        uploads = sorted((path, f.done()) for path, f in self.large_uploads.items())
+        retries = self.remote_sync_service.retry_queue.ready_keys()
+        return managed_files, downloads, uploads, retries
+
     # make lookup table for torrents, should be a set
     def build_managed_torrents_list(self):
-        managed_torrents = {}
-        for torrent in os.listdir(self.MANAGED_TORRENTS_DIRECTORY):
-            full_path = os.path.join(self.MANAGED_TORRENTS_DIRECTORY, torrent)
-
-            try:
-                t_info = self.metadata_service.torrent_info(full_path)
-            except RuntimeError as e:
-                error("Cannot read torrent info for '%s', perhaps corrupted" % full_path)
-                raise e
-
-            hash_ = str(t_info.info_hash()).upper()
-            # We redundantly store the hash in the value, just to make things
-            # easier a bit later
-            datum = {
-                'torrent_path': full_path,
-                'size': t_info.total_size(),
-                'name': t_info.name(),
-                'hash': hash_,
-            }
-            managed_torrents[hash_] = datum
+        if self.managed_index is not None:
+            self.managed_index.refresh()
+            managed_torrents = self.managed_index.torrents()
+        else:
+            managed_torrents = {}
+            for torrent in os.listdir(self.MANAGED_TORRENTS_DIRECTORY):
+                full_path = os.path.join(self.MANAGED_TORRENTS_DIRECTORY, torrent)
+                datum = self.read_managed_torrent(full_path)
+                managed_torrents[datum['hash']] = datum
+
+        self.metadata_service.commit(
+            [t['torrent_path'] for t in managed_torrents.values()]
+        )
         return managed_torrents
 
-    def get_torrents_from_rtorrent(self):
-        return splitter(
-            self.server.download_list(), lambda t: self.server.d.complete(t) == 1
-        )
+    def read_managed_torrent(self, full_path):
+        try:
+            t_info = self.metadata_service.torrent_info(full_path)
+        except RuntimeError as e:
+            error("Cannot read torrent info for '%s', perhaps corrupted" % full_path)
+            raise e
+
+        hash_ = str(t_info.info_hash()).upper()
+        # We redundantly store the hash in the value, just to make things
+        # easier a bit later
+        return {
+            'torrent_path': full_path,
+            'size': t_info.total_size(),
+            'name': t_info.name(),
+            'hash': hash_,
+            # When the torrent joined the queue, for the scheduling policies
+            'added': os.path.getmtime(full_path),
+        }
+
+    # Capture the managed directory and rtorrent's download list once, so
+    # that the rest of the run can work from the snapshot.  All per-download
+    # fields arrive in a single d.multicall2 round trip.
+    def take_snapshot(self):
+        managed_torrents = self.build_managed_torrents_list()
+        downloads = {d.hash: d for d in self.server.download_records()}
+        return snapshot.RunSnapshot(managed_torrents, downloads)
 
     def sync_and_remove(self, torrent_list):
+        ready = []
         for completed_torrent in torrent_list:
             infohash = completed_torrent['hash']
             info("Handling completed torrent: %s" % completed_torrent['name'])
@@ -229,26 +342,38 @@ class RtorrentLowSpaceDriver(object):
                 info("Torrent is completed but not seeded to required ratio.  Skipping.")
                 continue
 
-            base_path = self.server.d.base_path(infohash)
-            base_filename = self.server.d.base_filename(infohash)
-            self.remote_sync_service.sync_path(base_path, base_filename)
-            self.purge_torrent(completed_torrent)
+            ready.append(completed_torrent)
+
+        # Uploads run concurrently, and each torrent is purged as soon as its
+        # own upload is done.
+        jobs = [
+            (self.get_download_field(t['hash'], 'base_path'),
+             self.get_download_field(t['hash'], 'base_filename'))
+            for t in ready
+        ]
+        remaining = len(jobs)
+        metrics.UPLOAD_QUEUE_DEPTH.set(remaining, kind='torrents')
+        for index, exception in self.remote_sync_service.sync_paths(jobs):
+            remaining -= 1
+            metrics.UPLOAD_QUEUE_DEPTH.set(remaining, kind='torrents')
+            if exception is not None:
+                error("Failed to sync %s, leaving it for the next run.  exception was '%s'"
+                      % (ready[index]['name'], exception))
+                continue
+            self.purge_torrent(ready[index])
 
     # Purge a torrent, this means remove it from rtorrent, also delete the
     # local files, and remove the torrent from the group of managed torrents.
     # Takes a torrent object.
     def purge_torrent(self, completed_torrent):
-        # XXX: This method could probably use some caching
-        managed_torrents = self.build_managed_torrents_list()
         infohash = completed_torrent['hash']
-        base_path = self.server.d.base_path(infohash)
+        base_path = self.get_download_field(infohash, 'base_path')
+        directory = self.get_download_field(infohash, 'directory')
 
         self.server.d.erase(infohash)
-
-        if os.path.isdir(base_path):
-            shutil.rmtree(base_path)
-        else:
-            os.remove(base_path)
+        self.delete_download_data(base_path)
+        # The files of a large torrent were recorded under its directory.
+        self.remote_sync_service.forget(directory)
 
         torrent_path = completed_torrent['torrent_path']
         if os.path.exists(torrent_path):
@@ -257,10 +382,89 @@ class RtorrentLowSpaceDriver(object):
         else:
             info("Tied torrent file was already deleted by rtorrent.")
 
+        if self.managed_index is not None:
+            self.managed_index.discard(torrent_path)
+
+        self.snapshot.purged(completed_torrent)
+        metrics.TORRENTS_PURGED.inc()
+
+    def delete_download_data(self, base_path):
+        if os.path.isdir(base_path):
+            shutil.rmtree(base_path)
+        elif os.path.lexists(base_path):
+            os.remove(base_path)
+
+    # Give the space of managed downloads that made no progress for
+    # stall_window back to the pool.  Parked torrents stay managed and are
+    # loaded again after another stall_window, evicted ones are moved to the
+    # stalled_torrents_directory.  Downloads that aren't running, because
+    # they were stopped, are queued or are hash checking, and downloads with
+    # uploads in flight are left alone.
+    def handle_stalled_torrents(self):
+        now = self.clock()
+        for torrent in self.snapshot.managed_in(self.snapshot.incomplete()):
+            infohash = torrent['hash']
+            record = self.snapshot.downloads.get(infohash)
+            if record is None or not record.is_active or record.is_hash_checking:
+                continue
+            if not self.swarm.stalled(infohash, now, self.STALL_WINDOW):
+                continue
+            base_path = self.get_download_field(infohash, 'base_path')
+            if any(path == base_path or path.startswith(base_path + os.sep) for path in self.large_uploads):
+                continue
+
+            entry = self.swarm.get(infohash)
+            info("%s made no progress for %d seconds, with %d seeders and %d peers.  %s it." % (
+                torrent['name'], now - entry['progress_at'], entry['seeders'], entry['peers'],
+                'Parking' if self.STALL_ACTION == 'park' else 'Evicting'))
+            self.unload_stalled_torrent(torrent, base_path)
+            if self.STALL_ACTION == 'park':
+                self.swarm.park(infohash, now + self.STALL_WINDOW)
+                self.snapshot.erased(infohash)
+            else:
+                self.snapshot.purged(torrent)
+            metrics.STALLED_TORRENTS.inc(action=self.STALL_ACTION)
+
+    # Erase a stalled download and its data, keeping its torrent file, which
+    # rtorrent may delete along with the download.  Parked torrent files are
+    # restored with their mtime, so they keep their place in the queue.
+    def unload_stalled_torrent(self, torrent, base_path):
+        torrent_path = torrent['torrent_path']
+        try:
+            with open(torrent_path, 'rb') as f:
+                contents = f.read()
+            st = os.stat(torrent_path)
+        except FileNotFoundError:
+            warning("Torrent file %s is gone already" % torrent_path)
+            contents = None
+
+        self.server.d.erase(torrent['hash'])
+        self.delete_download_data(base_path)
+
+        if self.STALL_ACTION == 'evict':
+            destination = os.path.join(
+                os.path.expanduser(self.STALLED_TORRENTS_DIRECTORY), os.path.basename(torrent_path))
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            if os.path.exists(torrent_path):
+                shutil.move(torrent_path, destination)
+            elif contents is not None:
+                with open(destination, 'wb') as f:
+                    f.write(contents)
+            if self.managed_index is not None:
+                self.managed_index.discard(torrent_path)
+        elif not os.path.exists(torrent_path) and contents is not None:
+            info("Tied torrent file was deleted by rtorrent.  Restoring it.")
+            with open(torrent_path, 'wb') as f:
+                f.write(contents)
+            os.utime(torrent_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
     # "Cumulative used size" here means the actual size used by completed
     # torrents, plus the size projected to be used by the currently loaded
     # incomplete torrents.
     def compute_effective_available_space(self, torrent_list):
+        if self.SPACE_ACCOUNTING == 'allocated':
+            return self.compute_allocated_available_space()
+
         # Count incomplete torrents
         cumulative_used_size = 0
         for torrent in torrent_list:
@@ -269,8 +473,58 @@ class RtorrentLowSpaceDriver(object):
         info("Cumulative used and incomplete size was %d" % cumulative_used_size)
         effective_available_size = self.SPACE_LIMIT - cumulative_used_size
 
+        self.record_space_metrics(cumulative_used_size, effective_available_size)
+        return effective_available_size
+
+    # The allocated accounting charges every loaded download, managed or
+    # not, with the blocks it really occupies on disk plus the bytes it still
+    # has to download.  Partially downloaded files and files zeroed by the
+    # large strategy are thus counted for what they use, not their nominal
+    # size.  The result is also clamped to what is left on the volume new
+    # downloads go to, once the downloads already on it are finished.
+    def compute_allocated_available_space(self):
+        default_directory = self.server.directory.default('')
+        used_size = 0
+        outstanding = collections.Counter()
+
+        for infohash, record in self.snapshot.downloads.items():
+            if record is None:
+                # Loaded during this run, nothing known but the nominal size.
+                size = self.snapshot.managed.get(infohash, {}).get('size', 0)
+                used_size += size
+                outstanding[diskusage.volume_of(default_directory)] += size
+                continue
+
+            on_disk = diskusage.allocated_bytes(self.download_data_path(record))
+            remaining = 0 if record.complete else max(0, record.size_bytes - record.completed_bytes)
+            used_size += on_disk + remaining
+            outstanding[diskusage.volume_of(record.directory or default_directory)] += remaining
+
+        info("Allocated and outstanding size was %d" % used_size)
+        effective_available_size = self.SPACE_LIMIT - used_size
+
+        volume = diskusage.volume_of(default_directory)
+        volume_available_size = diskusage.free_bytes(default_directory) - outstanding[volume]
+        info("Volume of %s can take another %d" % (default_directory, volume_available_size))
+
+        effective_available_size = min(effective_available_size, volume_available_size)
+        self.record_space_metrics(used_size, effective_available_size)
         return effective_available_size
 
+    def record_space_metrics(self, used_size, effective_available_size):
+        metrics.SPACE_BYTES.set(self.SPACE_LIMIT, kind='limit')
+        metrics.SPACE_BYTES.set(used_size, kind='used')
+        metrics.SPACE_BYTES.set(effective_available_size, kind='available')
+
+    # rtorrent only reports d.base_path while a download is open, so for
+    # stopped ones the path is rebuilt from its directory.
+    def download_data_path(self, record):
+        if record.base_path:
+            return record.base_path
+        if record.size_files > 1:
+            return record.directory
+        return os.path.join(record.directory, record.base_filename)
+
     def filter_out_managed_items_already_in_client(
         self, managed_group, incomplete_group, complete_group
     ):
@@ -282,19 +536,19 @@ class RtorrentLowSpaceDriver(object):
 
         return not_already_loaded
 
+    # Order the candidates by the configured scheduling_policy, then pick the
+    # set that will fit according to the configured packing_mode
     def build_next_load_group(self, candidates, space):
-        # Pick the first set that will fit
-        by_size = sorted(candidates, key=lambda t: t['size'])
-        this_group = []
-        total_size = 0
-
-        for torrent in by_size:
-            if (total_size + torrent['size']) > space:
-                break
-            this_group.append(torrent)
-            total_size += torrent['size']
-
-        return this_group
+        ordered = self.policy.order(candidates, self.scoring_context())
+        return self.pack(ordered, space)
+
+    def scoring_context(self):
+        downloads = self.snapshot.downloads if self.snapshot is not None else {}
+        return policies.ScoringContext(
+            self.clock(), downloads,
+            aging_period=self.AGING_PERIOD, rotation_overhead=self.ROTATION_OVERHEAD,
+            swarm=self.swarm
+        )
 
     def load_torrents(self, torrent_paths):
         start_function = getattr(self.server, 'load.start')
@@ -303,6 +557,8 @@ class RtorrentLowSpaceDriver(object):
             # For some reason, it needs to have a blank string as the first
             # target.  See <https://github.com/rakshasa/rtorrent/issues/627>
             start_function('', torrent_to_load['torrent_path'])
+            self.snapshot.loaded(torrent_to_load)
+            metrics.TORRENTS_LOADED.inc()
 
     # LARGE TORRENT STRATEGY
 
@@ -311,39 +567,60 @@ class RtorrentLowSpaceDriver(object):
     # Returns a boolean indicating if this torrent should be removed, and a
     # new large torrent should be loaded.
     def handle_large_torrent_strategy(self, torrent):
+        if self.LARGE_STRATEGY_MODE == 'pipelined':
+            return self.handle_large_torrent_strategy_pipelined(torrent)
+
         infohash = torrent['hash']
 
-        realpath = self.server.d.directory(infohash)
+        realpath = self.get_download_field(infohash, 'directory')
 
         info("Managing large torrent: %s" % torrent['name'])
 
         self.stop_torrent(infohash)
-        local_completed_files = self.check_for_local_completed_files(infohash)
+        # A single f.multicall serves every per-file question below.
+        files = self.server.file_records(infohash)
+        layout = pieces.PieceLayout(files, self.get_download_field(infohash, 'chunk_size'))
+        local_completed_files = self.check_for_local_completed_files(files)
         info("Locally completed files: \n%s" % pformat(local_completed_files, width=120))
 
-        self.remote_sync_service.maybe_create_directory(realpath)
+        try:
+            self.remote_sync_service.maybe_create_directory(realpath)
 
-        if local_completed_files:
-            self.sync_completed_files_to_remote(realpath, local_completed_files)
-        else:
-            info("Nothing completed locally, so not syncing anything.")
+            if local_completed_files:
+                self.sync_completed_files_to_remote(realpath, local_completed_files)
+            else:
+                info("Nothing completed locally, so not syncing anything.")
 
-        remote_completed_list = self.remote_sync_service.list_files(realpath)
+            remote_completed_list = self.remote_sync_service.list_files(realpath)
+        except retry.RemoteUnavailable as e:
+            # Nothing was removed yet, so the torrent just carries on with the
+            # files it has, and the completed ones are synced next time.
+            error("Remote is unavailable, resuming torrent until the next run.  exception was '%s'" % e)
+            self.start_torrent(infohash)
+            return False
         debug("Remotely completed files: \n%s" % pformat(remote_completed_list, width=120))
 
-        self.remove_completed_files(realpath, local_completed_files)
-        self.set_all_files_to_zero_priority(infohash)
+        done = set(remote_completed_list) | set(local_completed_files)
+        removable_files, kept_size = self.split_removable_files(
+            files, layout, local_completed_files, done
+        )
+        info("Keeping %d bytes of completed files until their neighbours complete." % kept_size)
+        self.remove_completed_files(realpath, removable_files)
 
-        next_group = self.generate_next_group(infohash, remote_completed_list)
+        next_group = self.generate_next_group(
+            files, remote_completed_list, layout, self.SPACE_LIMIT - kept_size
+        )
         debug("Next group: \n%s" % pformat(next_group, width=120))
 
+        # Everything outside the next group drops to zero priority.
+        self.set_priorities(infohash, files, {x.id: 1 for x in next_group})
+
         if next_group:
-            self.set_priority(infohash, [x['id'] for x in next_group], 1)
             self.start_torrent(infohash)
         else:
             is_completed = \
                 self.is_large_torrent_remotely_completed(
-                    infohash, remote_completed_list
+                    files, remote_completed_list
                 )
             if is_completed:
                 info("We decided that this torrent is completed.")
@@ -353,22 +630,143 @@ class RtorrentLowSpaceDriver(object):
                 self.start_torrent(infohash)
                 return False
 
-    # returns list of locally completed files as IDs
-    def check_for_local_completed_files(self, infohash):
-        completed_list = []
+    # Pipelined variant of the large torrent strategy.  The torrent keeps
+    # running: completed files are handed to background uploads while the
+    # remaining priority-1 files keep downloading, and whatever space the
+    # finished uploads free up is refilled with new files straight away.
+    # It is only stopped for the moment it takes to truncate uploaded files.
+    # Without a daemon to come back to them, the uploads are awaited before
+    # the run ends.
+    # Returns a boolean with the same meaning as above.
+    def handle_large_torrent_strategy_pipelined(self, torrent):
+        infohash = torrent['hash']
+        realpath = self.get_download_field(infohash, 'directory')
+
+        info("Managing large torrent without stopping it: %s" % torrent['name'])
 
-        size_files = self.server.d.size_files(infohash)
+        files = self.server.file_records(infohash)
+        layout = pieces.PieceLayout(files, self.get_download_field(infohash, 'chunk_size'))
 
-        for i in range(size_files):
-            id_ = "%s:f%d" % (infohash, i)
-            path = self.server.f.path(id_)
-            debug("Torrent path: %s" % path)
-            done = self.server.f.completed_chunks(id_)
-            total = self.server.f.size_chunks(id_)
-            priority = self.server.f.priority(id_)
+        try:
+            self.remote_sync_service.maybe_create_directory(realpath)
+            remote_completed = set(self.remote_sync_service.list_files(realpath))
+        except retry.RemoteUnavailable as e:
+            # The torrent keeps downloading its current files meanwhile.
+            error("Remote is unavailable, trying again on the next run.  exception was '%s'" % e)
+            return False
+        debug("Remotely completed files: \n%s" % pformat(sorted(remote_completed), width=120))
+
+        uploaded = self.collect_finished_uploads()
+        local_completed_files = [
+            path for path in self.check_for_local_completed_files(files)
+            if path not in remote_completed and path not in self.large_uploads
+        ]
+        info("Locally completed files: \n%s" % pformat(local_completed_files, width=120))
+        if local_completed_files:
+            self.start_upload(realpath, local_completed_files)
+
+        if self.wake is None:
+            info("Waiting for %d uploads to finish." % len(self.large_uploads))
+            concurrent.futures.wait(list(self.large_uploads.values()))
+            uploaded += self.collect_finished_uploads()
+
+        done = remote_completed | set(uploaded)
+        removable_files, kept_size = self.split_removable_files(files, layout, uploaded, done)
+        if removable_files:
+            files = self.release_completed_files(infohash, realpath, files, removable_files)
+
+        # Files that are uploading, or were picked and started downloading,
+        # keep their space, and the rest of the budget goes to the next files.
+        # Picked files without any progress yet are simply picked again, which
+        # also keeps the default priorities of a freshly loaded torrent out.
+        in_flight = [
+            x for x in files
+            if x.path not in done and (
+                x.path in self.large_uploads
+                or (x.priority > 0 and x.completed_chunks > 0)
+            )
+        ]
+        covered = set()
+        used_size = kept_size
+        for x in in_flight:
+            used_size += layout.cost(x.index, covered)
+            covered |= layout.boundary_pieces(x.index)
+        info("%d bytes in use by %d files in flight and completed files." % (used_size, len(in_flight)))
+
+        next_group = self.generate_next_group(
+            files, list(done) + [x.path for x in in_flight], layout,
+            self.SPACE_LIMIT - used_size, covered
+        )
+        debug("Next group: \n%s" % pformat(next_group, width=120))
 
-            if done == total and priority > 0:
-                completed_list.append(self.server.f.path(id_))
+        self.set_priorities(infohash, files, {x.id: 1 for x in in_flight + next_group})
+
+        if in_flight or next_group:
+            if not self.server.d.is_active(infohash):
+                self.start_torrent(infohash)
+            return False
+
+        is_completed = self.is_large_torrent_remotely_completed(files, list(done))
+        if is_completed:
+            info("We decided that this torrent is completed.")
+        return is_completed
+
+    # Truncate uploaded files of a torrent that keeps running.  rtorrent maps
+    # file data into memory and peers may still request those pieces, so the
+    # files first drop to priority 0, and are closed by stopping the torrent
+    # for as long as the truncation takes.  Returns the file records with the
+    # new priorities.
+    def release_completed_files(self, infohash, realpath, files, paths):
+        released = set(paths)
+        self.set_priorities(infohash, files, {x.id: x.priority for x in files if x.path not in released})
+        files = [x._replace(priority=0) if x.path in released else x for x in files]
+
+        was_active = self.server.d.is_active(infohash)
+        self.stop_torrent(infohash)
+        try:
+            self.remove_completed_files(realpath, paths)
+        finally:
+            if was_active:
+                self.start_torrent(infohash)
+        return files
+
+    def start_upload(self, realpath, paths):
+        if self.upload_pool is None:
+            self.upload_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.remote_sync_service.upload_workers
+            )
+
+        future = self.upload_pool.submit(self.sync_completed_files_to_remote, realpath, paths)
+        if self.wake is not None:
+            future.add_done_callback(lambda f: self.wake())
+        for path in paths:
+            self.large_uploads[path] = future
+        metrics.UPLOAD_QUEUE_DEPTH.set(len(self.large_uploads), kind='large_torrent_files')
+
+    # Returns the paths whose background upload succeeded since the last
+    # call.  Failed uploads are forgotten, so that the files are picked up
+    # again as locally completed on the next pass.
+    def collect_finished_uploads(self):
+        uploaded = []
+        for path, future in list(self.large_uploads.items()):
+            if not future.done():
+                continue
+            del self.large_uploads[path]
+            if future.exception() is not None:
+                error("Failed to upload %s, retrying later.  exception was '%s'" % (path, future.exception()))
+            else:
+                uploaded.append(path)
+        metrics.UPLOAD_QUEUE_DEPTH.set(len(self.large_uploads), kind='large_torrent_files')
+        return uploaded
+
+    # returns list of locally completed files as paths
+    def check_for_local_completed_files(self, files):
+        completed_list = []
+
+        for file_ in files:
+            debug("Torrent path: %s" % file_.path)
+            if file_.completed_chunks == file_.size_chunks and file_.priority > 0:
+                completed_list.append(file_.path)
 
         return completed_list
 
@@ -384,19 +782,45 @@ class RtorrentLowSpaceDriver(object):
             for path in completed_files:
                 transfer_list.write(bytes(path + "\n", 'utf8'))
 
-        self.remote_sync_service.sync_files_from_filelist(realpath, tmpfile_path)
-        os.remove(transfer_list.name)
+        try:
+            self.remote_sync_service.sync_files_from_filelist(realpath, tmpfile_path)
+        finally:
+            os.remove(tmpfile_path)
+
+    # A completed file may only be truncated once every file it shares a
+    # piece with is done too.  Truncating it earlier corrupts the shared
+    # pieces while a neighbour still needs them.  Returns the paths that
+    # are safe to truncate now, and the total size of done files that have
+    # to stay on disk for the time being.
+    def split_removable_files(self, files, layout, local_completed_files, done):
+        newly_done = set(local_completed_files)
+        removable_files = []
+        kept_size = 0
+
+        for file_ in files:
+            if file_.path not in done:
+                continue
+
+            neighbours = [files[j] for j in layout.neighbours(file_.index)]
+            if not all(n.path in done for n in neighbours):
+                kept_size += file_.size_bytes
+            elif file_.path in newly_done or any(n.path in newly_done for n in neighbours):
+                # Other done files were already truncated on an earlier pass.
+                removable_files.append(file_.path)
+
+        return removable_files, kept_size
 
     def remove_completed_files(self, realpath, completed_files):
         for path in completed_files:
             self._zero_out_file(os.path.join(realpath, path))
         subprocess.check_call(["sync"])
+        metrics.FILES_ROTATED.inc(len(completed_files))
 
     def _zero_out_file(self, path):
         open(path.encode('utf8'), 'w').close()
 
-    def is_large_torrent_remotely_completed(self, infohash, remote_completed_list):
-        file_len = self.server.d.size_files(infohash)
+    def is_large_torrent_remotely_completed(self, files, remote_completed_list):
+        file_len = len(files)
         debug("Files in torrent: %d" % file_len)
         debug("Remotely completed files: %d" % len(remote_completed_list))
 
@@ -405,19 +829,27 @@ class RtorrentLowSpaceDriver(object):
         # it's too dangerous to use --delete, so we just leave them there.
         return len(remote_completed_list) >= file_len
 
-    def set_all_files_to_zero_priority(self, infohash):
-        id_list = []
-        file_len = self.server.d.size_files(infohash)
-
-        for i in range(file_len):
-            id_list.append("%s:f%d" % (infohash, i))
+    # Bring file priorities in line with 'wanted', a dict of file id to
+    # priority where missing files mean zero.  Only files whose priority
+    # actually changes are sent, batched together with the trailing
+    # d.update_priorities into one system.multicall round trip.
+    def set_priorities(self, infohash, files, wanted):
+        changes = [
+            (x.id, wanted.get(x.id, 0)) for x in files
+            if x.priority != wanted.get(x.id, 0)
+        ]
+        debug("Changing priority of %d files out of %d" % (len(changes), len(files)))
+        if not changes:
+            return
 
-        self.set_priority(infohash, id_list, 0)
+        multicall = xmlrpc.client.MultiCall(self.server)
+        for id_, priority in changes:
+            multicall.f.priority.set(id_, priority)
+        multicall.d.update_priorities(infohash)
 
-    def set_priority(self, infohash, ids, priority):
-        for id_ in ids:
-            self.server.f.priority.set(id_, priority)
-        self.server.d.update_priorities(infohash)
+        # Iterating the results raises the first fault, if any.
+        for result in multicall():
+            pass
 
     # Check for the situation where, under the large torrents strategy, a large
     # torrent has a single file within it that breaches the global space limit.
@@ -427,8 +859,8 @@ class RtorrentLowSpaceDriver(object):
         limit = self.SPACE_LIMIT
 
         for file_ in file_list:
-            path = file_['path']
-            file_size = file_['size']
+            path = file_.path
+            file_size = file_.size_bytes
             if file_size > self.SPACE_LIMIT:
                 new_suggested_size = file_size + (10 * 2**20)
                 warning(
@@ -444,40 +876,46 @@ class RtorrentLowSpaceDriver(object):
                     f"Suggest raising limit to {new_suggested_size}."
                 )
 
-    def generate_next_group(self, infohash, exclude_list):
-        file_len = self.server.d.size_files(infohash)
-        file_list = []
-        for i in range(file_len):
-            id_ = "%s:f%d" % (infohash, i)
-            size = self.server.f.size_bytes(id_)
-            path = self.server.f.path(id_)
-            datum = {
-                'id': id_, 'size': size, 'path': path
-            }
-            file_list.append(datum)
-
+    def generate_next_group(self, file_list, exclude_list, layout, space, covered=()):
         debug("File list was: \n%s", pformat(file_list, width=120))
 
         self.check_for_intractable_files(file_list)
 
         # filter out items existing on remote
-        filtered_items = [x for x in file_list if x['path'] not in exclude_list]
+        exclude_set = set(exclude_list)
+        pending = {x.index for x in file_list if x.path not in exclude_set}
 
         info("Filtered list was:\n%s", pformat(file_list, width=120))
 
-        # sort items by size
-        filtered_items.sort(key=lambda x: x['size'])
+        # Pick files by the bytes they would add, cheapest first, until we
+        # hit the space limit.  Pieces shared with a neighbouring file count
+        # against the space, but only once: picking a file makes its
+        # neighbours cheaper, which pulls files sharing pieces into the same
+        # group.  Heap entries go stale when that happens, so every cost is
+        # checked again when popped.
+        covered = set(covered)
+        heap = [(layout.cost(i, covered), i) for i in pending]
+        heapq.heapify(heap)
 
-        # pick until we hit the space limit
         size_so_far = 0
         group = []
-        for file_ in filtered_items:
-            this_size = file_['size']
-            if (size_so_far + this_size) > self.SPACE_LIMIT:
+        while heap:
+            cost, i = heapq.heappop(heap)
+            if i not in pending:
+                continue
+            if cost != layout.cost(i, covered):
+                heapq.heappush(heap, (layout.cost(i, covered), i))
+                continue
+            if (size_so_far + cost) > space:
                 break
 
-            size_so_far += this_size
-            group.append(file_)
+            size_so_far += cost
+            pending.discard(i)
+            group.append(file_list[i])
+            covered |= layout.boundary_pieces(i)
+            for j in layout.neighbours(i):
+                if j in pending:
+                    heapq.heappush(heap, (layout.cost(j, covered), j))
 
         return group
 
@@ -492,9 +930,21 @@ class RtorrentLowSpaceDriver(object):
                 self.server.d.stop(infohash)
                 time.sleep(1)
 
+    # Per-download fields come from the run snapshot.  Downloads loaded during
+    # this run have no record yet, so for those we ask rtorrent directly.
+    def get_download_field(self, infohash, field):
+        record = self.snapshot.downloads.get(infohash)
+        if record is not None:
+            return getattr(record, field)
+        return getattr(self.server.d, field)(infohash)
+
     # For some reason the XMLRPC interface returns the ratio as an i8, so
-    # convert it to the more regular floating point ratio.
+    # convert it to the more regular floating point ratio.  Snapshot records
+    # are already converted.
     def get_ratio_of_torrent(self, infohash):
+        record = self.snapshot.downloads.get(infohash)
+        if record is not None:
+            return record.ratio
         ratio = self.server.d.ratio(infohash)
         float_ratio = ratio / 1000.0
         return float_ratio
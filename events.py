@@ -0,0 +1,110 @@
+from logging import info, warning
+import os
+import socket
+import sys
+import xmlrpc.client
+
+# rtorrent events reported to the driver, by the name used in datagrams.
+EVENTS = {
+    'finished': 'event.download.finished',
+    'hash_done': 'event.download.hash_done',
+    'erased': 'event.download.erased',
+}
+
+# Events that the driver's own d.erase and load.start calls cause.  They only
+# wake the daemon, whose fingerprint check tells whether anything else
+# changed, instead of forcing another run straight after the one that caused
+# them.
+SELF_CAUSED_EVENTS = {'erased', 'hash_done'}
+
+# Key under which our handlers are registered with method.set_key, so that
+# they can be replaced or removed without touching anybody else's.
+HANDLER_KEY = 'rtorrent_low_space_driver'
+
+NOTIFIER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'notify_driver.py')
+
+
+class EventListener:
+    """Receives download events pushed by rtorrent over a unix datagram socket.
+
+    Each datagram is "<event> <infohash>", as sent by notify_driver.py.
+    Anybody who can write to the socket can make the daemon re-plan, so
+    only the daemon's user and group may.
+    """
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+        # rtorrent may well run as another user, in the daemon's group.
+        os.chmod(path, 0o660)
+        self.sock.setblocking(False)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def collect(self):
+        """Drains pending events.  Returns them as (event, infohash) tuples."""
+        events = []
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except BlockingIOError:
+                return events
+            event, _, infohash = data.decode('utf8', 'replace').partition(' ')
+            info("rtorrent reported event %s for %s" % (event, infohash))
+            events.append((event, infohash.upper()))
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def forces_run(collected):
+    """Returns whether events returned by EventListener.collect() call for
+    a run even if the fingerprint looks the same."""
+    return any(event not in SELF_CAUSED_EVENTS for event, infohash in collected)
+
+
+def handler_command(socket_path, event):
+    """Returns the rtorrent command that notifies socket_path of event."""
+    # execute.nothrow.bg neither waits for the notifier nor fails the event
+    # when no daemon is listening.
+    return "execute.nothrow.bg={python},{notifier},{socket},{event},$d.hash=".format(
+        python=sys.executable, notifier=NOTIFIER, socket=socket_path, event=event
+    )
+
+
+def install_handlers(server, socket_path):
+    """Makes rtorrent report download events to socket_path.
+
+    Returns:
+        Whether the handlers could be installed.
+    """
+    multicall = xmlrpc.client.MultiCall(server)
+    for event, key in EVENTS.items():
+        getattr(multicall, 'method.set_key')('', key, HANDLER_KEY, handler_command(socket_path, event))
+    try:
+        for result in multicall():
+            pass
+    except (xmlrpc.client.Fault, OSError) as e:
+        warning("Failed to install rtorrent event handlers, relying on polling.  exception was '%s'" % e)
+        return False
+    info("Installed rtorrent event handlers for %s" % ', '.join(EVENTS))
+    return True
+
+
+def remove_handlers(server):
+    """Removes the handlers installed by install_handlers()."""
+    multicall = xmlrpc.client.MultiCall(server)
+    for key in EVENTS.values():
+        # Setting a key without a command erases it.
+        getattr(multicall, 'method.set_key')('', key, HANDLER_KEY)
+    try:
+        for result in multicall():
+            pass
+    except (xmlrpc.client.Fault, OSError) as e:
+        warning("Failed to remove rtorrent event handlers.  exception was '%s'" % e)
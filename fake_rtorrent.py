@@ -0,0 +1,304 @@
+"""In-process stand-ins for rtorrent, the torrent metadata library and the
+remote, so that the driver can run end to end without any of them.
+
+FakeRtorrent speaks SCGI/XML-RPC on a unix socket, like the real thing, and
+implements the subset of commands the driver uses against an in-memory model
+of its downloads.
+"""
+from logging import debug
+import collections
+import math
+import os
+import socketserver
+import threading
+import xmlrpc.client
+
+import metadata
+import remotesync
+
+
+class I8Marshaller(xmlrpc.client.Marshaller):
+    """Marshals integers beyond 32 bits as <i8>, like rtorrent does."""
+    dispatch = dict(xmlrpc.client.Marshaller.dispatch)
+
+    def dump_long(self, value, write):
+        if xmlrpc.client.MININT <= value <= xmlrpc.client.MAXINT:
+            return super().dump_long(value, write)
+        write("<value><i8>%d</i8></value>\n" % value)
+    dispatch[int] = dump_long
+
+
+def dump_response(result):
+    """Returns an XML-RPC method response carrying result."""
+    marshaller = I8Marshaller('utf-8', allow_none=False)
+    return ("<?xml version='1.0'?>\n<methodResponse>\n"
+            + marshaller.dumps((result,))
+            + "</methodResponse>\n")
+
+
+class FakeFile:
+    def __init__(self, path, size_bytes, chunk_size, complete=False, priority=1):
+        self.path = path
+        self.size_bytes = size_bytes
+        self.size_chunks = max(1, math.ceil(size_bytes / chunk_size))
+        self.completed_chunks = self.size_chunks if complete else 0
+        self.priority = priority
+
+
+class FakeDownload:
+    """A download as rtorrent would report it."""
+    def __init__(self, infohash, name, directory, files, chunk_size,
+                 complete=False, ratio=0.0, is_active=True, down_rate=0,
+                 peers_complete=0, peers_accounted=0, is_hash_checking=False):
+        """Inits FakeDownload.
+
+        Args:
+            infohash: Upper case hex string.
+            name: Name of the torrent, which is also its base filename.
+            directory: Directory holding the data.  For multi-file torrents
+              this includes the name, like d.directory.
+            files: List of FakeFile.
+            chunk_size: Piece size in bytes.
+        """
+        self.hash = infohash
+        self.name = name
+        self.directory = directory
+        self.files = files
+        self.chunk_size = chunk_size
+        self.complete = complete
+        self.ratio = ratio
+        self.is_active = is_active
+        self.down_rate = down_rate
+        self.peers_complete = peers_complete
+        self.peers_accounted = peers_accounted
+        self.is_hash_checking = is_hash_checking
+
+    def base_path(self):
+        if len(self.files) > 1:
+            return self.directory
+        return os.path.join(self.directory, self.name)
+
+    def size_bytes(self):
+        return sum(f.size_bytes for f in self.files)
+
+    def completed_bytes(self):
+        return sum(f.size_bytes for f in self.files if f.completed_chunks == f.size_chunks)
+
+
+class FakeRtorrent:
+    """A fake rtorrent serving XML-RPC over SCGI on a unix socket.
+
+    Attributes:
+        downloads: Dict of infohash to FakeDownload, in load order.
+        calls: collections.Counter of method names called, with the methods
+          inside a system.multicall counted one by one.
+        requests: Number of SCGI round trips.
+    """
+    def __init__(self, socket_path, data_directory, metadata_service):
+        """Inits FakeRtorrent.
+
+        Args:
+            socket_path: Where to listen, string.
+            data_directory: The default download directory.
+            metadata_service: Resolves the torrent files passed to
+              load.start, normally a FakeMetadataService.
+        """
+        self.socket_path = socket_path
+        self.url = 'scgi://' + socket_path
+        self.data_directory = data_directory
+        self.metadata_service = metadata_service
+        self.downloads = collections.OrderedDict()
+        self.calls = collections.Counter()
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+        self.methods = {
+            'd.multicall2': self.d_multicall2,
+            'f.multicall': self.f_multicall,
+            'system.multicall': self.system_multicall,
+            'load.start': self.load_start,
+            'd.start': lambda infohash: self._set_active(infohash, True),
+            'd.stop': lambda infohash: self._set_active(infohash, False),
+            'd.erase': self.d_erase,
+            'd.update_priorities': lambda infohash: 0,
+            'f.priority.set': self.f_priority_set,
+            'directory.default': lambda target='': self.data_directory,
+            'method.set_key': lambda *args: 0,
+        }
+        for field in ('hash', 'complete', 'ratio', 'base_path', 'base_filename', 'directory',
+                      'size_bytes', 'completed_bytes', 'size_files', 'chunk_size', 'is_active',
+                      'down.rate', 'peers_complete', 'peers_accounted', 'is_hash_checking'):
+            self.methods['d.' + field] = self._getter(field)
+
+    def add_download(self, download):
+        self.downloads[download.hash] = download
+
+    def reset_counts(self):
+        self.calls.clear()
+        self.requests = 0
+
+    # Commands
+
+    def download_field(self, download, field):
+        if field == 'complete':
+            return int(download.complete)
+        if field == 'ratio':
+            return int(download.ratio * 1000)
+        if field == 'base_path':
+            return download.base_path()
+        if field == 'base_filename':
+            return download.name
+        if field in ('size_bytes', 'completed_bytes'):
+            return getattr(download, field)()
+        if field == 'size_files':
+            return len(download.files)
+        if field in ('is_active', 'is_hash_checking'):
+            return int(getattr(download, field))
+        if field == 'down.rate':
+            return download.down_rate
+        return getattr(download, field)
+
+    def _getter(self, field):
+        return lambda infohash: self.download_field(self.downloads[infohash], field)
+
+    def d_multicall2(self, target, view, *commands):
+        fields = [command.rstrip('=')[len('d.'):] for command in commands]
+        return [
+            [self.download_field(download, field) for field in fields]
+            for download in self.downloads.values()
+        ]
+
+    def f_multicall(self, infohash, pattern, *commands):
+        fields = [command.rstrip('=')[len('f.'):] for command in commands]
+        return [
+            [getattr(f, field) for field in fields]
+            for f in self.downloads[infohash].files
+        ]
+
+    def f_priority_set(self, file_id, priority):
+        infohash, _, index = file_id.partition(':f')
+        self.downloads[infohash].files[int(index)].priority = priority
+        return 0
+
+    def load_start(self, target, torrent_path):
+        t_info = self.metadata_service.torrent_info(torrent_path)
+        infohash = str(t_info.info_hash()).upper()
+        self.add_download(FakeDownload(
+            infohash, t_info.name(), self.data_directory,
+            [FakeFile(t_info.name(), t_info.total_size(), 2**20)], 2**20
+        ))
+        return 0
+
+    def d_erase(self, infohash):
+        del self.downloads[infohash]
+        return 0
+
+    def _set_active(self, infohash, active):
+        self.downloads[infohash].is_active = active
+        return 0
+
+    def system_multicall(self, calls):
+        results = []
+        for call in calls:
+            try:
+                results.append([self.dispatch(call['methodName'], call['params'])])
+            except xmlrpc.client.Fault as e:
+                results.append({'faultCode': e.faultCode, 'faultString': e.faultString})
+        return results
+
+    def dispatch(self, method, params):
+        self.calls[method] += 1
+        try:
+            function = self.methods[method]
+        except KeyError:
+            raise xmlrpc.client.Fault(-506, f"Method '{method}' not defined")
+        try:
+            return function(*params)
+        except (KeyError, IndexError, TypeError) as e:
+            raise xmlrpc.client.Fault(-501, f"{method}: {e!r}")
+
+    # Serving
+
+    def handle(self, request_body):
+        """Answers one XML-RPC request body with an SCGI response."""
+        params, method = xmlrpc.client.loads(request_body)
+        with self._lock:
+            self.requests += 1
+            try:
+                response = dump_response(self.dispatch(method, params))
+            except xmlrpc.client.Fault as e:
+                response = xmlrpc.client.dumps(e, methodresponse=True)
+        return b'Status: 200 OK\r\nContent-Type: text/xml\r\n\r\n' + response.encode('utf8')
+
+    def start(self):
+        """Starts serving from a background thread."""
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                # SCGI: a netstring of NUL separated headers, then the body.
+                length = b''
+                while not length.endswith(b':'):
+                    length += self.rfile.read(1)
+                headers = self.rfile.read(int(length[:-1]) + 1)[:-1].split(b'\0')
+                headers = dict(zip(headers[::2], headers[1::2]))
+                body = self.rfile.read(int(headers[b'CONTENT_LENGTH']))
+                self.wfile.write(fake.handle(body))
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self._server = socketserver.UnixStreamServer(self.socket_path, Handler)
+        threading.Thread(target=self._server.serve_forever, args=(0.05,), daemon=True).start()
+        debug("Fake rtorrent listening on %s" % self.socket_path)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            os.remove(self.socket_path)
+
+
+class FakeMetadataService(metadata.MetadataService):
+    """Serves torrent metadata registered up front, keyed by path."""
+    def __init__(self):
+        self.torrents = {}
+
+    def add(self, path, info_hash, name, total_size):
+        self.torrents[path] = metadata.CachedTorrentInfo(info_hash, name, total_size)
+
+    def torrent_info(self, path):
+        """See base class."""
+        try:
+            return self.torrents[path]
+        except KeyError:
+            raise RuntimeError(f"unknown torrent {path}")
+
+
+class FakeRemoteSync(remotesync.RemoteSyncEngine):
+    """A remote that only remembers what was uploaded to it."""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.REMOTE_PATH = kwargs.get('fake_remote_path', '/remote')
+        self.uploads = []
+
+    def get_remote_path(self, realpath):
+        return os.path.join(self.REMOTE_PATH, os.path.basename(realpath))
+
+    def remote_location(self, remote_path):
+        return 'fake:' + remote_path
+
+    def maybe_create_directory(self, realpath):
+        pass
+
+    def sync_path(self, base_path, base_filename):
+        self.uploads.append(base_path)
+        self.record_upload(base_path)
+
+    def list_remote_files(self, realpath):
+        return []
+
+    def sync_files_from_filelist(self, realpath, filelist_path):
+        self.uploads.append(filelist_path)
+        self.record_filelist_upload(realpath, filelist_path)
@@ -1,13 +1,50 @@
 #! /usr/bin/env python3
 
+import os
 import sys
 
 import driver
 import config
+import daemon
+import events
 import metadata
+import metrics
+import swarm
+import watcher
 
 if __name__ == "__main__":
-    metadata_svc = metadata.LibtorrentMetadataService()
-    cfg = config.Configuration(sys.argv[1:]).configs
+    configuration = config.Configuration(sys.argv[1:])
+    cfg = configuration.configs
+    metadata_cache_file = cfg.get('metadata_cache_file') \
+        or os.path.join(config.DEFAULT_CACHE_DIRECTORY, 'metadata.json')
+    metadata_svc = metadata.CachingMetadataService(
+        metadata.LibtorrentMetadataService(),
+        os.path.expanduser(metadata_cache_file)
+    )
     obj = driver.RtorrentLowSpaceDriver(metadata_svc, cfg)
-    obj.run()
+    swarm_history_file = cfg.get('swarm_history_file') \
+        or os.path.join(config.DEFAULT_CACHE_DIRECTORY, 'swarm.json')
+    obj.swarm = swarm.SwarmHistory(os.path.expanduser(swarm_history_file))
+    obj.profiler.enabled = bool(configuration.arguments.get('profile_rpc'))
+    if configuration.arguments.get('daemon'):
+        driver_daemon = daemon.DriverDaemon(obj, cfg)
+        obj.managed_index = watcher.ManagedTorrentIndex(
+            obj.MANAGED_TORRENTS_DIRECTORY, obj.read_managed_torrent
+        )
+        if obj.managed_index.fileno() is not None:
+            driver_daemon.add_reader(obj.managed_index.fileno(), obj.managed_index.collect)
+        if cfg.get('metrics_port'):
+            metrics.REGISTRY.serve(int(cfg['metrics_port']), cfg.get('metrics_address', '127.0.0.1'))
+        listener = None
+        if cfg.get('event_socket'):
+            listener = events.EventListener(os.path.expanduser(cfg['event_socket']))
+            if events.install_handlers(obj.server, listener.path):
+                driver_daemon.add_reader(listener.fileno(), listener.collect, force_run=events.forces_run)
+        try:
+            driver_daemon.run_forever()
+        finally:
+            if listener is not None:
+                events.remove_handlers(obj.server)
+                listener.close()
+    else:
+        obj.run()
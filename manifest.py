@@ -0,0 +1,76 @@
+import threading
+import time
+
+import persist
+
+
+class RemoteManifest:
+    """Local record of the files uploaded to a remote.
+
+    Files are grouped per remote directory, as listed by
+    RemoteSyncEngine.list_files, and stored with their size and upload
+    time.  Only the directories of large torrents are recorded, until the
+    torrent is purged.  Each directory also remembers when it was last reconciled with a
+    full listing of the remote.  The manifest is saved after every change
+    and may be updated from several upload threads at once.
+    """
+    def __init__(self, path):
+        """Inits RemoteManifest.
+
+        Args:
+            path: Path to the JSON manifest file, string.
+        """
+        self.path = path
+        self._directories = persist.load_json(path, {})
+        self._lock = threading.Lock()
+
+    def add(self, remote_dir, files):
+        """Records uploaded files.
+
+        Args:
+            remote_dir: Remote directory, string.
+            files: Dict of paths relative to remote_dir to sizes in bytes.
+        """
+        now = time.time()
+        with self._lock:
+            directory = self._directories.setdefault(remote_dir, {'reconciled': None, 'files': {}})
+            for path, size in files.items():
+                directory['files'][path] = {'size': size, 'uploaded': now}
+            persist.dump_json(self.path, self._directories)
+
+    def remove(self, remote_dir):
+        """Forgets a directory and the files recorded in it."""
+        with self._lock:
+            if self._directories.pop(remote_dir, None) is not None:
+                persist.dump_json(self.path, self._directories)
+
+    def list(self, remote_dir):
+        """Returns the paths recorded in a remote directory."""
+        with self._lock:
+            return list(self._directories.get(remote_dir, {}).get('files', {}))
+
+    def is_stale(self, remote_dir, max_age):
+        """Tells whether a directory wasn't reconciled within max_age seconds."""
+        with self._lock:
+            reconciled = self._directories.get(remote_dir, {}).get('reconciled')
+        return reconciled is None or time.time() - reconciled >= max_age
+
+    def reconcile(self, remote_dir, paths):
+        """Replaces what is recorded for a directory by a full remote listing.
+
+        Sizes and upload times of files that were already recorded are kept.
+
+        Args:
+            remote_dir: Remote directory, string.
+            paths: Every path relative to remote_dir that exists on the remote.
+        """
+        with self._lock:
+            old_files = self._directories.get(remote_dir, {}).get('files', {})
+            self._directories[remote_dir] = {
+                'reconciled': time.time(),
+                'files': {
+                    path: old_files.get(path, {'size': None, 'uploaded': None})
+                    for path in paths
+                },
+            }
+            persist.dump_json(self.path, self._directories)
@@ -1,5 +1,9 @@
+import os
+
 import libtorrent
 
+import persist
+
 
 class MetadataService:
     """Abstract Class: Interface to a torrent metadata library."""
@@ -11,9 +15,85 @@ class MetadataService:
         """
         raise NotImplementedError("not implemented")
 
+    def commit(self, live_paths):
+        """Persist whatever metadata was gathered so far.
+
+        Services without persistent state ignore this.
+
+        Args:
+            live_paths: Paths that still exist.  Anything else may be
+              forgotten.
+        """
+        pass
+
 
 class LibtorrentMetadataService(MetadataService):
     """libtorrent-rasterbar torrent metadata."""
     def torrent_info(self, path):
         """See base class."""
         return libtorrent.torrent_info(path)
+
+
+class CachedTorrentInfo:
+    """The subset of libtorrent.torrent_info used by the driver."""
+    def __init__(self, info_hash, name, total_size):
+        self._info_hash = info_hash
+        self._name = name
+        self._total_size = total_size
+
+    def info_hash(self):
+        return self._info_hash
+
+    def name(self):
+        return self._name
+
+    def total_size(self):
+        return self._total_size
+
+
+class CachingMetadataService(MetadataService):
+    """Persistent metadata cache in front of another MetadataService.
+
+    Entries are keyed on path and validated against the size and mtime of
+    the file, so a torrent file is only parsed again once it changes.
+    """
+    def __init__(self, backend, cache_path):
+        """Inits CachingMetadataService.
+
+        Args:
+            backend: MetadataService used on cache misses.
+            cache_path: Path to the JSON cache file, string.
+        """
+        self.backend = backend
+        self.cache_path = cache_path
+        self._entries = persist.load_json(cache_path, {})
+        self._dirty = False
+
+    def torrent_info(self, path):
+        """See base class."""
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        entry = self._entries.get(path)
+
+        if entry is None or entry['stamp'] != stamp:
+            t_info = self.backend.torrent_info(path)
+            entry = {
+                'stamp': stamp,
+                'hash': str(t_info.info_hash()).upper(),
+                'name': t_info.name(),
+                'size': t_info.total_size(),
+            }
+            self._entries[path] = entry
+            self._dirty = True
+
+        return CachedTorrentInfo(entry['hash'], entry['name'], entry['size'])
+
+    def commit(self, live_paths):
+        """See base class."""
+        for path in set(self._entries) - set(live_paths):
+            del self._entries[path]
+            self._dirty = True
+
+        if self._dirty:
+            persist.dump_json(self.cache_path, self._entries)
+            self._dirty = False
@@ -0,0 +1,262 @@
+from logging import info
+import contextlib
+import http.server
+import os
+import threading
+import time
+
+import persist
+
+# Prefix of every metric name.
+NAMESPACE = 'rtorrent_low_space_driver'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class Metric:
+    """Base of the metric types: a value per combination of label values."""
+    TYPE = None
+    # Whether the values are totals, which carry over between processes.
+    CUMULATIVE = False
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key):
+        if not key:
+            return ''
+        return '{' + ','.join(
+            '%s="%s"' % (name, _escape(value)) for name, value in zip(self.labelnames, key)
+        ) + '}'
+
+    def samples(self):
+        """Returns (suffix, label string, value) tuples."""
+        with self._lock:
+            return [('', self._labels(key), value) for key, value in sorted(self._values.items())]
+
+    def state(self):
+        """Returns the values as a JSON-serialisable list."""
+        with self._lock:
+            return [[list(key), value] for key, value in sorted(self._values.items())]
+
+    def restore(self, state):
+        """Replaces the values with those returned by state()."""
+        with self._lock:
+            self._values = {tuple(key): self._value(value) for key, value in state}
+
+    def _value(self, value):
+        return value
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.TYPE}",
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {value!r}")
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    """A value that only goes up, such as a number of bytes uploaded."""
+    TYPE = 'counter'
+    CUMULATIVE = True
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down, such as the free space."""
+    TYPE = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Summary(Metric):
+    """Count and sum of observations, such as durations."""
+    TYPE = 'summary'
+    CUMULATIVE = True
+
+    def _value(self, value):
+        return tuple(value)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            count, total = self._values.get(key, (0, 0.0))
+            self._values[key] = (count + 1, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observes the wall time spent in the with block."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            samples = []
+            for key, (count, total) in sorted(self._values.items()):
+                samples.append(('_count', self._labels(key), count))
+                samples.append(('_sum', self._labels(key), total))
+            return samples
+
+
+class Registry:
+    """A set of metrics, rendered together in the Prometheus text format.
+
+    See <https://prometheus.io/docs/instrumenting/exposition_formats/>.
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def _register(self, cls, name, documentation, labelnames):
+        name = f"{NAMESPACE}_{name}"
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames)
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def summary(self, name, documentation, labelnames=()):
+        return self._register(Summary, name, documentation, labelnames)
+
+    def render(self):
+        """Returns every metric in the Prometheus text format."""
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        return ''.join(metric.render() for name, metric in metrics)
+
+    def write_textfile(self, path):
+        """Writes the metrics for node_exporter's textfile collector.
+
+        The file is replaced atomically, so the collector never reads a
+        partial one.  Its name should end in '.prom'.  The totals of the
+        counters and summaries are saved next to it, for restore_textfile().
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        persist.dump_json(self._state_path(path), {
+            name: metric.state() for name, metric in metrics if metric.CUMULATIVE
+        })
+        persist.dump_text(path, self.render())
+
+    def restore_textfile(self, path):
+        """Carries on the counters and summaries from the totals saved by
+        write_textfile() to path.
+
+        Run from cron, every run is a new process, and Prometheus would see
+        counters that start from 0 every time.
+        """
+        state = persist.load_json(self._state_path(path), {})
+        with self._lock:
+            for name, values in state.items():
+                metric = self._metrics.get(name)
+                if metric is not None and metric.CUMULATIVE:
+                    metric.restore(values)
+
+    @staticmethod
+    def _state_path(path):
+        return os.path.splitext(path)[0] + '.json'
+
+    def serve(self, port, address='127.0.0.1'):
+        """Serves the metrics over HTTP from a background thread."""
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.HTTPServer((address, port), Handler)
+        thread = threading.Thread(target=self._server.serve_forever, args=(0.1,), daemon=True)
+        thread.start()
+        info("Serving metrics on http://%s:%d/metrics" % (address, self._server.server_address[1]))
+        return self._server.server_address[1]
+
+    def stop(self):
+        """Stops serving the metrics."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+# The registry every component reports to.
+REGISTRY = Registry()
+
+RPC_DURATION = REGISTRY.summary(
+    'rpc_duration_seconds', "Wall time of rtorrent XML-RPC calls.", ['method'])
+RPC_BYTES = REGISTRY.counter(
+    'rpc_bytes_total', "Bytes exchanged with rtorrent, SCGI framing included.", ['method', 'direction'])
+RPC_ERRORS = REGISTRY.counter(
+    'rpc_errors_total', "rtorrent XML-RPC calls that raised.", ['method'])
+REMOTE_DURATION = REGISTRY.summary(
+    'remote_operation_duration_seconds', "Wall time of remote operations, including retries.",
+    ['engine', 'operation'])
+REMOTE_FAILURES = REGISTRY.counter(
+    'remote_operation_failures_total', "Remote operations that gave up or found the remote unavailable.",
+    ['engine', 'operation'])
+UPLOADED_BYTES = REGISTRY.counter(
+    'uploaded_bytes_total', "Bytes uploaded to the remote.", ['engine'])
+UPLOADED_FILES = REGISTRY.counter(
+    'uploaded_files_total', "Files uploaded to the remote.", ['engine'])
+UPLOAD_QUEUE_DEPTH = REGISTRY.gauge(
+    'upload_queue_depth', "Uploads waiting or running.", ['kind'])
+SPACE_BYTES = REGISTRY.gauge(
+    'space_bytes', "Space limit, space in use and space left to load into, by the last plan.", ['kind'])
+TORRENTS_LOADED = REGISTRY.counter(
+    'torrents_loaded_total', "Managed torrents loaded into rtorrent.")
+TORRENTS_PURGED = REGISTRY.counter(
+    'torrents_purged_total', "Managed torrents uploaded, erased and deleted.")
+FILES_ROTATED = REGISTRY.counter(
+    'files_rotated_total', "Files of large torrents uploaded and truncated.")
+STALLED_TORRENTS = REGISTRY.counter(
+    'stalled_torrents_total', "Managed torrents unloaded for making no progress.", ['action'])
+RUN_DURATION = REGISTRY.summary(
+    'run_duration_seconds', "Wall time of runs of the rotator algorithm.")
+LAST_RUN = REGISTRY.gauge(
+    'last_run_timestamp_seconds', "Unix time the last run finished.")
+
+
+def observe_rpc(method, seconds, exception, request_bytes, response_bytes):
+    """Observer for rtorrent_xmlrpc.SCGIServerProxy."""
+    RPC_DURATION.observe(seconds, method=method)
+    RPC_BYTES.inc(request_bytes, method=method, direction='sent')
+    RPC_BYTES.inc(response_bytes, method=method, direction='received')
+    if exception is not None:
+        RPC_ERRORS.inc(method=method)
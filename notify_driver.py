@@ -0,0 +1,23 @@
+#! /usr/bin/env python3
+
+# Called by rtorrent's event handlers, as installed by events.py, to tell a
+# running driver daemon about a download event.
+#
+# Usage: notify_driver.py SOCKET EVENT INFOHASH
+
+import socket
+import sys
+
+
+def notify(socket_path, event, infohash):
+    """Sends one event datagram.  Returns False if no daemon is listening."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.sendto(f"{event} {infohash}".encode('utf8'), socket_path)
+        except OSError:
+            return False
+    return True
+
+
+if __name__ == "__main__":
+    notify(*sys.argv[1:4])
@@ -0,0 +1,112 @@
+# Strategies for choosing which candidate torrents to load into the space
+# that is available.  Every strategy takes a list of managed torrent dicts
+# and the available space in bytes, and returns the chosen torrents.
+# Candidates arrive in the order of the scheduling policy (see policies.py).
+# The greedy strategy follows it; the optimal one only uses it to choose
+# between torrents of the same size.  Both return the chosen torrents in
+# that order.
+
+
+def greedy(candidates, space):
+    """Picks candidates in the order given, skipping those that don't fit."""
+    this_group = []
+    total_size = 0
+
+    for torrent in candidates:
+        if (total_size + torrent['size']) > space:
+            continue
+        this_group.append(torrent)
+        total_size += torrent['size']
+
+    return this_group
+
+
+def _first_fit(order, sizes, space):
+    chosen, total = [], 0
+    for i in order:
+        if total + sizes[i] <= space:
+            chosen.append(i)
+            total += sizes[i]
+    return total, chosen
+
+
+def _unchain(chain):
+    indices = []
+    while chain is not None:
+        indices.append(chain[0])
+        chain = chain[1]
+    return indices
+
+
+def optimal(candidates, space, node_limit=200000):
+    """Picks the subset of candidates with the largest total size that fits.
+
+    This is a depth-first branch and bound over the candidates, largest
+    first, pruning branches that can't beat the best total found so far.
+    Small candidate sets are solved exactly.  For large ones the search
+    stops after node_limit branches and returns the best subset found,
+    which is never worse than the greedy largest-first or smallest-first
+    packings it starts from.  Among candidates of the same size, those that
+    come first are preferred.
+    """
+    items = sorted(
+        (t for t in candidates if t['size'] <= space),
+        key=lambda t: t['size'], reverse=True
+    )
+    sizes = [t['size'] for t in items]
+    n = len(sizes)
+
+    # suffix[i] is the total size of items[i:]
+    suffix = [0] * (n + 1)
+    for i in range(n - 1, -1, -1):
+        suffix[i] = suffix[i + 1] + sizes[i]
+
+    if suffix[0] <= space:
+        return _in_order(candidates, items)
+
+    best_total, best = _first_fit(range(n), sizes, space)
+    smallest_total, smallest = _first_fit(sorted(range(n), key=lambda i: (sizes[i], i)), sizes, space)
+    if smallest_total > best_total:
+        best_total, best = smallest_total, smallest
+
+    # Chosen indices are kept as (index, parent) chains so that branches
+    # share their common prefix.
+    stack = [(0, 0, None)]
+    nodes = 0
+    while stack and best_total < space and nodes < node_limit:
+        i, total, chain = stack.pop()
+
+        if total + suffix[i] <= space:
+            # Everything that is left fits, which is the best this branch
+            # can do.
+            if total + suffix[i] > best_total:
+                best_total = total + suffix[i]
+                best = _unchain(chain) + list(range(i, n))
+            continue
+
+        if total > best_total:
+            best_total = total
+            best = _unchain(chain)
+
+        if total + suffix[i] <= best_total:
+            continue
+
+        nodes += 1
+        stack.append((i + 1, total, chain))
+        if total + sizes[i] <= space:
+            stack.append((i + 1, total + sizes[i], (i, chain)))
+
+    return _in_order(candidates, [items[i] for i in best])
+
+
+def _in_order(candidates, chosen):
+    chosen_ids = {id(t) for t in chosen}
+    return [t for t in candidates if id(t) in chosen_ids]
+
+
+# smallest_first predates the scheduling policies, and now means greedy.
+PACKING_MODES = {
+    'greedy': greedy,
+    'smallest_first': greedy,
+    'optimal': optimal,
+}
@@ -0,0 +1,50 @@
+import json
+import os
+import tempfile
+
+
+def load_json(path, default):
+    """Reads a JSON document, falling back to a default.
+
+    Args:
+        path: Path to file, string.
+        default: Value returned when the file is missing or unreadable.
+    """
+    try:
+        with open(path, 'r', encoding='utf8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return default
+
+
+def dump_json(path, obj):
+    """Writes a JSON document atomically, see dump_text().
+
+    Args:
+        path: Path to file, string.  Parent directories are created.
+        obj: Any JSON-serialisable object.
+    """
+    dump_text(path, json.dumps(obj))
+
+
+def dump_text(path, text):
+    """Writes a text file atomically.
+
+    The text is written to a temporary file in the same directory and then
+    renamed over the target, so a crash never leaves a truncated file, and
+    readers never see a partial one.
+
+    Args:
+        path: Path to file, string.  Parent directories are created.
+        text: String.
+    """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
@@ -0,0 +1,81 @@
+class PieceLayout:
+    """Maps the files of a torrent onto its pieces.
+
+    Pieces are laid over the concatenation of all files in torrent order, so
+    a piece can straddle the boundary between neighbouring files.
+    Downloading a file means downloading every piece it touches, and
+    truncating a file corrupts every piece it shares with its neighbours.
+    """
+    def __init__(self, files, chunk_size):
+        """Inits PieceLayout.
+
+        Args:
+            files: List of rtorrent_xmlrpc.File records, in torrent order.
+            chunk_size: Piece size of the torrent in bytes.
+        """
+        self.chunk_size = chunk_size
+        # [first, last) piece indices per file, empty for empty files.
+        self.spans = []
+        offset = 0
+        for file_ in files:
+            first = offset // chunk_size
+            if file_.size_bytes == 0:
+                self.spans.append((first, first))
+            else:
+                last = (offset + file_.size_bytes + chunk_size - 1) // chunk_size
+                self.spans.append((first, last))
+            offset += file_.size_bytes
+        self.total_size = offset
+
+    def piece_bytes(self, piece):
+        """Returns the size of a piece, the last one can be short."""
+        return min(self.chunk_size, self.total_size - piece * self.chunk_size)
+
+    def boundary_pieces(self, index):
+        """Returns the first and last piece of a file, the only ones it can share."""
+        first, last = self.spans[index]
+        if first == last:
+            return set()
+        return {first, last - 1}
+
+    def span_bytes(self, index):
+        """Returns the bytes of every piece a file touches."""
+        first, last = self.spans[index]
+        if first == last:
+            return 0
+        return (last - first - 1) * self.chunk_size + self.piece_bytes(last - 1)
+
+    def cost(self, index, covered):
+        """Returns the bytes downloading a file adds, given pieces already covered.
+
+        Args:
+            index: Index of the file.
+            covered: Set of piece indices that will be on disk anyway.  Only
+              boundary pieces need to be in it, as the others can't be shared.
+        """
+        return self.span_bytes(index) - sum(
+            self.piece_bytes(piece) for piece in self.boundary_pieces(index) & covered
+        )
+
+    def neighbours(self, index):
+        """Returns the indices of the other files sharing a piece with a file."""
+        first, last = self.spans[index]
+        if first == last:
+            return []
+
+        # Empty files touch no piece, so walk past them.
+        result = []
+        j = index - 1
+        while j >= 0 and (self._empty(j) or self.spans[j][1] > first):
+            if not self._empty(j):
+                result.append(j)
+            j -= 1
+        j = index + 1
+        while j < len(self.spans) and (self._empty(j) or self.spans[j][0] < last):
+            if not self._empty(j):
+                result.append(j)
+            j += 1
+        return result
+
+    def _empty(self, index):
+        return self.spans[index][0] == self.spans[index][1]
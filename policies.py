@@ -0,0 +1,137 @@
+# Scheduling policies decide the order in which candidate torrents are
+# considered for loading; the packing mode then picks from that order the
+# torrents that fit.  A policy scores every candidate against a
+# ScoringContext, and candidates with lower scores go first.
+
+# Download rate assumed for a candidate when no loaded download is
+# transferring, in bytes per second.
+DEFAULT_RATE = 2**20
+
+
+class ScoringContext:
+    """What a policy knows when scoring candidates.
+
+    Attributes:
+        now: Unix time of the run.
+        downloads: Dict of rtorrent_xmlrpc.Download records keyed by
+          infohash, as in the run's snapshot.  Downloads loaded during the
+          run map to None.
+        aging_period: Seconds of waiting that halve a candidate's score
+          under the fair aging policy.
+        rotation_overhead: Seconds a torrent costs on top of its download
+          time, such as waiting for the next run and uploading.
+        swarm: swarm.SwarmHistory, with what rtorrent reported about
+          candidates that were loaded before, or None.
+    """
+    def __init__(self, now, downloads, aging_period=86400, rotation_overhead=3600, swarm=None):
+        self.now = now
+        self.downloads = downloads
+        self.swarm = swarm
+        self.aging_period = aging_period
+        self.rotation_overhead = rotation_overhead
+        self._mean_rate = None
+
+    def age(self, torrent):
+        """Returns how long a candidate has been waiting, in seconds.
+
+        This is the age of its managed torrent file, as recorded in 'added'.
+        """
+        return max(0.0, self.now - torrent.get('added', self.now))
+
+    def mean_rate(self):
+        """Returns the mean download rate of the incomplete downloads that
+        are transferring, or DEFAULT_RATE when none are."""
+        if self._mean_rate is None:
+            rates = [
+                d.down_rate for d in self.downloads.values()
+                if d is not None and not d.complete and d.down_rate > 0
+            ]
+            self._mean_rate = sum(rates) / len(rates) if rates else DEFAULT_RATE
+        return self._mean_rate
+
+    def expected_rate(self, torrent):
+        """Returns the download rate expected for a candidate, bytes per second.
+
+        That is the rate its swarm gave it the last time it was loaded, or
+        the mean rate for candidates that never were.
+        """
+        if self.swarm is not None:
+            rate = self.swarm.expected_rate(torrent['hash'])
+            if rate is not None:
+                return rate
+        return self.mean_rate()
+
+    def expected_completion(self, torrent):
+        """Returns the seconds a candidate is expected to take to download,
+        infinite when its swarm gave it nothing."""
+        rate = self.expected_rate(torrent)
+        if rate <= 0:
+            return float('inf')
+        return torrent['size'] / rate
+
+
+class Policy:
+    """Base of the scheduling policies."""
+    def score(self, torrent, context):
+        """Returns the sort key of a candidate, lower goes first."""
+        raise NotImplementedError
+
+    def order(self, candidates, context):
+        """Returns the candidates in the order they should be considered."""
+        return sorted(candidates, key=lambda t: self.score(t, context))
+
+
+class SmallestFirst(Policy):
+    """Loads the smallest torrents first, which keeps the most torrents
+    going at once."""
+    def score(self, torrent, context):
+        return torrent['size']
+
+
+class OldestFirst(Policy):
+    """Loads torrents in the order they were added to the managed directory."""
+    def score(self, torrent, context):
+        return -context.age(torrent)
+
+
+class FastestExpectedCompletion(Policy):
+    """Loads the torrents expected to finish downloading soonest first.
+
+    The expected rate of a candidate comes from its swarm history.  For
+    candidates without one it is the same shared estimate, so among them
+    this is smallest first.
+    """
+    def score(self, torrent, context):
+        return context.expected_completion(torrent)
+
+
+class MaxBytesPerHour(Policy):
+    """Loads the torrents that deliver the most bytes per hour of rotation
+    first.
+
+    A torrent delivers its size over its expected download time plus the
+    rotation overhead.  With the same expected rate for every candidate,
+    larger torrents always amortise the overhead better, so among
+    candidates without swarm history this is largest first.  Swarm history
+    sets them apart: a large torrent with a slow swarm loses to a smaller
+    one with a fast swarm.
+    """
+    def score(self, torrent, context):
+        seconds = context.expected_completion(torrent) + context.rotation_overhead
+        return -3600 * torrent['size'] / seconds
+
+
+class FairAging(Policy):
+    """Smallest first, except that waiting shrinks a torrent's score, so
+    large torrents are not starved by a steady supply of small ones."""
+    def score(self, torrent, context):
+        return torrent['size'] / (1 + context.age(torrent) / context.aging_period)
+
+
+SCHEDULING_POLICIES = {
+    'smallest_first': SmallestFirst,
+    'oldest_first': OldestFirst,
+    'fastest_expected_completion': FastestExpectedCompletion,
+    'max_bytes_per_hour': MaxBytesPerHour,
+    'fair_aging': FairAging,
+}
@@ -1,11 +1,29 @@
 from logging import debug, info, error, warning
+import atexit
+import base64
+import concurrent.futures
+import hashlib
+import json
+import secrets
+import socket
 import time
+import urllib.error
+import urllib.parse
+import urllib.request
 import subprocess
+import tempfile
 import pipes
 import os
+import shlex
+import threading
 from abc import ABC, abstractmethod
 from pprint import pformat
 
+import config
+import manifest
+import metrics
+import retry
+
 
 def get_service(**kwargs):
     """Returns the appropriate class that implements RemoteSyncEngine interface."""
@@ -23,13 +41,123 @@ def get_service(**kwargs):
         return Rsync(**kwargs)
     if service == 'rclone':
         return Rclone(**kwargs)
+    if service == 'rclone_rcd':
+        return RcloneRcd(**kwargs)
 
 
 class RemoteSyncEngine(ABC):
-    """Abstract Class: Remote sync interface."""
+    """Abstract Class: Remote sync interface.
+
+    Uploads are recorded in a local manifest, so that list_files only needs
+    to list the remote itself when the manifest is due for reconciliation.
+    """
+    DEFAULT_MANIFEST_RECONCILE_INTERVAL = 24 * 60 * 60
+    DEFAULT_RETRY_BASE_DELAY = 5
+    DEFAULT_RETRY_MAX_DELAY = 300
+    DEFAULT_RETRY_ATTEMPTS = 6
+    DEFAULT_BREAKER_THRESHOLD = 5
+    DEFAULT_BREAKER_RESET = 600
+    # Failures of a single attempt that are worth another try.
+    RETRYABLE = (subprocess.CalledProcessError, OSError)
+
     @abstractmethod
     def __init__(self, **kwargs):
-        pass
+        """Reads the settings shared by all engines.
+
+        Subclasses must call this.
+        """
+        # Number of sync_path transfers run at once by sync_paths.
+        self.upload_workers = int(kwargs.get('upload_workers', 1))
+        manifest_file = kwargs.get('manifest_file') \
+            or os.path.join(config.DEFAULT_CACHE_DIRECTORY, 'remote_manifest.json')
+        manifest_file = os.path.expanduser(manifest_file)
+        self.manifest = manifest.RemoteManifest(manifest_file)
+        self.manifest_reconcile_interval = float(
+            kwargs.get('manifest_reconcile_interval', self.DEFAULT_MANIFEST_RECONCILE_INTERVAL)
+        )
+        # Operations are retried a limited number of times with growing,
+        # jittered waits, and all of them share one circuit breaker, so that
+        # an unreachable remote fails fast instead of blocking the driver.
+        self.retry_policy = retry.RetryPolicy(
+            float(kwargs.get('retry_base_delay', self.DEFAULT_RETRY_BASE_DELAY)),
+            float(kwargs.get('retry_max_delay', self.DEFAULT_RETRY_MAX_DELAY)),
+            int(kwargs.get('retry_attempts', self.DEFAULT_RETRY_ATTEMPTS)),
+        )
+        # Their state is kept next to the manifest, so that a remote that is
+        # down stays backed off over the next runs from cron.
+        state_directory = os.path.dirname(manifest_file)
+        self.circuit_breaker = retry.CircuitBreaker(
+            int(kwargs.get('breaker_threshold', self.DEFAULT_BREAKER_THRESHOLD)),
+            float(kwargs.get('breaker_reset', self.DEFAULT_BREAKER_RESET)),
+            os.path.join(state_directory, 'circuit_breaker.json'),
+        )
+        # Transfers get a single attempt per call, and back off across runs.
+        self.retry_queue = retry.RetryQueue(self.retry_policy, os.path.join(state_directory, 'retry_queue.json'))
+
+    def retry(self, description, func, min_delay=0):
+        """Runs func, retrying failures according to the retry policy.
+
+        Raises:
+            retry.RemoteUnavailable: The attempts ran out, or the circuit
+              breaker of this remote is open.
+        """
+        labels = {'engine': self.__class__.__name__, 'operation': description}
+        with metrics.REMOTE_DURATION.time(**labels):
+            try:
+                return retry.call(func, self.retry_policy, self.circuit_breaker,
+                                  description, self.RETRYABLE, min_delay=min_delay)
+            except retry.RemoteUnavailable:
+                metrics.REMOTE_FAILURES.inc(**labels)
+                raise
+
+    def transfer(self, description, key, func, min_delay=0):
+        """Runs func, a transfer, once, without sleeping to retry it.
+
+        A failed transfer is requeued: the caller leaves the work for a later
+        run, and until the transfer's backoff elapsed, calls with the same
+        key fail fast.
+
+        Raises:
+            retry.RemoteUnavailable: func failed, is backing off, or the
+              circuit breaker of this remote is open.
+        """
+        labels = {'engine': self.__class__.__name__, 'operation': description}
+        with metrics.REMOTE_DURATION.time(**labels):
+            try:
+                return retry.call_once(func, self.retry_queue, key, self.circuit_breaker,
+                                       description, self.RETRYABLE, min_delay=min_delay)
+            except retry.RemoteUnavailable:
+                metrics.REMOTE_FAILURES.inc(**labels)
+                raise
+
+    def run_command(self, cmd, **kwargs):
+        """Runs a command, logging its stderr at debug level if it fails."""
+        try:
+            return subprocess.run(cmd, check=True, capture_output=True, encoding='utf8', **kwargs)
+        except subprocess.CalledProcessError as e:
+            debug(f"{self.__class__.__name__}: {e.stderr.strip()}")  # Debug level prints stderr
+            raise
+
+    def sync_paths(self, jobs):
+        """Copy several objects to remote, with up to upload_workers at once.
+
+        Args:
+            jobs: List of (base_path, base_filename) tuples, as passed to
+              sync_path.
+
+        Yields:
+            (index, exception) tuples in the order transfers finish, where
+              index points into jobs and exception is None on success.  Once
+              the remote is found unavailable, the remaining transfers fail
+              fast with retry.RemoteUnavailable.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.upload_workers) as pool:
+            futures = {
+                pool.submit(self.sync_path, *job): index
+                for index, job in enumerate(jobs)
+            }
+            for future in concurrent.futures.as_completed(futures):
+                yield futures[future], future.exception()
 
     @abstractmethod
     def get_remote_path(self, realpath):
@@ -47,10 +175,75 @@ class RemoteSyncEngine(ABC):
         pass
 
     @abstractmethod
+    def remote_location(self, remote_path):
+        """Returns a remote path qualified with the host or remote name."""
+        pass
+
     def list_files(self, realpath):
-        """List files in the remote."""
+        """List files in the remote, relative to get_remote_path(realpath).
+
+        Served from the manifest, unless the directory is due for
+        reconciliation with a full listing of the remote.
+        """
+        remote_dir = self.remote_location(self.get_remote_path(realpath))
+        if not self.manifest.is_stale(remote_dir, self.manifest_reconcile_interval):
+            debug(f"Listing {remote_dir} from the manifest.")
+            return self.manifest.list(remote_dir)
+
+        remote_files = self.list_remote_files(realpath)
+        self.manifest.reconcile(remote_dir, remote_files)
+        return remote_files
+
+    @abstractmethod
+    def list_remote_files(self, realpath):
+        """List files in the remote itself, bypassing the manifest."""
         pass
 
+    def record_upload(self, base_path):
+        """Counts a file or directory tree uploaded by sync_path.
+
+        sync_path uploads whole torrents, which are purged straight after,
+        so they are kept out of the manifest: list_files is only asked
+        about the files of large torrents.
+        """
+        if os.path.isdir(base_path):
+            sizes = [
+                os.path.getsize(os.path.join(root, name))
+                for root, dirs, names in os.walk(base_path) for name in names
+            ]
+        else:
+            sizes = [os.path.getsize(base_path)]
+        self.count_uploads(sizes)
+
+    def record_filelist_upload(self, realpath, filelist_path):
+        """Adds the files uploaded by sync_files_from_filelist to the manifest."""
+        with open(filelist_path, 'r', encoding='utf8') as f:
+            paths = [line.rstrip('\n') for line in f if line.strip()]
+        self.record_files_upload(realpath, paths)
+
+    def record_files_upload(self, realpath, paths):
+        """Adds files uploaded from realpath, relative paths, to the manifest."""
+        self.add_uploads(
+            self.remote_location(self.get_remote_path(realpath)),
+            {path: os.path.getsize(os.path.join(realpath, path)) for path in paths}
+        )
+
+    def add_uploads(self, remote_dir, files):
+        """Records uploaded files, a dict of path to size, and counts them."""
+        self.manifest.add(remote_dir, files)
+        self.count_uploads(files.values())
+
+    def count_uploads(self, sizes):
+        """Adds uploaded files, given by their sizes, to the metrics."""
+        sizes = list(sizes)
+        metrics.UPLOADED_FILES.inc(len(sizes), engine=self.__class__.__name__)
+        metrics.UPLOADED_BYTES.inc(sum(sizes), engine=self.__class__.__name__)
+
+    def forget(self, realpath):
+        """Drops what the manifest recorded for realpath, once its torrent
+        is purged."""
+        self.manifest.remove(self.remote_location(self.get_remote_path(realpath)))
+
     @abstractmethod
     def sync_files_from_filelist(self, realpath, filelist_path):
         """Copy files from filelist to remote."""
@@ -67,28 +260,40 @@ class Rsync(RemoteSyncEngine):
     # between the timeouts activating on the server and client side.
     RECEIVE_SERVER_TIMEOUT = 15
     LOCAL_WAIT_TIME = RECEIVE_SERVER_TIMEOUT * 10
+    DEFAULT_SSH_CONTROL_PERSIST = 600
 
     def __init__(self, **kwargs):
+        super().__init__(**kwargs)
         self.RSYNC_HOST = kwargs['rsync_host']
         self.RSYNC_PATH = kwargs['rsync_path']
+        self.SSH_CONTROL_PERSIST = int(kwargs.get('ssh_control_persist', self.DEFAULT_SSH_CONTROL_PERSIST))
+        # The socket is named after the host, as short as possible because
+        # unix socket paths are limited to about 100 bytes.
+        host_digest = hashlib.sha1(self.RSYNC_HOST.encode('utf8')).hexdigest()[:16]
+        self.SSH_CONTROL_PATH = os.path.expanduser(
+            kwargs.get('ssh_control_path')
+            or os.path.join(config.DEFAULT_CACHE_DIRECTORY, f"ssh-{host_digest}")
+        )
+        self._ssh_master_lock = threading.Lock()
 
     def get_remote_path(self, realpath):
         return os.path.join(self.RSYNC_PATH, os.path.basename(realpath))
 
+    def remote_location(self, remote_path):
+        return self.RSYNC_HOST + ":" + remote_path
+
     def maybe_create_directory(self, realpath):
         remote_path = self.get_remote_path(realpath)
-        cmd = ["ssh", self.RSYNC_HOST, "mkdir", "-p", pipes.quote(remote_path)]
+        # remote path must be quoted, lest it be interpreted wrongly by the
+        # shell on the server side.
+        cmd = ["ssh"] + self.ssh_options() + [self.RSYNC_HOST, "mkdir", "-p", pipes.quote(remote_path)]
         debug(f"Running command: {' '.join(cmd)}")
-        while True:
-            try:
-                # remote path must be quoted, lest it be interpreted wrongly
-                # by the shell on the server side.
-                subprocess.run(cmd, check=True, capture_output=True, encoding='utf8')
-                return
-            except subprocess.CalledProcessError as e:
-                debug(f"{self.__class__.__name__}: {e.stderr.strip()}")  # Debug level prints stderr
-                error("Failed to read remote, retrying.  exception was %s" % e)
-                time.sleep(60)
+
+        def attempt():
+            self.ensure_ssh_master()
+            self.run_command(cmd)
+
+        self.retry("Creating remote directory", attempt)
 
     def sync_path(self, base_path, base_filename):
         cmd = self.rsync_command() + [
@@ -96,11 +301,12 @@ class Rsync(RemoteSyncEngine):
         ]
 
         info(f"Running command: {pformat(cmd)}")
-        while True:
+
+        def attempt():
+            self.ensure_ssh_master()
             try:
-                subprocess.run(cmd, check=True, capture_output=True, encoding='utf8')
-                return
-            except subprocess.CalledProcessError as e:
+                self.run_command(cmd)
+            except subprocess.CalledProcessError:
                 # This can happen in some strange cases such as when multiple
                 # managed torrents exist that use the same source directory and
                 # finish at the same time.  One previously synced torrent can
@@ -111,31 +317,30 @@ class Rsync(RemoteSyncEngine):
                     error(
                         "Somehow the source path no longer existed.  This should never happen, bailing out of this "
                         "transfer.")
-                    break
-                debug(f"{self.__class__.__name__}: {e.stderr.strip()}")  # Debug level prints stderr
-                error("Failed to sync files to remote, retrying.  exception was '%s'" % e)
-                self.pessimistic_wait()
+                    return
+                raise
+            self.record_upload(base_path)
 
-    def list_files(self, realpath):
+        self.transfer("Syncing files to remote", base_path, attempt, min_delay=self.LOCAL_WAIT_TIME)
+
+    def list_remote_files(self, realpath):
         remote_path = self.get_remote_path(realpath)
-        cmd = ["ssh", self.RSYNC_HOST, "find", pipes.quote(remote_path), "-type", "f", "-print"]
+        # remote path must be quoted, lest it be interpreted wrongly by the
+        # shell on the server side.
+        cmd = ["ssh"] + self.ssh_options() + [self.RSYNC_HOST, "find", pipes.quote(remote_path), "-type", "f", "-print"]
         debug(f"Running command: {' '.join(cmd)}")
-        while True:
-            try:
-                # remote path must be quoted, lest it be interpreted wrongly
-                # by the shell on the server side.
-                output = subprocess.run(cmd, check=True, capture_output=True, encoding='utf8').stdout
-                
-                remote_files = output.rstrip().split("\n")
-
-                return [
-                    x[len(remote_path + "/"):] for x in remote_files
-                    if x.startswith(self.RSYNC_PATH)
-                ]
-            except subprocess.CalledProcessError as e:
-                debug(f"{self.__class__.__name__}: {e.stderr.strip()}")  # Debug level prints stderr
-                error("Failed to read remote, retrying.  exception was '%s'" % e)
-                time.sleep(60)
+
+        def attempt():
+            self.ensure_ssh_master()
+            return self.run_command(cmd).stdout
+
+        output = self.retry("Reading remote", attempt)
+        remote_files = output.rstrip().split("\n")
+
+        return [
+            x[len(remote_path + "/"):] for x in remote_files
+            if x.startswith(self.RSYNC_PATH)
+        ]
 
     def sync_files_from_filelist(self, realpath, filelist_path):
         remote_path = "%s:%s" \
@@ -148,34 +353,75 @@ class Rsync(RemoteSyncEngine):
         ]
 
         info(f"Running command: {' '.join(cmd)}")
-        while True:
-            try:
-                subprocess.run(cmd, check=True, capture_output=True, encoding='utf8')
-                return
-            except subprocess.CalledProcessError as e:
-                debug(f"{self.__class__.__name__}: {e.stderr.strip()}")  # Debug level prints stderr
-                error("failed to sync files to remote, retrying.  exception was '%s'" % e)
-                self.pessimistic_wait()
+
+        def attempt():
+            self.ensure_ssh_master()
+            self.run_command(cmd)
+
+        self.transfer("Syncing files to remote", realpath, attempt, min_delay=self.LOCAL_WAIT_TIME)
+        self.record_filelist_upload(realpath, filelist_path)
 
     def rsync_command(self):
         rst = self.RECEIVE_SERVER_TIMEOUT
-        return [
+        cmd = [
             'rsync', '-a', '--partial', f"--timeout={rst}"
         ]
+        if self.ssh_options():
+            cmd += ['-e', ' '.join(['ssh'] + [shlex.quote(o) for o in self.ssh_options()])]
+        return cmd
+
+    # Every ssh and rsync command shares one ControlMaster connection, so
+    # only the master pays for the TCP and SSH handshakes.  The master exits
+    # by itself once idle for ssh_control_persist seconds.
+    def ssh_options(self):
+        if self.SSH_CONTROL_PERSIST <= 0:
+            return []
+        return [
+            '-o', 'ControlMaster=auto',
+            '-o', f"ControlPath={self.SSH_CONTROL_PATH}",
+            '-o', f"ControlPersist={self.SSH_CONTROL_PERSIST}",
+        ]
 
-    def pessimistic_wait(self):
-        time.sleep(self.LOCAL_WAIT_TIME)
+    def ensure_ssh_master(self):
+        """Starts the ControlMaster, unless a live one already exists."""
+        if self.SSH_CONTROL_PERSIST <= 0:
+            return
+
+        with self._ssh_master_lock:
+            check = ["ssh"] + self.ssh_options() + ["-O", "check", self.RSYNC_HOST]
+            if subprocess.run(check, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+                return
+
+            # A master that died leaves its socket behind, which would make
+            # ssh fail instead of starting a new one.
+            if os.path.exists(self.SSH_CONTROL_PATH):
+                info("Removing stale ssh control socket %s" % self.SSH_CONTROL_PATH)
+                os.remove(self.SSH_CONTROL_PATH)
+
+            os.makedirs(os.path.dirname(self.SSH_CONTROL_PATH), exist_ok=True)
+            cmd = ["ssh"] + self.ssh_options() + ["-M", "-N", "-f", self.RSYNC_HOST]
+            debug(f"Running command: {' '.join(cmd)}")
+            # The master forks into the background holding on to the output
+            # of ssh, so that can't be a pipe: run() would wait for the
+            # master to exit before returning.
+            with tempfile.TemporaryFile(mode='w+') as stderr:
+                result = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                        stderr=stderr)
+                if result.returncode != 0:
+                    # Commands still work without a master, just more slowly.
+                    stderr.seek(0)
+                    warning("Failed to start ssh master connection: %s" % stderr.read().strip())
 
 
 class Rclone(RemoteSyncEngine):
     """Implements the interface for usage with Rclone"""
-    LOCAL_WAIT_TIME = 300
     DEFAULT_FLAGS = {'RCLONE_STATS': '8h',
                      'RCLONE_STATS_ONE_LINE': 'true',
                      'RCLONE_STATS_LOG_LEVEL': 'NOTICE',
                      'RCLONE_LOG_FORMAT': ''}
 
     def __init__(self, **kwargs):
+        super().__init__(**kwargs)
         self.RCLONE_REMOTE = kwargs.pop('rclone_remote')
         self.RCLONE_PATH = kwargs.pop('rclone_path')
 
@@ -203,18 +449,14 @@ class Rclone(RemoteSyncEngine):
     def get_remote_path(self, realpath):
         return os.path.join(self.RCLONE_PATH, os.path.basename(realpath))
 
+    def remote_location(self, remote_path):
+        return self.RCLONE_REMOTE + ":" + remote_path
+
     def maybe_create_directory(self, realpath):
         remote_path = self.get_remote_path(realpath)
         cmd = ["rclone", "mkdir", self.RCLONE_REMOTE + ':' + remote_path]
         debug(f"Running command: {' '.join(cmd)}")
-        while True:
-            try:
-                subprocess.run(cmd, check=True, capture_output=True, encoding='utf8', env=self.env)
-                return
-            except subprocess.CalledProcessError as e:
-                debug(f"{self.__class__.__name__}: {e.stderr.strip()}")  # Debug level prints stderr
-                error("Failed to read remote, retrying.  exception was '%s'" % e)
-                time.sleep(60)
+        self.retry("Creating remote directory", lambda: self.run_command(cmd, env=self.env))
 
     def sync_path(self, base_path, base_filename):
         # Note: The original logic of driver.py calls rsync without a trailing
@@ -230,40 +472,30 @@ class Rclone(RemoteSyncEngine):
 
         cmd = ['rclone', 'copyto', base_path, self.RCLONE_REMOTE + ':' + remote_path]
         info(f"Running command: {pformat(cmd)}")
-        while True:
+
+        def attempt():
             try:
-                subprocess.run(cmd, check=True, capture_output=True, encoding='utf8', env=self.env)
-                return
-            except subprocess.CalledProcessError as e:
-                # This can happen in some strange cases such as when multiple
-                # managed torrents exist that use the same source directory and
-                # finish at the same time.  One previously synced torrent can
-                # cause the source path to be purged, which will also
-                # accidentally purge files from another torrent.  We don't
-                # really care about this edge case at present.
+                self.run_command(cmd, env=self.env)
+            except subprocess.CalledProcessError:
+                # See Rsync.sync_path.
                 if not os.path.exists(base_path):
                     error(
                         "Somehow the source path no longer existed.  This should never happen, bailing out of this "
                         "transfer.")
-                    break
-                debug(f"{self.__class__.__name__}: {e.stderr.strip()}")  # Debug level prints stderr
-                error("Failed to sync files to remote, retrying.  exception was '%s'" % e)
-                self.pessimistic_wait()
+                    return
+                raise
+            self.record_upload(base_path)
 
-    def list_files(self, realpath):
+        self.transfer("Syncing files to remote", base_path, attempt)
+
+    def list_remote_files(self, realpath):
         remote_path = self.get_remote_path(realpath)
         cmd = ['rclone', 'lsf', '-R', self.RCLONE_REMOTE + ':' + remote_path]
         debug(f"Running command: {' '.join(cmd)}")
-        while True:
-            try:
-                output = subprocess.run(cmd, check=True, capture_output=True, encoding='utf8', env=self.env).stdout
-                
-                remote_files = output.rstrip().split("\n")
-                return remote_files
-            except subprocess.CalledProcessError as e:
-                debug(f"{self.__class__.__name__}: {e.stderr.strip()}")  # Debug level prints stderr
-                error("Failed to read remote, retrying.  exception was '%s'" % e)
-                time.sleep(60)
+        output = self.retry("Reading remote", lambda: self.run_command(cmd, env=self.env).stdout)
+
+        remote_files = output.rstrip().split("\n")
+        return remote_files
 
     def sync_files_from_filelist(self, realpath, filelist_path):
         remote_path = "%s:%s" \
@@ -273,14 +505,192 @@ class Rclone(RemoteSyncEngine):
         cmd = ['rclone', 'copyto', "--files-from=" + filelist_path, realpath, remote_path]
 
         info(f"Running command: {' '.join(cmd)}")
-        while True:
-            try:
-                subprocess.run(cmd, check=True, capture_output=True, encoding='utf8', env=self.env)
+        self.transfer("Syncing files to remote", realpath, lambda: self.run_command(cmd, env=self.env))
+        self.record_filelist_upload(realpath, filelist_path)
+
+
+class RcdError(Exception):
+    """An rclone remote control call failed."""
+
+
+class RcloneRcd(Rclone):
+    """Implements the interface through a long-lived 'rclone rcd' process.
+
+    Instead of starting rclone for every operation, a single rcd is started
+    on first use and driven over its HTTP API, so the config is read, the
+    backend authenticated and its directory cache filled only once.  Copies
+    run as asynchronous jobs, several at a time.  Set 'rcd_url' to use an
+    rcd that is already running instead of starting one.
+    See <https://rclone.org/rc/>.
+    """
+    DEFAULT_MAX_JOBS = 4
+    JOB_POLL_INTERVAL = 1
+    RETRYABLE = Rclone.RETRYABLE + (RcdError,)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.rcd_url = kwargs.get('rcd_url')
+        self.rcd_user = kwargs.get('rcd_user') or secrets.token_hex(8)
+        self.rcd_pass = kwargs.get('rcd_pass') or secrets.token_hex(16)
+        self.max_jobs = int(kwargs.get('rcd_max_jobs', self.DEFAULT_MAX_JOBS))
+        self.process = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Starts the rcd, unless it is running or an rcd_url was given."""
+        with self._start_lock:
+            if self.rcd_url is not None and (self.process is None or self.process.poll() is None):
                 return
-            except subprocess.CalledProcessError as e:
-                debug(f"{self.__class__.__name__}: {e.stderr.strip()}")  # Debug level prints stderr
-                error("failed to sync files to remote, retrying.  exception was '%s'" % e)
-                self.pessimistic_wait()
 
-    def pessimistic_wait(self):
-        time.sleep(self.LOCAL_WAIT_TIME)
+            with socket.socket() as s:
+                s.bind(('127.0.0.1', 0))
+                port = s.getsockname()[1]
+            cmd = ['rclone', 'rcd', f"--rc-addr=127.0.0.1:{port}"]
+            info(f"Running command: {' '.join(cmd)}")
+            # The credentials go in the environment, as any local user can
+            # read the command line.
+            env = {**self.env, 'RCLONE_RC_USER': self.rcd_user, 'RCLONE_RC_PASS': self.rcd_pass}
+            if self.process is None:
+                atexit.register(self.stop)
+            self.process = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL)
+            self.rcd_url = f"http://127.0.0.1:{port}/"
+
+            for attempt in range(30):
+                try:
+                    self._call('rc/noop')
+                    return
+                except (RcdError, OSError):
+                    time.sleep(1)
+            raise RcdError("rclone rcd did not come up")
+
+    def stop(self):
+        """Stops the rcd started by start()."""
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+
+    def call(self, method, **params):
+        """Calls an rc method, starting the rcd if needed.  Returns the reply."""
+        self.start()
+        return self._call(method, **params)
+
+    def _call(self, method, **params):
+        request = urllib.request.Request(
+            urllib.parse.urljoin(self.rcd_url, method),
+            data=json.dumps(params).encode('utf8'),
+            headers={'Content-Type': 'application/json'},
+        )
+        credentials = base64.b64encode(f"{self.rcd_user}:{self.rcd_pass}".encode('utf8'))
+        request.add_header('Authorization', 'Basic ' + credentials.decode('ascii'))
+        try:
+            with urllib.request.urlopen(request) as response:
+                return json.load(response)
+        except urllib.error.HTTPError as e:
+            raise RcdError(f"{method}: {e.read().decode('utf8', 'replace').strip()}")
+
+    def start_job(self, method, **params):
+        """Starts an asynchronous rc job and returns its id."""
+        return self.call(method, _async=True, **params)['jobid']
+
+    def wait_for_jobs(self, jobids):
+        """Polls jobs until they all finished.  Returns {jobid: error or None}."""
+        results = {}
+        pending = set(jobids)
+        while pending:
+            for jobid in list(pending):
+                status = self.call('job/status', jobid=jobid)
+                if status['finished']:
+                    pending.discard(jobid)
+                    results[jobid] = None if status['success'] else status.get('error') or 'failed'
+            if pending:
+                time.sleep(self.JOB_POLL_INTERVAL)
+        return results
+
+    def remote_fs(self):
+        return self.RCLONE_REMOTE + ':'
+
+    def maybe_create_directory(self, realpath):
+        remote_path = self.get_remote_path(realpath)
+        self.retry("Creating remote directory",
+                   lambda: self.call('operations/mkdir', fs=self.remote_fs(), remote=remote_path))
+
+    def sync_path(self, base_path, base_filename):
+        remote_path = self.get_remote_path(base_filename)
+        info(f"Copying {base_path} to {self.remote_location(remote_path)}")
+
+        def attempt():
+            try:
+                if os.path.isdir(base_path):
+                    jobid = self.start_job('sync/copy', srcFs=base_path,
+                                           dstFs=self.remote_location(remote_path))
+                else:
+                    jobid = self.start_job('operations/copyfile',
+                                           srcFs=os.path.dirname(base_path),
+                                           srcRemote=os.path.basename(base_path),
+                                           dstFs=self.remote_fs(), dstRemote=remote_path)
+                job_error = self.wait_for_jobs([jobid])[jobid]
+                if job_error is not None:
+                    raise RcdError(job_error)
+            except self.RETRYABLE:
+                # See Rsync.sync_path.
+                if not os.path.exists(base_path):
+                    error(
+                        "Somehow the source path no longer existed.  This should never happen, bailing out of this "
+                        "transfer.")
+                    return
+                raise
+            self.record_upload(base_path)
+
+        self.transfer("Syncing files to remote", base_path, attempt)
+
+    def list_remote_files(self, realpath):
+        remote_path = self.get_remote_path(realpath)
+        reply = self.retry("Reading remote", lambda: self.call(
+            'operations/list', fs=self.remote_fs(), remote=remote_path,
+            opt={'recurse': True, 'filesOnly': True}
+        ))
+        return [item['Path'] for item in reply['list']]
+
+    def sync_files_from_filelist(self, realpath, filelist_path):
+        remote_path = self.get_remote_path(realpath)
+        with open(filelist_path, 'r', encoding='utf8') as f:
+            pending = [line.rstrip('\n') for line in f if line.strip()]
+
+        # Every file is copied by its own job, with up to max_jobs running
+        # at once.  The attempt works through the whole queue.  Only the
+        # files whose jobs succeeded are recorded as uploaded, so whatever
+        # failed, or never got a job, is listed again by the next run.
+        copied = []
+
+        def attempt():
+            running = {}
+            failed = []
+            while pending or running:
+                while pending and len(running) < self.max_jobs:
+                    path = pending[-1]
+                    jobid = self.start_job('operations/copyfile',
+                                           srcFs=realpath, srcRemote=path,
+                                           dstFs=self.remote_fs(),
+                                           dstRemote=os.path.join(remote_path, path))
+                    running[jobid] = pending.pop()
+
+                for jobid in list(running):
+                    status = self.call('job/status', jobid=jobid)
+                    if not status['finished']:
+                        continue
+                    path = running.pop(jobid)
+                    if status['success']:
+                        copied.append(path)
+                    else:
+                        error("failed to sync %s to remote.  error was '%s'" % (path, status.get('error')))
+                        failed.append(path)
+
+                if running:
+                    time.sleep(self.JOB_POLL_INTERVAL)
+            if failed:
+                raise RcdError("%d files failed to copy" % len(failed))
+
+        try:
+            self.transfer("Syncing files to remote", realpath, attempt)
+        finally:
+            self.record_files_upload(realpath, copied)
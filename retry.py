@@ -0,0 +1,250 @@
+from logging import info, error, warning
+import random
+import threading
+import time
+
+import persist
+
+
+class RemoteUnavailable(Exception):
+    """A remote operation gave up, or was refused by an open circuit.
+
+    The work is not lost: callers leave it where it is, and the next run
+    picks it up again.
+    """
+
+
+class RetryPolicy(object):
+    """Exponential backoff with full jitter and a budget of attempts.
+
+    The n-th retry waits a random time between min_delay and
+    base_delay * 2**n, capped at max_delay.  The randomness keeps concurrent
+    transfers that failed together from retrying in lockstep.
+    """
+    def __init__(self, base_delay, max_delay, max_attempts, rng=random.random):
+        """Inits RetryPolicy.
+
+        Args:
+            base_delay: Upper bound of the first wait, in seconds.
+            max_delay: Upper bound of any wait, in seconds.
+            max_attempts: Number of tries before giving up, including the
+              first one.
+            rng: Returns a float in [0, 1), for tests.
+        """
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max(1, max_attempts)
+        self.rng = rng
+
+    def delay(self, attempt, min_delay=0):
+        """Returns the time to wait after the given failed attempt, from 0."""
+        ceiling = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return max(min_delay, ceiling * self.rng())
+
+
+class CircuitBreaker(object):
+    """Stops calling a remote that keeps failing.
+
+    After 'threshold' failed attempts in a row the circuit opens, and every
+    call fails straight away for 'reset_timeout' seconds.  After that, calls
+    are let through again; a single failure reopens it, a success closes it.
+    With a path, the state is persisted so that it carries over to the next
+    run of the driver from cron.
+    """
+    def __init__(self, threshold, reset_timeout, path=None, clock=time.time):
+        """Inits CircuitBreaker.
+
+        Args:
+            threshold: Failures in a row that open the circuit.
+            reset_timeout: Seconds the circuit stays open.
+            path: Path to the JSON file to persist to, string, or None to
+              keep the state in memory only.
+            clock: Returns the Unix time, for tests.
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.path = path
+        self.clock = clock
+        state = persist.load_json(path, {}) if path else {}
+        self.failures = state.get('failures', 0)
+        self.opened_at = state.get('opened_at')
+        self._lock = threading.Lock()
+
+    def _save(self):
+        if self.path:
+            persist.dump_json(self.path, {'failures': self.failures, 'opened_at': self.opened_at})
+
+    def allow(self):
+        """Returns whether calls may go through right now."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            return self.clock() - self.opened_at >= self.reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                info("Remote is reachable again, closing the circuit.")
+            changed = self.failures or self.opened_at is not None
+            self.failures = 0
+            self.opened_at = None
+            if changed:
+                self._save()
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.threshold:
+                if self.opened_at is None:
+                    warning("Remote failed %d times in a row, not calling it for %d seconds."
+                            % (self.failures, self.reset_timeout))
+                self.opened_at = self.clock()
+            self._save()
+
+
+class RetryQueue(object):
+    """Failed transfers, and when each may be attempted again.
+
+    Transfers are not retried by sleeping in the calling thread.  A failed
+    one is handed back to its caller, which leaves the work where it is for
+    a later run, and ready() holds it back until its backoff elapsed.  The
+    backoff follows the RetryPolicy, counting failures across runs, which
+    with a path includes runs of the driver from cron.
+    """
+    def __init__(self, policy, path=None, clock=time.time):
+        """Inits RetryQueue.
+
+        Args:
+            policy: The RetryPolicy giving the backoff.
+            path: Path to the JSON file to persist to, string, or None to
+              keep the queue in memory only.
+            clock: Returns the Unix time, for tests.
+        """
+        self.policy = policy
+        self.path = path
+        self.clock = clock
+        # Key to (failures, Unix time of the next attempt).
+        self._items = {
+            key: tuple(item) for key, item in (persist.load_json(path, {}) if path else {}).items()
+        }
+        self._lock = threading.Lock()
+
+    def _save(self):
+        if self.path:
+            persist.dump_json(self.path, self._items)
+
+    def ready(self, key):
+        """Returns whether the transfer may be attempted now."""
+        with self._lock:
+            failures, not_before = self._items.get(key, (0, 0))
+            return self.clock() >= not_before
+
+    def ready_keys(self):
+        """Returns the sorted keys of failed transfers that may be attempted now."""
+        with self._lock:
+            now = self.clock()
+            return sorted(key for key, (failures, not_before) in self._items.items() if now >= not_before)
+
+    def failures(self, key):
+        with self._lock:
+            return self._items.get(key, (0, 0))[0]
+
+    def record_failure(self, key, min_delay=0):
+        """Backs the transfer off.  Returns the delay, in seconds."""
+        with self._lock:
+            failures = self._items.get(key, (0, 0))[0]
+            delay = self.policy.delay(failures, min_delay)
+            self._items[key] = (failures + 1, self.clock() + delay)
+            self._save()
+            return delay
+
+    def record_success(self, key):
+        with self._lock:
+            if self._items.pop(key, None) is not None:
+                self._save()
+
+
+def call(func, policy, breaker, description, retryable, min_delay=0, sleep=time.sleep):
+    """Calls func until it succeeds, the attempts run out or the circuit opens.
+
+    Args:
+        func: Callable without arguments, doing one attempt.
+        policy: A RetryPolicy.
+        breaker: The CircuitBreaker of the remote func talks to.
+        description: What func does, for the log.
+        retryable: Exception class, or tuple of them, worth retrying.
+        min_delay: Shortest wait between two attempts, in seconds.
+        sleep: Replaces time.sleep, for tests.
+
+    Returns:
+        Whatever func returned.
+
+    Raises:
+        RemoteUnavailable: func kept failing, or the circuit is open.
+    """
+    last_exception = None
+    for attempt in range(policy.max_attempts):
+        if not breaker.allow():
+            raise RemoteUnavailable(f"{description}: remote is unavailable, circuit open") \
+                from last_exception
+        try:
+            result = func()
+        except retryable as e:
+            last_exception = e
+            breaker.record_failure()
+            if not breaker.allow():
+                # Waiting for another attempt would only end in this.
+                error("%s failed, and the circuit opened.  exception was '%s'" % (description, e))
+                raise RemoteUnavailable(f"{description}: remote is unavailable, circuit open") from e
+            if attempt + 1 == policy.max_attempts:
+                error("%s failed, giving up for now.  exception was '%s'" % (description, e))
+                break
+            delay = policy.delay(attempt, min_delay)
+            error("%s failed, retrying in %.0f seconds.  exception was '%s'" % (description, delay, e))
+            sleep(delay)
+        else:
+            breaker.record_success()
+            return result
+
+    raise RemoteUnavailable(f"{description}: gave up after {policy.max_attempts} attempts") \
+        from last_exception
+
+
+def call_once(func, queue, key, breaker, description, retryable, min_delay=0):
+    """Makes a single attempt at a transfer, unless it is still backing off.
+
+    Args:
+        func: Callable without arguments, doing the transfer.
+        queue: The RetryQueue of the remote.
+        key: Identifies the transfer across runs, such as its local path.
+        breaker: The CircuitBreaker of the remote func talks to.
+        description: What func does, for the log.
+        retryable: Exception class, or tuple of them, worth retrying.
+        min_delay: Shortest wait before the next attempt, in seconds.
+
+    Returns:
+        Whatever func returned.
+
+    Raises:
+        RemoteUnavailable: func failed, is backing off from an earlier
+          failure, or the circuit is open.
+    """
+    if not queue.ready(key):
+        raise RemoteUnavailable(f"{description}: {key} is backing off after failing")
+    if not breaker.allow():
+        raise RemoteUnavailable(f"{description}: remote is unavailable, circuit open")
+    try:
+        result = func()
+    except retryable as e:
+        breaker.record_failure()
+        delay = queue.record_failure(key, min_delay)
+        failures = queue.failures(key)
+        if failures >= queue.policy.max_attempts:
+            error("%s failed %d times in a row, trying again in %.0f seconds.  exception was '%s'"
+                  % (description, failures, delay, e))
+        else:
+            warning("%s failed, trying again in %.0f seconds.  exception was '%s'" % (description, delay, e))
+        raise RemoteUnavailable(f"{description}: {key} failed, requeued") from e
+    breaker.record_success()
+    queue.record_success(key)
+    return result
@@ -0,0 +1,67 @@
+import collections
+import contextlib
+import threading
+
+CallStats = collections.namedtuple(
+    'CallStats', ['phase', 'method', 'calls', 'seconds', 'request_bytes', 'response_bytes']
+)
+
+
+class RpcProfiler:
+    """Accounts rtorrent calls to the driver phase that made them.
+
+    The driver marks its phases with phase(), and reports every call with
+    record().  While disabled, record() returns straight away, so the
+    profiler can stay wired in permanently.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Attributes the calls made by this thread in the with block to name."""
+        previous = getattr(self._local, 'phase', None)
+        self._local.phase = name
+        try:
+            yield
+        finally:
+            self._local.phase = previous
+
+    def record(self, method, seconds, request_bytes, response_bytes):
+        """Adds one call to the profile."""
+        if not self.enabled:
+            return
+        key = (getattr(self._local, 'phase', None) or 'other', method)
+        with self._lock:
+            calls, total, sent, received = self._stats.get(key, (0, 0.0, 0, 0))
+            self._stats[key] = (calls + 1, total + seconds,
+                                sent + request_bytes, received + response_bytes)
+
+    def summary(self):
+        """Returns a list of CallStats, the most expensive first."""
+        with self._lock:
+            stats = [CallStats(phase, method, *values) for (phase, method), values in self._stats.items()]
+        return sorted(stats, key=lambda s: (-s.seconds, -s.calls))
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def report(self):
+        """Returns the summary as a table, for the log."""
+        stats = self.summary()
+        lines = [
+            "RPC profile: %d calls, %.3f s, %d bytes sent, %d bytes received" % (
+                sum(s.calls for s in stats), sum(s.seconds for s in stats),
+                sum(s.request_bytes for s in stats), sum(s.response_bytes for s in stats)),
+            "%-16s %-24s %7s %9s %9s %11s %11s" % (
+                'phase', 'method', 'calls', 'total s', 'mean ms', 'sent', 'received'),
+        ]
+        for s in stats:
+            lines.append("%-16s %-24s %7d %9.3f %9.2f %11d %11d" % (
+                s.phase, s.method, s.calls, s.seconds, 1000 * s.seconds / s.calls,
+                s.request_bytes, s.response_bytes))
+        return '\n'.join(lines)
@@ -0,0 +1,134 @@
+# rtorrent_aioxmlrpc
+#
+# asyncio companion to rtorrent_xmlrpc.  Requests go straight to rtorrent
+# over SCGI, one connection per request as rtorrent requires, with a bounded
+# number of requests in flight at any time.
+#
+# Usage: server = AsyncSCGIServerProxy('scgi:///path/to/scgi.sock')
+#        ratios = await asyncio.gather(*[server.d.ratio(h) for h in hashes])
+
+import asyncio
+import urllib.parse
+import xmlrpc.client
+
+import rtorrent_xmlrpc
+
+
+class _AsyncMethod:
+    # Same dotted-name dispatch as xmlrpc.client._Method, except that
+    # calling the method returns a coroutine.
+    def __init__(self, send, name):
+        self.__send = send
+        self.__name = name
+
+    def __getattr__(self, name):
+        return _AsyncMethod(self.__send, "%s.%s" % (self.__name, name))
+
+    def __call__(self, *args):
+        return self.__send(self.__name, args)
+
+
+class AsyncSCGIServerProxy:
+    """asyncio XML-RPC client for rtorrent's SCGI socket.
+
+    Remote methods are called as with SCGIServerProxy, e.g.
+    await server.d.ratio(infohash), and independent calls can be awaited
+    concurrently.  At most max_in_flight requests are open at once.
+    """
+    RECV_BUFFER_SIZE = rtorrent_xmlrpc.SCGITransport.RECV_BUFFER_SIZE
+
+    def __init__(self, uri, max_in_flight=8, encoding=None, allow_none=False,
+                 use_datetime=False):
+        url_parsed = urllib.parse.urlparse(uri)
+        if url_parsed.scheme not in ('scgi'):
+            raise IOError('unsupported XML-RPC protocol')
+        self.__host, self.__handler = url_parsed.netloc, url_parsed.path
+        if not self.__handler:
+            self.__handler = '/'
+
+        self.__max_in_flight = max_in_flight
+        # Created on first use, so that it binds to the running loop.
+        self.__semaphore = None
+        self.__encoding = encoding
+        self.__allow_none = allow_none
+        self.__use_datetime = use_datetime
+
+    async def __connect(self):
+        if self.__host:
+            hostname, _, port = self.__host.rpartition(':')
+            return await asyncio.open_connection(hostname, int(port))
+        return await asyncio.open_unix_connection(self.__handler)
+
+    async def __request(self, methodname, params):
+        request = xmlrpc.client.dumps(params, methodname, encoding=self.__encoding,
+                                      allow_none=self.__allow_none)
+
+        if self.__semaphore is None:
+            self.__semaphore = asyncio.Semaphore(self.__max_in_flight)
+
+        async with self.__semaphore:
+            reader, writer = await self.__connect()
+            try:
+                writer.write(rtorrent_xmlrpc.encode_scgi_request(request))
+                await writer.drain()
+                response = await self.__read_response(reader)
+            finally:
+                writer.close()
+
+        if len(response) == 1:
+            response = response[0]
+
+        return response
+
+    async def __read_response(self, reader):
+        p, u = xmlrpc.client.getparser(use_datetime=self.__use_datetime)
+
+        response_header = b''
+        in_body = False
+        while True:
+            data = await reader.read(self.RECV_BUFFER_SIZE)
+            if not data:
+                break
+
+            if not in_body:
+                response_header += data
+                match = rtorrent_xmlrpc.SCGITransport.HEADER_END.search(response_header)
+                if match is None:
+                    continue
+                data = response_header[match.end():]
+                in_body = True
+
+            p.feed(data)
+
+        p.close()
+
+        return u.close()
+
+    async def download_records(self, view='main'):
+        """See SCGIServerProxy.download_records."""
+        multicall = getattr(self, 'd.multicall2')
+        rows = await multicall('', view, *[command for name, command, convert in rtorrent_xmlrpc.DOWNLOAD_FIELDS])
+        return [rtorrent_xmlrpc.download_from_row(row) for row in rows]
+
+    async def download_states(self, view='main'):
+        """See SCGIServerProxy.download_states."""
+        multicall = getattr(self, 'd.multicall2')
+        rows = await multicall('', view, *[command for name, command, convert in rtorrent_xmlrpc.STATE_FIELDS])
+        return [rtorrent_xmlrpc.state_from_row(row) for row in rows]
+
+    async def file_records(self, infohash):
+        """See SCGIServerProxy.file_records."""
+        rows = await self.f.multicall(infohash, '', *[command for name, command, convert in rtorrent_xmlrpc.FILE_FIELDS])
+        return rtorrent_xmlrpc.files_from_rows(infohash, rows)
+
+    def __repr__(self):
+        return (
+            "<AsyncSCGIServerProxy for %s%s>" %
+            (self.__host, self.__handler)
+            )
+
+    __str__ = __repr__
+
+    def __getattr__(self, name):
+        # magic method dispatcher
+        return _AsyncMethod(self.__request, name)
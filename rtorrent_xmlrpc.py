@@ -78,83 +78,203 @@
 # ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE
 # OF THIS SOFTWARE.
 
+import collections
 import re
 import socket
+import threading
+import time
 import urllib.parse
 import xmlrpc
 import xmlrpc.client
 
+# Per-download fields fetched in bulk by SCGIServerProxy.download_records(),
+# as (record field, rtorrent command, conversion) triples.  rtorrent reports
+# the ratio multiplied by 1000 and booleans as integers.
+DOWNLOAD_FIELDS = (
+    ('hash', 'd.hash=', str),
+    ('complete', 'd.complete=', bool),
+    ('ratio', 'd.ratio=', lambda ratio: ratio / 1000.0),
+    ('base_path', 'd.base_path=', str),
+    ('base_filename', 'd.base_filename=', str),
+    ('directory', 'd.directory=', str),
+    ('size_bytes', 'd.size_bytes=', int),
+    ('completed_bytes', 'd.completed_bytes=', int),
+    ('size_files', 'd.size_files=', int),
+    ('chunk_size', 'd.chunk_size=', int),
+    ('is_active', 'd.is_active=', bool),
+    ('down_rate', 'd.down.rate=', int),
+    ('peers_complete', 'd.peers_complete=', int),
+    ('peers_accounted', 'd.peers_accounted=', int),
+    ('is_hash_checking', 'd.is_hash_checking=', bool),
+)
+
+Download = collections.namedtuple(
+    'Download', [name for name, command, convert in DOWNLOAD_FIELDS]
+)
+
+# The few fields fetched by SCGIServerProxy.download_states(), for cheap
+# polling.
+STATE_FIELDS = DOWNLOAD_FIELDS[:3]
+
+DownloadState = collections.namedtuple(
+    'DownloadState', [name for name, command, convert in STATE_FIELDS]
+)
+
+# Per-file fields fetched in bulk by SCGIServerProxy.file_records().  The
+# record also carries the file's index and its "<hash>:f<index>" target id.
+FILE_FIELDS = (
+    ('path', 'f.path=', str),
+    ('size_bytes', 'f.size_bytes=', int),
+    ('completed_chunks', 'f.completed_chunks=', int),
+    ('size_chunks', 'f.size_chunks=', int),
+    ('priority', 'f.priority=', int),
+)
+
+File = collections.namedtuple(
+    'File', ['index', 'id'] + [name for name, command, convert in FILE_FIELDS]
+)
+
+
+def download_from_row(row):
+    """Converts one d.multicall2 row requested with DOWNLOAD_FIELDS."""
+    return Download(*[convert(value) for (name, command, convert), value in zip(DOWNLOAD_FIELDS, row)])
+
+
+def state_from_row(row):
+    """Converts one d.multicall2 row requested with STATE_FIELDS."""
+    return DownloadState(*[convert(value) for (name, command, convert), value in zip(STATE_FIELDS, row)])
+
+
+def files_from_rows(infohash, rows):
+    """Converts the f.multicall rows of a download requested with FILE_FIELDS."""
+    return [
+        File(index, "%s:f%d" % (infohash, index),
+             *[convert(value) for (name, command, convert), value in zip(FILE_FIELDS, row)])
+        for index, row in enumerate(rows)
+    ]
+
+
+def encode_scgi_request(request_body):
+    """Wraps an XML-RPC request body, a string, in SCGI framing."""
+    # Make sure we use the byte-length, not the unicode-string-length
+    encoded_version = bytes(request_body, 'UTF-8')
+
+    # Add SCGI headers to the request.
+    headers = {'CONTENT_LENGTH': str(len(encoded_version)), 'SCGI': '1'}
+
+    # NB: For some reason these headers need to be in this exact order,
+    # hence the below call to sorted() -- which sorts by key.
+    # Not sure exactly why, can be a bug in either this code or rtorrent
+    # xmlrpc handling code.  But this bug only occurs in python 3 for
+    # some reason that must be bizarre.
+    header = '\x00'.join(
+        ('%s\x00%s' % item for item in sorted(headers.items()))
+    ) + '\x00'
+    header = '%d:%s' % (len(header), header)
+    return bytes('%s,' % header, 'UTF-8') + encoded_version
+
+
 class SCGITransport(xmlrpc.client.Transport):
+    # rtorrent answers exactly one request per SCGI connection and closes it
+    # afterwards, as the SCGI protocol has no keep-alive.  Connections can't
+    # be pooled, so instead we keep the per-call overhead down: resolved
+    # addresses are cached, and responses are streamed into the XML parser
+    # through a buffer allocated once per thread, rather than accumulated in
+    # memory.
+    RECV_BUFFER_SIZE = 256 * 1024
+
+    # End of the SCGI response headers, "\r\n\r\n" in practice.
+    HEADER_END = re.compile(rb'\n\s*?\n')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._addresses = {}
+        # Sizes of the last exchange, see last_exchange(), and the receive
+        # buffer, per thread.
+        self._exchange = threading.local()
+
     def single_request(self, host, handler, request_body, verbose=0):
-        # Make sure we use the byte-length, not the unicode-string-length
-        encoded_version = bytes(request_body, 'UTF-8')
-
-        # Add SCGI headers to the request.
-        headers = {'CONTENT_LENGTH': str(len(encoded_version)), 'SCGI': '1'}
-
-        # NB: For some reason these headers need to be in this exact order,
-        # hence the below call to sorted() -- which sorts by key.
-        # Not sure exactly why, can be a bug in either this code or rtorrent
-        # xmlrpc handling code.  But this bug only occurs in python 3 for
-        # some reason that must be bizarre.
-        header = '\x00'.join(
-            ('%s\x00%s' % item for item in sorted(headers.items()))
-        ) + '\x00'
-        header = '%d:%s' % (len(header), header)
-        request_body = '%s,%s' % (header, request_body)
-        
+        request_body = encode_scgi_request(request_body)
+        self._exchange.request_bytes = len(request_body)
+        self._exchange.response_bytes = 0
+
         sock = None
         
         try:
-            if host:
-                host, port = urllib.splitport(host)
-                addrinfo = socket.getaddrinfo(host, port, socket.AF_INET,
-                                              socket.SOCK_STREAM)
-                sock = socket.socket(*addrinfo[0][:3])
-                sock.connect(addrinfo[0][4])
-            else:
-                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-                sock.connect(handler)
-            
+            sock = self.connect(host, handler)
             self.verbose = verbose
 
-
-            sock.send(bytes(request_body, 'UTF-8'))
+            sock.sendall(request_body)
             return self.parse_response(sock)
         finally:
             if sock:
                 sock.close()
+
+    def connect(self, host, handler):
+        if not host:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(handler)
+            return sock
+
+        addrinfo = self._addresses.get(host)
+        if addrinfo is None:
+            hostname, _, port = host.rpartition(':')
+            addrinfo = socket.getaddrinfo(hostname, int(port), socket.AF_INET,
+                                          socket.SOCK_STREAM)[0]
+            self._addresses[host] = addrinfo
+        sock = socket.socket(*addrinfo[:3])
+        sock.connect(addrinfo[4])
+        return sock
     
     def parse_response(self, response_sock):
         p, u = self.getparser()
-        
-        response_body = b''
+
+        buffer = getattr(self._exchange, 'buffer', None)
+        if buffer is None:
+            buffer = self._exchange.buffer = bytearray(self.RECV_BUFFER_SIZE)
+        view = memoryview(buffer)
+        # SCGI headers are accumulated until the blank line that ends them,
+        # everything after that is fed to the parser as it arrives.
+        response_header = b''
+        in_body = False
+        response_bytes = 0
         while True:
-            data = response_sock.recv(1024)
-            if data == b'':
+            received = response_sock.recv_into(buffer)
+            if received == 0:
                 break
-            response_body += data
-        
-        response_body = response_body.decode('UTF-8')
-
-        # Remove SCGI headers from the response.
-#        print(repr(response_body))
-        response_header, response_body = re.split(
-            r'\n\s*?\n', response_body, maxsplit=1
-        )
-        if self.verbose:
-            print('body:', repr(response_body))
-        
-        
-        p.feed(response_body)
+            response_bytes += received
+
+            data = view[:received]
+            if not in_body:
+                response_header += data
+                match = self.HEADER_END.search(response_header)
+                if match is None:
+                    continue
+                data = response_header[match.end():]
+                in_body = True
+
+            if self.verbose:
+                print('body:', repr(bytes(data)))
+            p.feed(data)
+
         p.close()
+        self._exchange.response_bytes = response_bytes
         
         return u.close()
 
+    def last_exchange(self):
+        """Returns the request and response sizes in bytes, SCGI framing
+        included, of the last request made by the calling thread."""
+        return (getattr(self._exchange, 'request_bytes', 0),
+                getattr(self._exchange, 'response_bytes', 0))
+
 
 class SCGIServerProxy(xmlrpc.client.ServerProxy):
+    # If given, observer is called after every call with the method name, the
+    # wall time in seconds, the exception raised or None, and the request and
+    # response sizes in bytes as far as the transport can tell.
     def __init__(self, uri, transport=None, encoding=None, verbose=False,
-                 allow_none=False, use_datetime=False):
+                 allow_none=False, use_datetime=False, observer=None):
         url_parsed = urllib.parse.urlparse(uri)
         if url_parsed.scheme not in ('scgi'):
             raise IOError('unsupported XML-RPC protocol')
@@ -169,6 +289,7 @@ class SCGIServerProxy(xmlrpc.client.ServerProxy):
         self.__encoding = encoding
         self.__verbose = verbose
         self.__allow_none = allow_none
+        self.__observer = observer
  
     def __close(self):
         self.__transport.close()
@@ -179,18 +300,33 @@ class SCGIServerProxy(xmlrpc.client.ServerProxy):
         request = xmlrpc.client.dumps(params, methodname, encoding=self.__encoding,
                                   allow_none=self.__allow_none)
     
-        response = self.__transport.request(
-            self.__host,
-            self.__handler,
-            request,
-            verbose=self.__verbose
-            )
+        observer = self.__observer
+        if observer is not None:
+            start = time.monotonic()
+        try:
+            response = self.__transport.request(
+                self.__host,
+                self.__handler,
+                request,
+                verbose=self.__verbose
+                )
+        except Exception as e:
+            if observer is not None:
+                self.__observe(methodname, time.monotonic() - start, e)
+            raise
+        if observer is not None:
+            self.__observe(methodname, time.monotonic() - start, None)
     
         if len(response) == 1:
             response = response[0]
     
         return response
     
+    def __observe(self, methodname, seconds, exception):
+        last_exchange = getattr(self.__transport, 'last_exchange', None)
+        request_bytes, response_bytes = last_exchange() if last_exchange else (0, 0)
+        self.__observer(methodname, seconds, exception, request_bytes, response_bytes)
+
     def __repr__(self):
         return (
             "<SCGIServerProxy for %s%s>" %
@@ -199,6 +335,34 @@ class SCGIServerProxy(xmlrpc.client.ServerProxy):
     
     __str__ = __repr__
     
+    def download_records(self, view='main'):
+        """Fetch every download in a view with a single d.multicall2 call.
+
+        Returns a list of Download records, in the order rtorrent lists them.
+        """
+        multicall = getattr(self, 'd.multicall2')
+        rows = multicall('', view, *[command for name, command, convert in DOWNLOAD_FIELDS])
+        return [download_from_row(row) for row in rows]
+
+    def download_states(self, view='main'):
+        """Fetch the hash, completeness and ratio of every download in a
+        view with a single d.multicall2 call.
+
+        Returns a list of DownloadState records, in the order rtorrent lists
+        them.
+        """
+        multicall = getattr(self, 'd.multicall2')
+        rows = multicall('', view, *[command for name, command, convert in STATE_FIELDS])
+        return [state_from_row(row) for row in rows]
+
+    def file_records(self, infohash):
+        """Fetch every file of a download with a single f.multicall call.
+
+        Returns a list of File records, in torrent order.
+        """
+        rows = self.f.multicall(infohash, '', *[command for name, command, convert in FILE_FIELDS])
+        return files_from_rows(infohash, rows)
+
     def __getattr__(self, name):
         # magic method dispatcher
         return xmlrpc.client._Method(self.__request, name)
@@ -0,0 +1,404 @@
+#! /usr/bin/env python3
+
+# Discrete-event simulation of the rotator, for choosing space_limit,
+# required_ratio and the other planning settings offline.  The driver's own
+# planning code decides what to load and which files of a large torrent to
+# download, while downloads, seeding and uploads are simulated from a
+# synthetic or recorded workload.
+#
+# Usage: simulator.py --space-limit BYTES [--required-ratio R] [--days D]
+#                     [--workload FILE | --torrents N] [--record FILE]
+
+import argparse
+import collections
+import heapq
+import json
+import logging
+import os
+import random
+
+import driver
+import metadata
+import pieces
+import rtorrent_xmlrpc
+
+MiB = 2**20
+GiB = 2**30
+DAY = 24 * 60 * 60
+
+WorkloadTorrent = collections.namedtuple(
+    'WorkloadTorrent',
+    ['name', 'arrival', 'file_sizes', 'download_rate', 'upload_rate', 'chunk_size']
+)
+WorkloadTorrent.__doc__ = """One torrent of a workload.
+
+Sizes are in bytes, rates in bytes per second and the arrival, when the
+torrent file shows up in the managed directory, in seconds from the start.
+The upload rate is what the swarm takes from us while seeding, so the ratio
+grows by upload_rate / size per second.
+"""
+
+Report = collections.namedtuple('Report', [
+    'days', 'delivered_torrents', 'delivered_bytes', 'bytes_per_day',
+    'mean_disk_utilisation', 'peak_disk_utilisation',
+    'mean_queue_latency', 'p95_queue_latency', 'mean_delivery_latency',
+    'waiting_torrents', 'undeliverable_torrents',
+])
+
+
+def synthetic_workload(torrents, seed=0, arrivals_per_day=24, median_size=2 * GiB, size_sigma=1.0,
+                       mean_file_size=512 * MiB, download_rate=(1 * MiB, 10 * MiB),
+                       upload_rate=(50 * 1024, 2 * MiB), chunk_size=4 * MiB):
+    """Returns a list of random WorkloadTorrents.
+
+    Arrivals are a Poisson process, sizes are log-normal around median_size,
+    and rates uniform within the given (low, high) bounds.
+    """
+    rng = random.Random(seed)
+    workload = []
+    arrival = 0.0
+    for i in range(torrents):
+        arrival += rng.expovariate(arrivals_per_day / DAY)
+        size = max(1, int(rng.lognormvariate(0, size_sigma) * median_size))
+        files = max(1, round(size / mean_file_size))
+        cuts = sorted(rng.randrange(size) for _ in range(files - 1))
+        file_sizes = [b - a for a, b in zip([0] + cuts, cuts + [size])]
+        workload.append(WorkloadTorrent(
+            'torrent-%05d' % i, arrival, file_sizes,
+            rng.uniform(*download_rate), rng.uniform(*upload_rate), chunk_size,
+        ))
+    return workload
+
+
+def load_workload(path):
+    """Reads a workload recorded with save_workload()."""
+    with open(path, 'r', encoding='utf8') as f:
+        return [WorkloadTorrent(**entry) for entry in json.load(f)]
+
+
+def save_workload(path, workload):
+    with open(path, 'w', encoding='utf8') as f:
+        json.dump([t._asdict() for t in workload], f, indent=1)
+
+
+def make_planner(cfg):
+    """Builds a driver to plan with.  It never talks to rtorrent or a remote.
+
+    Only the nominal space accounting can be simulated, as the allocated one
+    looks at the disk.
+    """
+    cfg = dict({
+        'managed_torrents_directory': '',
+        'required_ratio': '1',
+        'socket_url': 'scgi:///nonexistent',
+        'remote_sync_service': 'rsync',
+        'rsync_host': 'simulated',
+        'rsync_path': '/simulated',
+        'manifest_file': os.devnull,
+    }, **cfg)
+    cfg['space_accounting'] = 'nominal'
+    return driver.RtorrentLowSpaceDriver(metadata.MetadataService(), cfg)
+
+
+class Blob:
+    """Data that is downloaded at a steady rate, then kept until removed."""
+    def __init__(self, size, start, end):
+        self.size = size
+        self.start = start
+        self.end = end
+        self.removed = None
+
+    def on_disk(self, t):
+        if t <= self.start or (self.removed is not None and t >= self.removed):
+            return 0
+        if t >= self.end:
+            return self.size
+        return self.size * (t - self.start) / (self.end - self.start)
+
+
+class SimulatedTorrent:
+    """A workload torrent, and what happened to it so far."""
+    def __init__(self, torrent):
+        self.torrent = torrent
+        self.size = sum(torrent.file_sizes)
+        # As build_managed_torrents_list() would describe it.
+        self.datum = {
+            'torrent_path': torrent.name + '.torrent',
+            'size': self.size,
+            'name': torrent.name,
+            'hash': torrent.name,
+            'added': torrent.arrival,
+        }
+        self.blobs = []
+        self.loaded_at = None
+        self.downloaded_at = None
+        self.seeded_at = None
+        self.uploading = False
+        self.delivered_at = None
+        # Large strategy only: per file index, the Blob and whether it was
+        # uploaded.
+        self.file_blobs = {}
+        self.uploaded_files = set()
+
+
+class Simulator:
+    """Runs the planning code of a driver against a workload.
+
+    The planner runs every run_interval seconds, like the driver from cron.
+    Loaded torrents download at their own rate, independently of each
+    other, and seed until they reach the required ratio.  Uploads go through
+    a single queue at remote_rate bytes per second, and a torrent, or file of
+    a large torrent, leaves the disk once its upload finished.
+    """
+    def __init__(self, workload, cfg, run_interval=3600, remote_rate=10 * MiB, duration=30 * DAY):
+        """Inits Simulator.
+
+        Args:
+            workload: List of WorkloadTorrent.
+            cfg: Driver configs in dictionary form, space_limit at least.
+            run_interval: Seconds between runs of the planner.
+            remote_rate: Upload speed to the remote in bytes per second.
+            duration: Simulated time in seconds.
+        """
+        self.planner = make_planner(cfg)
+        self.planner.clock = lambda: self.now
+        self.workload = sorted(workload, key=lambda t: t.arrival)
+        self.run_interval = run_interval
+        self.remote_rate = remote_rate
+        self.duration = duration
+
+        self.now = 0.0
+        self._events = []
+        self._sequence = 0
+        self.remote_free_at = 0.0
+        self.managed = []
+        self.loaded = []
+        self.large = None
+        self.delivered = []
+        self.undeliverable = []
+        self._disk_area = 0.0
+        self._disk_last = 0.0
+        self._disk_peak = 0
+
+    def schedule(self, t, callback, *args):
+        heapq.heappush(self._events, (t, self._sequence, callback, args))
+        self._sequence += 1
+
+    def run(self):
+        """Simulates the whole duration and returns a Report."""
+        for torrent in self.workload:
+            if torrent.arrival < self.duration:
+                self.schedule(torrent.arrival, self.arrive, SimulatedTorrent(torrent))
+        t = 0.0
+        while t < self.duration:
+            self.schedule(t, self.plan)
+            t += self.run_interval
+
+        while self._events and self._events[0][0] <= self.duration:
+            t, sequence, callback, args = heapq.heappop(self._events)
+            self.advance(t)
+            callback(*args)
+        self.advance(self.duration)
+        return self.report()
+
+    # Disk usage is piecewise linear between events, so integrating it with
+    # the trapezoid rule is exact.
+    def disk_usage(self, t):
+        return sum(blob.on_disk(t) for s in self.loaded for blob in s.blobs)
+
+    def advance(self, t):
+        usage = self.disk_usage(t)
+        self._disk_area += (self._disk_last + usage) / 2 * (t - self.now)
+        self._disk_last = usage
+        self._disk_peak = max(self._disk_peak, usage)
+        self.now = t
+
+    # Events
+
+    def arrive(self, s):
+        self.managed.append(s)
+
+    def downloaded(self, s):
+        s.downloaded_at = self.now
+        ratio_time = self.planner.REQUIRED_RATIO * s.size / s.torrent.upload_rate
+        s.seeded_at = self.now + ratio_time
+
+    def upload(self, size, callback, *args):
+        start = max(self.now, self.remote_free_at)
+        self.remote_free_at = start + size / self.remote_rate
+        self.schedule(self.remote_free_at, callback, *args)
+
+    def uploaded(self, s):
+        for blob in s.blobs:
+            blob.removed = self.now
+        self.deliver(s)
+
+    def deliver(self, s):
+        s.delivered_at = self.now
+        self.loaded.remove(s)
+        self.delivered.append(s)
+
+    def file_downloaded(self, s, index):
+        self.upload(s.torrent.file_sizes[index], self.file_uploaded, s, index)
+
+    def file_uploaded(self, s, index):
+        s.file_blobs[index].removed = self.now
+        s.uploaded_files.add(index)
+        if len(s.uploaded_files) == len(s.torrent.file_sizes):
+            self.large = None
+            self.deliver(s)
+
+    def load(self, s):
+        s.loaded_at = self.now
+        self.managed.remove(s)
+        self.loaded.append(s)
+
+    # Planning, the same decisions as RtorrentLowSpaceDriver.run() makes.
+
+    def plan(self):
+        for s in self.loaded:
+            if s is not self.large and not s.uploading \
+                    and s.seeded_at is not None and s.seeded_at <= self.now:
+                s.uploading = True
+                self.upload(s.size, self.uploaded, s)
+
+        if self.large is not None:
+            self.plan_large()
+            return
+
+        effective_space = self.planner.compute_effective_available_space(
+            [s.datum for s in self.loaded]
+        )
+        by_hash = {s.datum['hash']: s for s in self.managed}
+        choices = self.planner.build_next_load_group([s.datum for s in self.managed], effective_space)
+        for datum in choices:
+            s = by_hash[datum['hash']]
+            self.load(s)
+            end = self.now + s.size / s.torrent.download_rate
+            s.blobs.append(Blob(s.size, self.now, end))
+            self.schedule(end, self.downloaded, s)
+
+        if not choices and self.managed \
+                and all(s.seeded_at is not None and s.seeded_at <= self.now for s in self.loaded):
+            if self.loaded:
+                return
+            self.large = min(self.managed, key=lambda s: s.size)
+            self.load(self.large)
+            self.plan_large()
+
+    def plan_large(self):
+        s = self.large
+        if any(blob.end > self.now for blob in s.file_blobs.values()):
+            return
+
+        files = [
+            rtorrent_xmlrpc.File(i, "%s:f%d" % (s.torrent.name, i), str(i), size,
+                                 1 if i in s.file_blobs else 0, 1, 0)
+            for i, size in enumerate(s.torrent.file_sizes)
+        ]
+        layout = pieces.PieceLayout(files, s.torrent.chunk_size)
+        kept_size = sum(
+            blob.size for i, blob in s.file_blobs.items() if i not in s.uploaded_files
+        )
+        group = self.planner.generate_next_group(
+            files, [str(i) for i in s.file_blobs], layout, self.planner.SPACE_LIMIT - kept_size
+        )
+
+        if not group and not kept_size:
+            # Only files larger than the space limit are left.
+            self.large = None
+            self.loaded.remove(s)
+            self.undeliverable.append(s)
+            return
+
+        start = self.now
+        for file_ in group:
+            end = start + file_.size_bytes / s.torrent.download_rate
+            blob = s.file_blobs[file_.index] = Blob(file_.size_bytes, start, end)
+            s.blobs.append(blob)
+            self.schedule(end, self.file_downloaded, s, file_.index)
+            start = end
+
+    def report(self):
+        days = self.duration / DAY
+        delivered_bytes = sum(s.size for s in self.delivered)
+        # Torrents still waiting count as loaded at the end of the simulation.
+        # That understates their latency, but leaving them out would hide
+        # overload altogether.
+        queue_latencies = sorted(
+            [s.loaded_at - s.torrent.arrival for s in self.delivered + self.loaded + self.undeliverable]
+            + [self.duration - s.torrent.arrival for s in self.managed]
+        )
+        delivery_latencies = [s.delivered_at - s.torrent.arrival for s in self.delivered]
+        limit = self.planner.SPACE_LIMIT
+
+        def mean(values):
+            return sum(values) / len(values) if values else 0.0
+
+        return Report(
+            days=days,
+            delivered_torrents=len(self.delivered),
+            delivered_bytes=delivered_bytes,
+            bytes_per_day=delivered_bytes / days,
+            mean_disk_utilisation=self._disk_area / self.duration / limit,
+            peak_disk_utilisation=self._disk_peak / limit,
+            mean_queue_latency=mean(queue_latencies),
+            p95_queue_latency=queue_latencies[int(0.95 * (len(queue_latencies) - 1))] if queue_latencies else 0.0,
+            mean_delivery_latency=mean(delivery_latencies),
+            waiting_torrents=len(self.managed),
+            undeliverable_torrents=len(self.undeliverable),
+        )
+
+
+def format_report(report):
+    hours = 60 * 60
+    return '\n'.join([
+        "Simulated %.1f days" % report.days,
+        "Delivered:            %d torrents, %.1f GiB, %.1f GiB/day" % (
+            report.delivered_torrents, report.delivered_bytes / GiB, report.bytes_per_day / GiB),
+        "Disk utilisation:     %.1f%% mean, %.1f%% peak" % (
+            100 * report.mean_disk_utilisation, 100 * report.peak_disk_utilisation),
+        "Queue latency:        %.1f h mean, %.1f h p95, counting %d still waiting" % (
+            report.mean_queue_latency / hours, report.p95_queue_latency / hours, report.waiting_torrents),
+        "Delivery latency:     %.1f h mean" % (report.mean_delivery_latency / hours),
+        "Still waiting:        %d torrents" % report.waiting_torrents,
+        "Undeliverable:        %d torrents" % report.undeliverable_torrents,
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the rotator against a workload.")
+    parser.add_argument('--space-limit', type=int, required=True, help='space_limit in bytes.')
+    parser.add_argument('--required-ratio', type=float, default=1.0)
+    parser.add_argument('--packing-mode', default='smallest_first')
+    parser.add_argument('--scheduling-policy', default='smallest_first')
+    parser.add_argument('--days', type=float, default=30)
+    parser.add_argument('--run-interval', type=float, default=3600, help='Seconds between runs.')
+    parser.add_argument('--remote-rate', type=float, default=10 * MiB, help='Upload bytes per second.')
+    parser.add_argument('--workload', metavar='FILE', help='Recorded workload, JSON.')
+    parser.add_argument('--torrents', type=int, default=500, help='Size of a synthetic workload.')
+    parser.add_argument('--arrivals-per-day', type=float, default=24)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--record', metavar='FILE', help='Save the workload used to FILE.')
+    args = parser.parse_args()
+    # The planner's own logging would drown the report.
+    logging.basicConfig(level=logging.ERROR)
+
+    if args.workload:
+        workload = load_workload(args.workload)
+    else:
+        workload = synthetic_workload(args.torrents, seed=args.seed, arrivals_per_day=args.arrivals_per_day)
+    if args.record:
+        save_workload(args.record, workload)
+
+    simulator = Simulator(workload, {
+        'space_limit': str(args.space_limit),
+        'required_ratio': str(args.required_ratio),
+        'packing_mode': args.packing_mode,
+        'scheduling_policy': args.scheduling_policy,
+    }, run_interval=args.run_interval, remote_rate=args.remote_rate, duration=args.days * DAY)
+    print(format_report(simulator.run()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+class RunSnapshot:
+    """State of the managed directory and of rtorrent, captured once per run.
+
+    Driver phases read from the snapshot instead of querying rtorrent and
+    the filesystem again, and mutations performed by the driver (loading,
+    erasing, purging) are applied to it in place.
+
+    Attributes:
+        managed: Dict of managed torrents keyed by infohash.
+        downloads: Dict of rtorrent_xmlrpc.Download records keyed by
+          infohash, in the order rtorrent reported them.  Downloads loaded
+          during the run map to None, as their fields are not known yet.
+    """
+    def __init__(self, managed, downloads):
+        """Inits RunSnapshot.
+
+        Args:
+            managed: Dict of managed torrents keyed by infohash, as built by
+              build_managed_torrents_list().
+            downloads: Dict of rtorrent_xmlrpc.Download records keyed by
+              infohash.
+        """
+        self.managed = managed
+        self.downloads = downloads
+
+    def complete(self):
+        """Returns the infohashes of complete downloads."""
+        return [h for h, d in self.downloads.items() if d is not None and d.complete]
+
+    def incomplete(self):
+        """Returns the infohashes of incomplete downloads."""
+        return [h for h, d in self.downloads.items() if d is None or not d.complete]
+
+    def managed_in(self, hashes):
+        """Returns the managed torrents among the given infohashes."""
+        return [self.managed[h] for h in hashes if h in self.managed]
+
+    def loaded(self, torrent):
+        """Records that a managed torrent was loaded into rtorrent."""
+        self.downloads[torrent['hash']] = None
+
+    def erased(self, infohash):
+        """Records that a download was erased from rtorrent."""
+        self.downloads.pop(infohash, None)
+
+    def purged(self, torrent):
+        """Records that a managed torrent was erased and its file deleted."""
+        self.erased(torrent['hash'])
+        self.managed.pop(torrent['hash'], None)
@@ -0,0 +1,117 @@
+from logging import debug
+
+import persist
+
+# Weight of the newest d.down.rate sample in a download's mean rate.
+RATE_WEIGHT = 0.5
+
+
+class SwarmHistory:
+    """What rtorrent reported about the swarm of every managed download.
+
+    rtorrent only knows about the swarm of loaded downloads, so the history
+    is what lets the scheduling policies predict how a parked torrent will
+    do when it is loaded again.  Entries are keyed on infohash and hold:
+
+        seeders, peers: d.peers_complete and d.peers_accounted last seen.
+        rate: Moving average of d.down.rate, bytes per second.
+        completed_bytes, progress_at: d.completed_bytes, and the last time
+          it grew or the download wasn't running, while it is loaded.
+        parked_until: Unix time before which a parked torrent isn't loaded.
+    """
+    def __init__(self, path=None):
+        """Inits SwarmHistory.
+
+        Args:
+            path: Path to the JSON file to persist to, string, or None to
+              keep the history in memory only.
+        """
+        self.path = path
+        self._entries = persist.load_json(path, {}) if path else {}
+        self._dirty = False
+
+    def observe(self, downloads, now):
+        """Records the swarm of the incomplete downloads.
+
+        Downloads that rtorrent stopped, queued or is hash checking can't
+        make progress, so their stall window only starts once they run.
+
+        Args:
+            downloads: Iterable of rtorrent_xmlrpc.Download records, or None
+              for downloads loaded during the run.
+            now: Unix time of the records.
+        """
+        for d in downloads:
+            if d is None or d.complete:
+                continue
+            entry = self._entries.setdefault(d.hash, {})
+            running = d.is_active and not d.is_hash_checking
+            if 'progress_at' not in entry or not running or d.completed_bytes > entry['completed_bytes']:
+                entry['progress_at'] = now
+            entry['completed_bytes'] = d.completed_bytes
+            entry['seeders'] = d.peers_complete
+            entry['peers'] = d.peers_accounted
+            if 'rate' not in entry:
+                entry['rate'] = d.down_rate if running else 0
+            elif running:
+                entry['rate'] = RATE_WEIGHT * d.down_rate + (1 - RATE_WEIGHT) * entry['rate']
+            entry.pop('parked_until', None)
+            self._dirty = True
+
+    def get(self, infohash):
+        """Returns the entry of a download as a dict, or None."""
+        return self._entries.get(infohash)
+
+    def expected_rate(self, infohash):
+        """Returns the download rate to expect from a download's swarm.
+
+        A swarm last seen without seeders or peers is unavailable, and
+        expected to give nothing.  Otherwise this is the mean rate seen, or
+        None when nothing is known, or the download never got going.
+        """
+        entry = self._entries.get(infohash)
+        if entry is None:
+            return None
+        if not self.available(infohash):
+            return 0.0
+        return entry.get('rate') or None
+
+    def available(self, infohash):
+        """Returns whether a download's swarm was last seen with seeders or
+        peers.  Unknown swarms count as available."""
+        entry = self._entries.get(infohash)
+        return entry is None or bool(entry.get('seeders') or entry.get('peers'))
+
+    def stalled(self, infohash, now, window):
+        """Returns whether a loaded download made no progress for window seconds."""
+        entry = self._entries.get(infohash)
+        return entry is not None and 'progress_at' in entry and now - entry['progress_at'] >= window
+
+    def park(self, infohash, until):
+        """Records that a download was unloaded, and keeps it out until then."""
+        entry = self._entries.setdefault(infohash, {})
+        entry.pop('progress_at', None)
+        entry.pop('completed_bytes', None)
+        entry['parked_until'] = until
+        self._dirty = True
+
+    def parked(self, infohash, now):
+        """Returns whether a torrent is parked at the time now."""
+        entry = self._entries.get(infohash)
+        return entry is not None and entry.get('parked_until', 0) > now
+
+    def commit(self, live_hashes):
+        """Forgets the torrents that are no longer managed, and persists.
+
+        Args:
+            live_hashes: Infohashes of the managed torrents.
+        """
+        live_hashes = set(live_hashes)
+        for infohash in set(self._entries) - live_hashes:
+            debug("Forgetting the swarm of %s" % infohash)
+            del self._entries[infohash]
+            self._dirty = True
+
+        if self._dirty and self.path:
+            persist.dump_json(self.path, self._entries)
+        self._dirty = False
@@ -0,0 +1,51 @@
+import pytest
+
+import benchmark
+
+
+@pytest.fixture
+def small(tmp_path):
+    driver_, fake = benchmark.small_strategy(str(tmp_path), 1000)
+    yield driver_, fake
+    fake.stop()
+
+
+@pytest.fixture
+def large(tmp_path):
+    driver_, fake = benchmark.large_strategy(str(tmp_path), 5000)
+    yield driver_, fake
+    fake.stop()
+
+
+class TestRpcBudget:
+    def test_small_strategy_makes_one_call_per_change(self, small):
+        driver_, fake = small
+        driver_.run()
+
+        purged, loaded = fake.calls['d.erase'], fake.calls['load.start']
+        assert purged == 100
+        assert loaded > 0
+        # One snapshot, then nothing but the changes themselves.
+        assert fake.requests == 1 + purged + loaded
+        assert len(driver_.remote_sync_service.uploads) == purged
+
+    def test_large_strategy_round_trips_do_not_grow_with_files(self, large):
+        driver_, fake = large
+        driver_.run()
+
+        # Snapshot, f.multicall, the priority multicall and d.is_active,
+        # however many files the torrent has.
+        assert fake.requests <= 4
+        assert fake.calls['d.directory'] == 0
+        assert fake.calls['f.multicall'] == 1
+        assert fake.calls['system.multicall'] == 1
+        # Every completed file was uploaded, in one transfer list.
+        assert len(driver_.remote_sync_service.uploads) == 1
+
+    def test_measure(self):
+        result = benchmark.measure('small', 100)
+        assert (result.scenario, result.scale) == ('small', 100)
+        # The small strategy never batches, so commands and requests match.
+        assert result.calls == result.requests > 10
+        assert result.seconds > 0
+        assert result.peak_bytes > 0
@@ -0,0 +1,132 @@
+import asyncio
+import os
+
+import pytest
+
+import benchmark
+import daemon
+import fake_rtorrent
+
+
+class FakeDriver:
+    """Counts runs, and reports the fingerprint set by the test."""
+    def __init__(self):
+        self.fingerprint = 'a'
+        self.runs = 0
+        self.fail = False
+
+    def state_fingerprint(self):
+        return self.fingerprint
+
+    def run(self):
+        self.runs += 1
+        if self.fail:
+            raise RuntimeError("test")
+
+
+@pytest.fixture
+def daemon_(monkeypatch):
+    """A daemon around a FakeDriver, with a clock set by the test."""
+    now = [0.0]
+    monkeypatch.setattr(daemon.time, 'monotonic', lambda: now[0])
+    driver_ = FakeDriver()
+    daemon_ = daemon.DriverDaemon(driver_, {'full_run_interval': '100'})
+    daemon_.loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(daemon_.loop)
+    daemon_._wakeup = asyncio.Event()
+
+    def tick():
+        daemon_.loop.run_until_complete(daemon_._tick())
+
+    yield daemon_, driver_, tick, now
+    asyncio.set_event_loop(None)
+    daemon_.loop.close()
+
+
+class TestDriverDaemon:
+    def test_runs_only_when_the_fingerprint_changed(self, daemon_):
+        daemon_, driver_, tick, now = daemon_
+        tick()
+        tick()
+        assert driver_.runs == 1
+
+        driver_.fingerprint = 'b'
+        tick()
+        assert driver_.runs == 2
+
+    def test_runs_when_the_full_run_is_due(self, daemon_):
+        daemon_, driver_, tick, now = daemon_
+        tick()
+        now[0] = 99
+        tick()
+        assert driver_.runs == 1
+
+        now[0] = 100
+        tick()
+        assert driver_.runs == 2
+
+    def test_readable_reader_forces_a_run(self, daemon_):
+        daemon_, driver_, tick, now = daemon_
+        drained = []
+        tick()
+
+        daemon_._on_readable(lambda: drained.append(True), force_run=False)
+        tick()
+        assert driver_.runs == 1
+
+        daemon_._on_readable(lambda: drained.append(True), force_run=True)
+        tick()
+        assert driver_.runs == 2
+        assert drained == [True, True]
+        assert daemon_._wakeup.is_set()
+
+    def test_reader_decides_from_what_it_collected(self, daemon_):
+        daemon_, driver_, tick, now = daemon_
+        tick()
+
+        daemon_._on_readable(lambda: ['erased'], force_run=lambda collected: 'finished' in collected)
+        tick()
+        assert driver_.runs == 1
+
+        daemon_._on_readable(lambda: ['finished'], force_run=lambda collected: 'finished' in collected)
+        tick()
+        assert driver_.runs == 2
+
+    def test_failed_run_is_retried_at_the_next_poll(self, daemon_):
+        daemon_, driver_, tick, now = daemon_
+        driver_.fail = True
+        tick()
+
+        driver_.fail = False
+        tick()
+        assert driver_.runs == 2
+        tick()
+        assert driver_.runs == 2
+
+    def test_driver_wakes_the_daemon(self, daemon_):
+        daemon_, driver_, tick, now = daemon_
+        driver_.wake()
+        daemon_.loop.run_until_complete(asyncio.wait_for(daemon_._wakeup.wait(), 1))
+
+
+class TestStateFingerprint:
+    def test_polls_three_fields_per_download(self, tmp_path):
+        workdir = str(tmp_path)
+        os.makedirs(os.path.join(workdir, 'managed'))
+        metadata_service = fake_rtorrent.FakeMetadataService()
+        fake = fake_rtorrent.FakeRtorrent(os.path.join(workdir, 'rpc.socket'), workdir, metadata_service)
+        fake.add_download(fake_rtorrent.FakeDownload(
+            '%040X' % 1, 'a', workdir, [fake_rtorrent.FakeFile('a', 4, 4)], 4, ratio=2.0))
+        multicalls = []
+        d_multicall2 = fake.methods['d.multicall2']
+        fake.methods['d.multicall2'] = lambda *params: (multicalls.append(params[2:]), d_multicall2(*params))[1]
+        fake.start()
+        try:
+            driver_ = benchmark.make_driver(workdir, fake, metadata_service, 64)
+            fingerprint = driver_.state_fingerprint()
+            fake.downloads['%040X' % 1].complete = True
+            assert driver_.state_fingerprint() != fingerprint
+        finally:
+            fake.stop()
+
+        assert multicalls == [('d.hash=', 'd.complete=', 'd.ratio=')] * 2
@@ -2,10 +2,20 @@
 
 # main test suite
 
+import os
+import tempfile
+
 import pytest
 
+import benchmark
 import driver
+import fake_rtorrent
 import metadata
+import diskusage
+import pieces
+import retry
+import rtorrent_xmlrpc
+import snapshot
 
 
 @pytest.fixture(scope="module")
@@ -44,3 +54,428 @@ class TestThings:
         next_group = self.driver.build_next_load_group(candidates, limit)
         assert len(next_group) == 1
         assert "foo" == next_group[0]['name']
+
+    @pytest.mark.parametrize('packing_mode, expected', [
+        ('smallest_first', ["foo", "bar"]),
+        ('optimal', ["bar", "baz"]),
+    ])
+    def test_build_next_load_group_packing_mode(self, configs_valid, packing_mode, expected):
+        metadata_svc = metadata.MetadataService()
+        cfg = dict(configs_valid, packing_mode=packing_mode)
+        self.driver = driver.RtorrentLowSpaceDriver(metadata_svc, cfg)
+
+        candidates = [
+            {'name': "foo", 'size': 2 * 2**20},
+            {'name': "bar", 'size': 3 * 2**20},
+            {'name': "baz", 'size': 3 * 2**20},
+        ]
+
+        next_group = self.driver.build_next_load_group(candidates, 6 * 2**20)
+        assert [t['name'] for t in next_group] == expected
+
+
+class CountingMetadataService(metadata.MetadataService):
+    def __init__(self):
+        self.parsed = []
+
+    def torrent_info(self, path):
+        self.parsed.append(path)
+        return metadata.CachedTorrentInfo("abcd", "foo", 4 * 2**20)
+
+
+class TestCachingMetadataService:
+    def test_unchanged_files_are_not_parsed_again(self, tmp_path):
+        torrent = tmp_path / 'foo.torrent'
+        torrent.write_bytes(b'd4:infod4:name3:fooee')
+        cache_path = str(tmp_path / 'cache' / 'metadata.json')
+
+        backend = CountingMetadataService()
+        svc = metadata.CachingMetadataService(backend, cache_path)
+        assert svc.torrent_info(str(torrent)).info_hash() == "ABCD"
+        svc.commit([str(torrent)])
+
+        svc = metadata.CachingMetadataService(backend, cache_path)
+        t_info = svc.torrent_info(str(torrent))
+        assert t_info.name() == "foo"
+        assert t_info.total_size() == 4 * 2**20
+        assert len(backend.parsed) == 1
+
+    def test_changed_files_are_parsed_again(self, tmp_path):
+        torrent = tmp_path / 'foo.torrent'
+        torrent.write_bytes(b'd4:infod4:name3:fooee')
+        cache_path = str(tmp_path / 'metadata.json')
+
+        backend = CountingMetadataService()
+        svc = metadata.CachingMetadataService(backend, cache_path)
+        svc.torrent_info(str(torrent))
+        torrent.write_bytes(b'd4:infod4:name6:foobaree')
+        svc.torrent_info(str(torrent))
+        assert len(backend.parsed) == 2
+
+
+def file_records(sizes):
+    return [
+        rtorrent_xmlrpc.File(i, "ABCD:f%d" % i, "f%d" % i, size, 0, 1, 0)
+        for i, size in enumerate(sizes)
+    ]
+
+
+class TestPieceAwareLargeStrategy:
+    @pytest.fixture
+    def driver_(self, configs_valid):
+        return driver.RtorrentLowSpaceDriver(metadata.MetadataService(), configs_valid)
+
+    def test_next_group_keeps_files_sharing_pieces_together(self, driver_):
+        # With 4 byte pieces, f0 and f1 share piece 1.  Each costs 8 bytes
+        # on its own, but both together only take 12.
+        files = file_records([6, 6, 100])
+        layout = pieces.PieceLayout(files, 4)
+
+        group = driver_.generate_next_group(files, [], layout, 12)
+        assert [f.path for f in group] == ["f0", "f1"]
+
+    def test_next_group_counts_boundary_pieces(self, driver_):
+        files = file_records([6, 6, 100])
+        layout = pieces.PieceLayout(files, 4)
+
+        group = driver_.generate_next_group(files, ["f0"], layout, 7)
+        assert group == []
+
+    def test_completed_file_is_kept_until_neighbours_are_done(self, driver_):
+        files = file_records([6, 6, 100])
+        layout = pieces.PieceLayout(files, 4)
+
+        removable, kept_size = driver_.split_removable_files(files, layout, ["f0"], {"f0"})
+        assert removable == []
+        assert kept_size == 6
+
+        removable, kept_size = driver_.split_removable_files(files, layout, ["f1"], {"f0", "f1"})
+        assert removable == ["f0", "f1"]
+        assert kept_size == 0
+
+
+class TestFileRecords:
+    @pytest.fixture
+    def driver_(self, configs_valid):
+        return driver.RtorrentLowSpaceDriver(metadata.MetadataService(), configs_valid)
+
+    def test_completed_files_are_wanted_and_fully_downloaded(self, driver_):
+        files = [
+            rtorrent_xmlrpc.File(0, "ABCD:f0", "done", 6, 2, 2, 1),
+            rtorrent_xmlrpc.File(1, "ABCD:f1", "partial", 6, 1, 2, 1),
+            rtorrent_xmlrpc.File(2, "ABCD:f2", "skipped", 6, 2, 2, 0),
+        ]
+        assert driver_.check_for_local_completed_files(files) == ["done"]
+
+
+class UnavailableRemote:
+    def sync_files_from_filelist(self, realpath, filelist_path):
+        assert os.path.exists(filelist_path)
+        raise retry.RemoteUnavailable("test")
+
+
+class TestSyncCompletedFiles:
+    def test_transfer_list_is_removed_when_the_upload_fails(self, configs_valid, tmp_path, monkeypatch):
+        driver_ = driver.RtorrentLowSpaceDriver(metadata.MetadataService(), configs_valid)
+        driver_.remote_sync_service = UnavailableRemote()
+        monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+
+        with pytest.raises(retry.RemoteUnavailable):
+            driver_.sync_completed_files_to_remote('/dl/show', ['a.mkv'])
+        assert os.listdir(str(tmp_path)) == []
+
+
+class FakeDirectoryServer:
+    """Stands in for rtorrent, answering directory.default only."""
+    def __init__(self, default):
+        self.directory = self
+        self.default_directory = default
+
+    def default(self, target):
+        return self.default_directory
+
+
+def download(hash_, directory, complete, size_bytes, completed_bytes):
+    return rtorrent_xmlrpc.Download(
+        hash_, complete, 0.0, directory, '', directory, size_bytes, completed_bytes, 1, 4, 1, 0, 0, 0, 0
+    )
+
+
+class TestAllocatedSpaceAccounting:
+    @pytest.fixture
+    def driver_(self, configs_valid, tmp_path):
+        cfg = dict(configs_valid, space_limit=str(10 * 2**20), space_accounting='allocated')
+        driver_ = driver.RtorrentLowSpaceDriver(metadata.MetadataService(), cfg)
+        driver_.server = FakeDirectoryServer(str(tmp_path))
+        return driver_
+
+    def test_counts_allocated_blocks_and_outstanding_bytes(self, driver_, tmp_path):
+        # A completed download whose file was zeroed by the large strategy,
+        # and an incomplete one still missing 3 MiB.
+        (tmp_path / 'zeroed').mkdir()
+        (tmp_path / 'zeroed' / 'a.mkv').write_bytes(b'')
+        (tmp_path / 'partial').mkdir()
+        driver_.snapshot = snapshot.RunSnapshot({}, {
+            'AA': download('AA', str(tmp_path / 'zeroed'), True, 8 * 2**20, 8 * 2**20),
+            'BB': download('BB', str(tmp_path / 'partial'), False, 4 * 2**20, 2**20),
+        })
+
+        used = diskusage.allocated_bytes(str(tmp_path / 'zeroed')) \
+            + diskusage.allocated_bytes(str(tmp_path / 'partial'))
+        assert driver_.compute_effective_available_space([]) == 10 * 2**20 - 3 * 2**20 - used
+
+    def test_clamps_to_free_space_of_volume(self, driver_, tmp_path, monkeypatch):
+        monkeypatch.setattr(diskusage, 'free_bytes', lambda path: 5 * 2**20)
+        driver_.snapshot = snapshot.RunSnapshot({}, {
+            'BB': download('BB', str(tmp_path / 'partial'), False, 4 * 2**20, 2**20),
+        })
+
+        assert driver_.compute_effective_available_space([]) == 2 * 2**20
+
+
+class EventLog(list):
+    """Records driver, rtorrent and remote actions in the order they happen."""
+    def wrap(self, fake, method, name=None):
+        function = fake.methods[method]
+
+        def wrapper(*params):
+            self.append((name or method,) + params)
+            return function(*params)
+        fake.methods[method] = wrapper
+
+
+class LoggingRemoteSync(fake_rtorrent.FakeRemoteSync):
+    def __init__(self, log, fail=False, **kwargs):
+        super().__init__(**kwargs)
+        self.log = log
+        self.fail = fail
+
+    def sync_files_from_filelist(self, realpath, filelist_path):
+        with open(filelist_path) as f:
+            paths = sorted(line.strip() for line in f)
+        if self.fail:
+            self.log.append(('upload failed',) + tuple(paths))
+            raise retry.RemoteUnavailable("test")
+        self.log.append(('upload',) + tuple(paths))
+        super().sync_files_from_filelist(realpath, filelist_path)
+
+
+class TestPipelinedLargeStrategy:
+    INFOHASH = '%040X' % 1
+
+    @pytest.fixture
+    def scenario(self, tmp_path, monkeypatch):
+        """A large torrent with 4 byte pieces.  f0 and f1 share piece 1, f2
+        starts on a piece of its own.  f0 and f2 are complete."""
+        monkeypatch.setattr(driver.time, 'sleep', lambda seconds: None)
+        workdir = str(tmp_path)
+        directory = os.path.join(workdir, 'data', 'large')
+        os.makedirs(os.path.join(workdir, 'managed'))
+        os.makedirs(directory)
+        metadata_service = fake_rtorrent.FakeMetadataService()
+        fake = fake_rtorrent.FakeRtorrent(os.path.join(workdir, 'rpc.socket'),
+                                          os.path.join(workdir, 'data'), metadata_service)
+        files = [
+            fake_rtorrent.FakeFile('f0', 6, 4, complete=True),
+            fake_rtorrent.FakeFile('f1', 6, 4),
+            fake_rtorrent.FakeFile('f2', 8, 4, complete=True),
+        ]
+        for f in files:
+            with open(os.path.join(directory, f.path), 'w') as data:
+                data.write('x' * f.size_bytes)
+        download = fake_rtorrent.FakeDownload(self.INFOHASH, 'large', directory, files, 4)
+        fake.add_download(download)
+        benchmark.add_managed_torrent(workdir, metadata_service, self.INFOHASH, 'large', 20)
+        fake.start()
+
+        log = EventLog()
+        for method in ('d.stop', 'd.start', 'f.priority.set'):
+            log.wrap(fake, method)
+
+        def make(fail=False):
+            driver_ = benchmark.make_driver(workdir, fake, metadata_service, 64,
+                                            large_strategy_mode='pipelined')
+            driver_.remote_sync_service = LoggingRemoteSync(
+                log, fail, manifest_file=os.path.join(workdir, 'manifest.json'))
+            zero_out_file = driver_._zero_out_file
+
+            def logging_zero_out_file(path):
+                log.append(('truncate', os.path.basename(path)))
+                zero_out_file(path)
+            driver_._zero_out_file = logging_zero_out_file
+            return driver_
+
+        def size(path):
+            return os.path.getsize(os.path.join(directory, path))
+
+        yield make, fake, download, log, size
+        fake.stop()
+
+    def strategy(self, driver_):
+        driver_.snapshot = driver_.take_snapshot()
+        return driver_.handle_large_torrent_strategy({'hash': self.INFOHASH, 'name': 'large'})
+
+    def test_upload_then_release_then_truncate(self, scenario):
+        make, fake, download, log, size = scenario
+
+        assert self.strategy(make()) is False
+
+        assert log == [
+            ('upload', 'f0', 'f2'),
+            ('f.priority.set', self.INFOHASH + ':f2', 0),
+            ('d.stop', self.INFOHASH),
+            ('truncate', 'f2'),
+            ('d.start', self.INFOHASH),
+            # f0 is done, so it stops downloading, but stays on disk.
+            ('f.priority.set', self.INFOHASH + ':f0', 0),
+        ]
+        assert download.is_active
+        assert [f.priority for f in download.files] == [0, 1, 0]
+
+    def test_files_are_fetched_with_one_f_multicall(self, scenario):
+        make, fake, download, log, size = scenario
+        fake.reset_counts()
+        self.strategy(make())
+
+        assert fake.calls['f.multicall'] == 1
+        assert not {'f.path', 'f.size_bytes', 'f.completed_chunks'} & set(fake.calls)
+
+    def test_neighbour_is_kept_until_its_piece_is_done(self, scenario):
+        make, fake, download, log, size = scenario
+        self.strategy(make())
+        assert (size('f0'), size('f2')) == (6, 0)
+
+        download.files[1].completed_chunks = download.files[1].size_chunks
+        del log[:]
+        self.strategy(make())
+
+        assert log[0] == ('upload', 'f1')
+        assert sorted(e[1] for e in log if e[0] == 'truncate') == ['f0', 'f1']
+        assert (size('f0'), size('f1')) == (0, 0)
+
+    def test_failed_upload_truncates_nothing(self, scenario):
+        make, fake, download, log, size = scenario
+        driver_ = make(fail=True)
+
+        assert self.strategy(driver_) is False
+
+        assert log == [('upload failed', 'f0', 'f2')]
+        assert (size('f0'), size('f2')) == (6, 8)
+        assert driver_.large_uploads == {}
+        assert download.is_active
+
+        # The next run uploads them after all.
+        driver_.remote_sync_service.fail = False
+        self.strategy(driver_)
+        assert ('upload', 'f0', 'f2') in log
+        assert size('f2') == 0
+
+
+class FailingRemoteSync(fake_rtorrent.FakeRemoteSync):
+    """A remote that fails the uploads of the given names."""
+    def __init__(self, failing, **kwargs):
+        super().__init__(**kwargs)
+        self.failing = failing
+
+    def sync_path(self, base_path, base_filename):
+        if base_filename in self.failing:
+            raise retry.RemoteUnavailable("test")
+        super().sync_path(base_path, base_filename)
+
+
+class TestSyncAndRemove:
+    @pytest.fixture
+    def seeded(self, tmp_path):
+        """Three complete downloads seeded to the required ratio, whose
+        uploads run concurrently.  That of 'b' fails."""
+        workdir = str(tmp_path)
+        data = os.path.join(workdir, 'data')
+        os.makedirs(os.path.join(workdir, 'managed'))
+        os.makedirs(data)
+        metadata_service = fake_rtorrent.FakeMetadataService()
+        fake = fake_rtorrent.FakeRtorrent(os.path.join(workdir, 'rpc.socket'), data, metadata_service)
+        torrent_paths = {}
+        for i, name in enumerate(['a', 'b', 'c']):
+            infohash = '%040X' % i
+            torrent_paths[name] = benchmark.add_managed_torrent(workdir, metadata_service, infohash, name, 2**20)
+            open(os.path.join(data, name), 'w').close()
+            fake.add_download(fake_rtorrent.FakeDownload(
+                infohash, name, data, [fake_rtorrent.FakeFile(name, 2**20, 2**20, True)], 2**20,
+                complete=True, ratio=2.0
+            ))
+        fake.start()
+
+        driver_ = benchmark.make_driver(workdir, fake, metadata_service, 64 * 2**20)
+        driver_.remote_sync_service = FailingRemoteSync(
+            {'b'}, upload_workers='3', manifest_file=os.path.join(workdir, 'manifest.json'))
+        yield driver_, fake, data, torrent_paths
+        fake.stop()
+
+    def test_failed_upload_keeps_its_torrent_only(self, seeded):
+        driver_, fake, data, torrent_paths = seeded
+        driver_.run()
+
+        assert sorted(driver_.remote_sync_service.uploads) == [
+            os.path.join(data, 'a'), os.path.join(data, 'c')]
+        assert list(fake.downloads) == ['%040X' % 1]
+        assert sorted(os.listdir(data)) == ['b']
+        assert [name for name, path in sorted(torrent_paths.items()) if os.path.exists(path)] == ['b']
+
+    def test_failed_upload_is_retried_next_run(self, seeded):
+        driver_, fake, data, torrent_paths = seeded
+        driver_.run()
+
+        driver_.remote_sync_service.failing = set()
+        driver_.run()
+
+        assert fake.downloads == {}
+        assert os.listdir(data) == []
+
+    def test_purge_drops_the_directory_from_the_manifest(self, seeded):
+        driver_, fake, data, torrent_paths = seeded
+        remote_sync = driver_.remote_sync_service
+        remote_sync.record_files_upload(data, ['a'])
+        assert remote_sync.manifest.list('fake:/remote/data') == ['a']
+
+        driver_.run()
+
+        assert remote_sync.manifest.list('fake:/remote/data') == []
+
+
+class TestSetPriorities:
+    INFOHASH = '%040X' % 1
+
+    @pytest.fixture
+    def loaded(self, tmp_path):
+        """A driver and a loaded download of three files, f1 skipped."""
+        workdir = str(tmp_path)
+        os.makedirs(os.path.join(workdir, 'managed'))
+        metadata_service = fake_rtorrent.FakeMetadataService()
+        fake = fake_rtorrent.FakeRtorrent(os.path.join(workdir, 'rpc.socket'), workdir, metadata_service)
+        files = [fake_rtorrent.FakeFile('f%d' % i, 4, 4, priority=int(i != 1)) for i in range(3)]
+        download = fake_rtorrent.FakeDownload(self.INFOHASH, 'large', workdir, files, 4)
+        fake.add_download(download)
+        fake.start()
+        driver_ = benchmark.make_driver(workdir, fake, metadata_service, 64)
+        yield driver_, fake, download
+        fake.stop()
+
+    def test_only_changes_are_sent_in_one_request(self, loaded):
+        driver_, fake, download = loaded
+        files = driver_.server.file_records(self.INFOHASH)
+        fake.reset_counts()
+
+        driver_.set_priorities(self.INFOHASH, files, {files[0].id: 1, files[1].id: 1})
+
+        assert fake.requests == 1
+        assert fake.calls == {'system.multicall': 1, 'f.priority.set': 2, 'd.update_priorities': 1}
+        assert [f.priority for f in download.files] == [1, 1, 0]
+
+    def test_nothing_is_sent_without_changes(self, loaded):
+        driver_, fake, download = loaded
+        files = driver_.server.file_records(self.INFOHASH)
+        fake.reset_counts()
+
+        driver_.set_priorities(self.INFOHASH, files, {files[0].id: 1, files[2].id: 1})
+
+        assert fake.requests == 0
@@ -0,0 +1,70 @@
+import os
+import stat
+
+import pytest
+
+import events
+import notify_driver
+
+
+class UnreachableServer:
+    """Fails system.multicall like an rtorrent that isn't running."""
+    def __init__(self):
+        self.system = self
+
+    def multicall(self, calls):
+        raise ConnectionRefusedError(111, 'Connection refused')
+
+
+class FakeServer:
+    """Records the calls of system.multicall and succeeds them all."""
+    def __init__(self):
+        self.system = self
+        self.calls = []
+
+    def multicall(self, calls):
+        self.calls.extend(calls)
+        return [[0] for call in calls]
+
+
+@pytest.fixture
+def listener(tmp_path):
+    listener = events.EventListener(str(tmp_path / 'events.sock'))
+    yield listener
+    listener.close()
+
+
+class TestEvents:
+    def test_notifications_are_received(self, listener):
+        assert listener.collect() == []
+        assert notify_driver.notify(listener.path, 'finished', 'abcd')
+        assert notify_driver.notify(listener.path, 'erased', 'ef01')
+        assert listener.collect() == [('finished', 'ABCD'), ('erased', 'EF01')]
+
+    def test_only_events_the_driver_did_not_cause_force_a_run(self):
+        assert not events.forces_run([])
+        assert not events.forces_run([('erased', 'ABCD'), ('hash_done', 'EF01')])
+        assert events.forces_run([('erased', 'ABCD'), ('finished', 'EF01')])
+
+    def test_notify_without_listener(self, tmp_path):
+        assert not notify_driver.notify(str(tmp_path / 'nobody.sock'), 'finished', 'abcd')
+
+    def test_install_and_remove_handlers(self, listener):
+        server = FakeServer()
+        assert events.install_handlers(server, listener.path)
+        keys = [call['params'][1] for call in server.calls]
+        assert keys == ['event.download.finished', 'event.download.hash_done', 'event.download.erased']
+        assert all(call['methodName'] == 'method.set_key' for call in server.calls)
+        assert server.calls[0]['params'][3].endswith(
+            "notify_driver.py,%s,finished,$d.hash=" % listener.path)
+
+        server.calls = []
+        events.remove_handlers(server)
+        assert [len(call['params']) for call in server.calls] == [3, 3, 3]
+
+    def test_handlers_without_rtorrent(self, listener):
+        assert not events.install_handlers(UnreachableServer(), listener.path)
+        events.remove_handlers(UnreachableServer())
+
+    def test_socket_is_not_world_writable(self, listener):
+        assert stat.S_IMODE(os.stat(listener.path).st_mode) == 0o660
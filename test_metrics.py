@@ -0,0 +1,81 @@
+import urllib.request
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def registry():
+    return metrics.Registry()
+
+
+class TestRegistry:
+    def test_render(self, registry):
+        uploads = registry.counter('uploaded_bytes_total', "Bytes uploaded.", ['engine'])
+        uploads.inc(100, engine='Rsync')
+        uploads.inc(50, engine='Rsync')
+        registry.gauge('space_bytes', "Space.", ['kind']).set(7, kind='limit')
+
+        assert registry.render() == (
+            '# HELP rtorrent_low_space_driver_space_bytes Space.\n'
+            '# TYPE rtorrent_low_space_driver_space_bytes gauge\n'
+            'rtorrent_low_space_driver_space_bytes{kind="limit"} 7\n'
+            '# HELP rtorrent_low_space_driver_uploaded_bytes_total Bytes uploaded.\n'
+            '# TYPE rtorrent_low_space_driver_uploaded_bytes_total counter\n'
+            'rtorrent_low_space_driver_uploaded_bytes_total{engine="Rsync"} 150\n'
+        )
+
+    def test_summary(self, registry):
+        durations = registry.summary('rpc_duration_seconds', "RPC time.", ['method'])
+        durations.observe(0.5, method='d.start')
+        durations.observe(0.25, method='d.start')
+
+        text = registry.render()
+        assert 'rtorrent_low_space_driver_rpc_duration_seconds_count{method="d.start"} 2\n' in text
+        assert 'rtorrent_low_space_driver_rpc_duration_seconds_sum{method="d.start"} 0.75\n' in text
+
+    def test_labels_are_escaped_and_checked(self, registry):
+        counter = registry.counter('things_total', "Things.", ['path'])
+        counter.inc(path='a "b"\n')
+        assert 'things_total{path="a \\"b\\"\\n"} 1\n' in registry.render()
+        with pytest.raises(ValueError):
+            counter.inc(engine='Rsync')
+
+    def test_write_textfile(self, registry, tmp_path):
+        registry.counter('things_total', "Things.").inc()
+        path = tmp_path / 'driver.prom'
+        registry.write_textfile(str(path))
+        assert path.read_text() == registry.render()
+
+    def test_totals_carry_over_between_processes(self, tmp_path):
+        path = str(tmp_path / 'driver.prom')
+
+        def run(space):
+            # Every run from cron is a new process, with a fresh registry.
+            registry = metrics.Registry()
+            things = registry.counter('things_total', "Things.", ['kind'])
+            durations = registry.summary('run_duration_seconds', "Runs.")
+            registry.restore_textfile(path)
+            things.inc(2, kind='a')
+            durations.observe(0.5)
+            registry.gauge('space_bytes', "Space.").set(space)
+            registry.write_textfile(path)
+
+        run(7)
+        run(3)
+
+        text = (tmp_path / 'driver.prom').read_text()
+        assert 'rtorrent_low_space_driver_things_total{kind="a"} 4\n' in text
+        assert 'rtorrent_low_space_driver_run_duration_seconds_count 2\n' in text
+        assert 'rtorrent_low_space_driver_run_duration_seconds_sum 1.0\n' in text
+        assert 'rtorrent_low_space_driver_space_bytes 3\n' in text
+
+    def test_serve(self, registry):
+        registry.counter('things_total', "Things.").inc()
+        port = registry.serve(0)
+        try:
+            with urllib.request.urlopen('http://127.0.0.1:%d/metrics' % port) as response:
+                assert response.read().decode('utf8') == registry.render()
+        finally:
+            registry.stop()
@@ -0,0 +1,145 @@
+import pytest
+
+import driver
+import metadata
+import packing
+import policies
+import rtorrent_xmlrpc
+import swarm
+
+GiB = 2**30
+HOUR = 3600
+
+
+def torrent(name, size, added=0.0):
+    return {'name': name, 'hash': name, 'size': size, 'added': added}
+
+
+def transferring(hash_, down_rate, complete=False, seeders=1, peers=1):
+    return rtorrent_xmlrpc.Download(
+        hash_, complete, 0.0, '', '', '', GiB, 0, 1, 2**20, True, down_rate, seeders, peers, False
+    )
+
+
+@pytest.fixture
+def context():
+    return policies.ScoringContext(
+        now=10 * HOUR,
+        downloads={
+            'A': transferring('A', 3 * 2**20),
+            'B': transferring('B', 1 * 2**20),
+            'C': transferring('C', 50 * 2**20, complete=True),
+            'D': None,
+        },
+        aging_period=HOUR, rotation_overhead=HOUR,
+    )
+
+
+@pytest.fixture
+def candidates():
+    return [
+        torrent('big-old', 8 * GiB, added=0.0),
+        torrent('small-new', 1 * GiB, added=9 * HOUR),
+        torrent('medium', 4 * GiB, added=6 * HOUR),
+    ]
+
+
+def names(torrents):
+    return [t['name'] for t in torrents]
+
+
+class TestScoringContext:
+    def test_mean_rate_of_incomplete_transferring_downloads(self, context):
+        assert context.mean_rate() == 2 * 2**20
+
+    def test_mean_rate_defaults_without_downloads(self):
+        context = policies.ScoringContext(0.0, {})
+        assert context.mean_rate() == policies.DEFAULT_RATE
+
+    def test_age(self, context):
+        assert context.age(torrent('t', 1, added=4 * HOUR)) == 6 * HOUR
+        assert context.age({'size': 1}) == 0.0
+
+
+class TestPolicies:
+    @pytest.mark.parametrize('policy, expected', [
+        ('smallest_first', ['small-new', 'medium', 'big-old']),
+        ('oldest_first', ['big-old', 'medium', 'small-new']),
+        ('fastest_expected_completion', ['small-new', 'medium', 'big-old']),
+        ('max_bytes_per_hour', ['big-old', 'medium', 'small-new']),
+        ('fair_aging', ['small-new', 'big-old', 'medium']),
+    ])
+    def test_order(self, context, candidates, policy, expected):
+        ordered = policies.SCHEDULING_POLICIES[policy]().order(candidates, context)
+        assert names(ordered) == expected
+
+    def test_fair_aging_is_smallest_first_without_waiting(self, context):
+        fresh = [torrent('b', 2 * GiB, 10 * HOUR), torrent('a', GiB, 10 * HOUR)]
+        assert names(policies.FairAging().order(fresh, context)) == ['a', 'b']
+
+    def test_expected_completion_uses_swarm_history(self, context, candidates):
+        history = swarm.SwarmHistory()
+        # The swarm of small-new was last seen without seeders or peers.
+        history.observe([transferring('small-new', 0, seeders=0, peers=0),
+                         transferring('big-old', 64 * 2**20)], 0)
+        context.swarm = history
+
+        ordered = policies.FastestExpectedCompletion().order(candidates, context)
+        assert names(ordered) == ['big-old', 'medium', 'small-new']
+
+    @pytest.mark.parametrize('policy, expected', [
+        ('smallest_first', ['small', 'medium', 'large']),
+        ('fastest_expected_completion', ['medium', 'small', 'large']),
+        ('max_bytes_per_hour', ['medium', 'large', 'small']),
+    ])
+    def test_swarm_history_sets_policies_apart_from_size(self, context, policy, expected):
+        # The large torrent had a slow swarm and the medium one a fast
+        # swarm, while the small one was never loaded.
+        history = swarm.SwarmHistory()
+        history.observe([transferring('large', 2**20), transferring('medium', 64 * 2**20)], 0)
+        context.swarm = history
+        candidates = [torrent('large', 8 * GiB), torrent('medium', 4 * GiB), torrent('small', GiB)]
+
+        ordered = policies.SCHEDULING_POLICIES[policy]().order(candidates, context)
+        assert names(ordered) == expected
+
+    def test_greedy_packing_follows_the_order(self, context, candidates):
+        ordered = policies.OldestFirst().order(candidates, context)
+        assert names(packing.greedy(ordered, 10 * GiB)) == ['big-old', 'small-new']
+
+    def test_optimal_packing_breaks_ties_by_the_order(self):
+        ordered = [torrent('x', 3), torrent('y', 3), torrent('z', 3), torrent('w', 1)]
+        assert names(packing.optimal(ordered, 6)) == ['x', 'y']
+        assert names(packing.optimal(ordered[::-1], 6)) == ['z', 'y']
+        assert names(packing.optimal(ordered[::-1], 7)) == ['w', 'z', 'y']
+
+
+class TestDriverScheduling:
+    @pytest.fixture
+    def cfg(self):
+        return {
+            'managed_torrents_directory': 'fake_dir/manages',
+            'space_limit': str(16 * GiB),
+            'required_ratio': '0',
+            'socket_url': 'scgi://fake_dir/.session/rpc.socket',
+            'remote_host': 'localhost',
+            'remote_path': 'upload',
+        }
+
+    def test_build_next_load_group_uses_policy(self, cfg, candidates):
+        cfg = dict(cfg, scheduling_policy='oldest_first', aging_period='3600')
+        driver_ = driver.RtorrentLowSpaceDriver(metadata.MetadataService(), cfg)
+        driver_.clock = lambda: 10 * HOUR
+
+        assert names(driver_.build_next_load_group(candidates, 9 * GiB)) == ['big-old', 'small-new']
+
+    def test_optimal_packing_with_other_policy_warns(self, cfg, caplog):
+        driver.RtorrentLowSpaceDriver(metadata.MetadataService(), dict(cfg, packing_mode='optimal'))
+        assert 'packing_mode optimal' not in caplog.text
+        driver.RtorrentLowSpaceDriver(
+            metadata.MetadataService(), dict(cfg, packing_mode='optimal', scheduling_policy='oldest_first'))
+        assert 'packing_mode optimal' in caplog.text
+
+    def test_unknown_policy_exits(self, cfg):
+        with pytest.raises(SystemExit):
+            driver.RtorrentLowSpaceDriver(metadata.MetadataService(), dict(cfg, scheduling_policy='random'))
@@ -0,0 +1,326 @@
+import http.server
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import remotesync
+
+
+class CountingRsync(remotesync.Rsync):
+    """Rsync engine whose remote listing is canned and counted."""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.listings = 0
+
+    def list_remote_files(self, realpath):
+        self.listings += 1
+        return ['a.mkv']
+
+
+@pytest.fixture
+def engine(tmp_path):
+    return CountingRsync(rsync_host='somehost', rsync_path='/upload',
+                         manifest_file=str(tmp_path / 'manifest.json'))
+
+
+class TestManifest:
+    def test_listing_is_served_from_manifest_after_reconciliation(self, engine):
+        assert engine.list_files('/dl/show') == ['a.mkv']
+        assert engine.list_files('/dl/show') == ['a.mkv']
+        assert engine.listings == 1
+
+    def test_uploads_are_recorded(self, engine, tmp_path):
+        realpath = tmp_path / 'show'
+        realpath.mkdir()
+        (realpath / 'b.mkv').write_bytes(b'1234')
+        filelist = tmp_path / 'transfer.lst'
+        filelist.write_text('b.mkv\n')
+
+        engine.list_files(str(realpath))
+        engine.record_filelist_upload(str(realpath), str(filelist))
+        assert sorted(engine.list_files(str(realpath))) == ['a.mkv', 'b.mkv']
+        assert engine.listings == 1
+
+    def test_forget(self, engine, tmp_path):
+        engine.list_files('/dl/show')
+        engine.list_files('/dl/other')
+        engine.forget('/dl/show')
+
+        engine = CountingRsync(rsync_host='somehost', rsync_path='/upload',
+                               manifest_file=str(tmp_path / 'manifest.json'))
+        engine.list_files('/dl/other')
+        assert engine.listings == 0
+        engine.list_files('/dl/show')
+        assert engine.listings == 1
+
+    def test_manifest_persists(self, engine, tmp_path):
+        engine.list_files('/dl/show')
+        engine = CountingRsync(rsync_host='somehost', rsync_path='/upload',
+                               manifest_file=str(tmp_path / 'manifest.json'))
+        assert engine.list_files('/dl/show') == ['a.mkv']
+        assert engine.listings == 0
+
+    def test_stale_manifest_is_reconciled(self, tmp_path):
+        engine = CountingRsync(rsync_host='somehost', rsync_path='/upload',
+                               manifest_file=str(tmp_path / 'manifest.json'),
+                               manifest_reconcile_interval='0')
+        engine.list_files('/dl/show')
+        engine.list_files('/dl/show')
+        assert engine.listings == 2
+
+
+@pytest.fixture
+def fake_rcd():
+    """Fake rclone rcd that completes every job immediately."""
+    calls = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            params = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            method = self.path.lstrip('/')
+            calls.append((method, params))
+            if method == 'operations/list':
+                reply = {'list': [{'Path': 'a.mkv'}, {'Path': 'sub/b.mkv'}]}
+            elif method == 'job/status':
+                reply = {'finished': True, 'success': True, 'error': ''}
+            elif params.get('_async'):
+                reply = {'jobid': len(calls)}
+            else:
+                reply = {}
+            body = json.dumps(reply).encode('utf8')
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:%d/' % server.server_address[1], calls
+    server.shutdown()
+
+
+@pytest.fixture
+def rcd_engine(fake_rcd, tmp_path):
+    url, calls = fake_rcd
+    engine = remotesync.get_service(remote_sync_service='rclone_rcd', rclone_remote='cloud',
+                                    rclone_path='/upload', rcd_url=url, rcd_max_jobs='2',
+                                    manifest_file=str(tmp_path / 'manifest.json'))
+    engine.JOB_POLL_INTERVAL = 0
+    return engine
+
+
+class TestRcloneRcd:
+    def test_start_keeps_credentials_off_the_command_line(self, tmp_path, monkeypatch):
+        started, registered = [], []
+
+        class FakeProcess:
+            def __init__(self, cmd, env, **kwargs):
+                started.append((cmd, env))
+
+            def poll(self):
+                # Dead as soon as started, so every start() starts another.
+                return 1
+
+        monkeypatch.setattr(remotesync.subprocess, 'Popen', FakeProcess)
+        monkeypatch.setattr(remotesync.atexit, 'register', registered.append)
+        engine = remotesync.get_service(remote_sync_service='rclone_rcd', rclone_remote='cloud',
+                                        rclone_path='/upload', rcd_pass='secret',
+                                        manifest_file=str(tmp_path / 'manifest.json'))
+        engine._call = lambda method, **params: {}
+
+        engine.start()
+        engine.start()
+
+        assert len(started) == 2
+        cmd, env = started[0]
+        assert not [arg for arg in cmd if 'secret' in arg or 'rc-user' in arg]
+        assert (env['RCLONE_RC_USER'], env['RCLONE_RC_PASS']) == (engine.rcd_user, 'secret')
+        assert registered == [engine.stop]
+
+    def test_list_remote_files(self, rcd_engine, fake_rcd):
+        url, calls = fake_rcd
+        assert rcd_engine.list_remote_files('/dl/show') == ['a.mkv', 'sub/b.mkv']
+        assert calls[-1] == ('operations/list', {'fs': 'cloud:', 'remote': '/upload/show',
+                                                 'opt': {'recurse': True, 'filesOnly': True}})
+
+    def test_sync_files_from_filelist(self, rcd_engine, fake_rcd, tmp_path):
+        url, calls = fake_rcd
+        realpath = tmp_path / 'show'
+        realpath.mkdir()
+        for name in ['1.mkv', '2.mkv', '3.mkv']:
+            (realpath / name).write_bytes(b'1234')
+        filelist = tmp_path / 'transfer.lst'
+        filelist.write_text('1.mkv\n2.mkv\n3.mkv\n')
+
+        rcd_engine.sync_files_from_filelist(str(realpath), str(filelist))
+
+        copies = [params for method, params in calls if method == 'operations/copyfile']
+        assert sorted(p['dstRemote'] for p in copies) == \
+            ['/upload/show/1.mkv', '/upload/show/2.mkv', '/upload/show/3.mkv']
+        assert sorted(rcd_engine.manifest.list('cloud:/upload/show')) == ['1.mkv', '2.mkv', '3.mkv']
+
+    @pytest.fixture
+    def filelist(self, tmp_path):
+        realpath = tmp_path / 'show'
+        realpath.mkdir()
+        for name in ['a', 'b', 'c']:
+            (realpath / name).write_bytes(b'1234')
+        filelist = tmp_path / 'transfer.lst'
+        filelist.write_text('a\nb\nc\n')
+        return str(realpath), str(filelist)
+
+    def test_sync_files_from_filelist_requeues_failed_job_starts(self, rcd_engine, fake_rcd, filelist):
+        url, calls = fake_rcd
+        realpath, filelist_path = filelist
+        rcd_engine.retry_policy.base_delay = 0
+        start_job = rcd_engine.start_job
+        starts = []
+
+        def flaky_start_job(method, **params):
+            starts.append(params['srcRemote'])
+            if len(starts) == 2:
+                raise remotesync.RcdError("rcd restarting")
+            return start_job(method, **params)
+        rcd_engine.start_job = flaky_start_job
+
+        with pytest.raises(remotesync.retry.RemoteUnavailable):
+            rcd_engine.sync_files_from_filelist(realpath, filelist_path)
+        assert rcd_engine.manifest.list('cloud:/upload/show') == []
+
+        # The next run tries the whole list again.
+        rcd_engine.sync_files_from_filelist(realpath, filelist_path)
+        assert sorted(rcd_engine.manifest.list('cloud:/upload/show')) == ['a', 'b', 'c']
+
+    def test_sync_files_from_filelist_records_only_copied_files(self, rcd_engine, fake_rcd, filelist):
+        realpath, filelist_path = filelist
+        start_job = rcd_engine.start_job
+
+        def start_job_failing_a(method, **params):
+            if params['srcRemote'] == 'a':
+                raise remotesync.RcdError("rcd restarting")
+            return start_job(method, **params)
+        rcd_engine.start_job = start_job_failing_a
+
+        with pytest.raises(remotesync.retry.RemoteUnavailable):
+            rcd_engine.sync_files_from_filelist(realpath, filelist_path)
+
+        assert sorted(rcd_engine.manifest.list('cloud:/upload/show')) == ['b', 'c']
+
+    def test_sync_path_of_directory(self, rcd_engine, fake_rcd, tmp_path):
+        url, calls = fake_rcd
+        base_path = tmp_path / 'show'
+        base_path.mkdir()
+        (base_path / '1.mkv').write_bytes(b'1234')
+
+        rcd_engine.sync_path(str(base_path), 'show')
+
+        assert ('sync/copy', {'srcFs': str(base_path), 'dstFs': 'cloud:/upload/show', '_async': True}) in calls
+        # Whole torrents are purged once uploaded, so aren't recorded.
+        assert rcd_engine.manifest.list('cloud:/upload/show') == []
+
+
+class TestRetries:
+    def test_unreachable_remote_gives_up_and_fails_fast(self, tmp_path):
+        engine = remotesync.get_service(remote_sync_service='rclone_rcd', rclone_remote='cloud',
+                                        rclone_path='/upload', rcd_url='http://127.0.0.1:9/',
+                                        retry_base_delay='0', retry_attempts='2',
+                                        breaker_threshold='2',
+                                        manifest_file=str(tmp_path / 'manifest.json'))
+        with pytest.raises(remotesync.retry.RemoteUnavailable):
+            engine.list_remote_files('/dl/show')
+        assert not engine.circuit_breaker.allow()
+
+        results = list(engine.sync_paths([(str(tmp_path), 'a'), (str(tmp_path), 'b')]))
+        assert all(isinstance(e, remotesync.retry.RemoteUnavailable) for index, e in results)
+
+
+class TestSshMaster:
+    @pytest.fixture
+    def rsync(self, tmp_path):
+        return remotesync.Rsync(rsync_host='somehost', rsync_path='/upload',
+                                ssh_control_path=str(tmp_path / 'ssh' / 'master'),
+                                manifest_file=str(tmp_path / 'manifest.json'))
+
+    @pytest.fixture
+    def commands(self, monkeypatch):
+        """Replaces subprocess.run with a fake that records the ssh commands
+        and returns the exit status set in returncodes."""
+        commands, returncodes = [], {'check': 0, 'master': 0}
+
+        def run(cmd, **kwargs):
+            kind = 'check' if '-O' in cmd else 'master'
+            commands.append(kind)
+            if kind == 'master':
+                assert kwargs['stdout'] is remotesync.subprocess.DEVNULL
+                assert kwargs['stderr'] is not remotesync.subprocess.PIPE
+                if returncodes['master']:
+                    kwargs['stderr'].write('Connection refused\n')
+            return remotesync.subprocess.CompletedProcess(cmd, returncodes[kind])
+
+        monkeypatch.setattr(remotesync.subprocess, 'run', run)
+        return commands, returncodes
+
+    def test_live_master_is_reused(self, rsync, commands):
+        commands, returncodes = commands
+        rsync.ensure_ssh_master()
+        assert commands == ['check']
+
+    def test_stale_socket_is_removed_and_master_started(self, rsync, commands, tmp_path):
+        commands, returncodes = commands
+        returncodes['check'] = 255
+        (tmp_path / 'ssh').mkdir()
+        (tmp_path / 'ssh' / 'master').write_text('')
+
+        rsync.ensure_ssh_master()
+
+        assert commands == ['check', 'master']
+        assert not (tmp_path / 'ssh' / 'master').exists()
+
+    def test_failed_master_warns(self, rsync, commands, caplog):
+        commands, returncodes = commands
+        returncodes.update(check=255, master=255)
+        rsync.ensure_ssh_master()
+        assert 'Connection refused' in caplog.text
+
+    def test_disabled_without_control_persist(self, tmp_path, commands):
+        commands, returncodes = commands
+        rsync = remotesync.Rsync(rsync_host='somehost', rsync_path='/upload', ssh_control_persist='0',
+                                 manifest_file=str(tmp_path / 'manifest.json'))
+        rsync.ensure_ssh_master()
+        assert rsync.ssh_options() == []
+        assert commands == []
+
+    def test_backgrounded_master_does_not_block(self, rsync, tmp_path, monkeypatch):
+        # An ssh that fails the check, and forks a master that outlives it.
+        bin_dir = tmp_path / 'bin'
+        bin_dir.mkdir()
+        (bin_dir / 'ssh').write_text('#!/bin/sh\n'
+                                     'case "$*" in *"-O check"*) exit 255;; esac\n'
+                                     'sleep 10 &\n')
+        (bin_dir / 'ssh').chmod(0o755)
+        monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+
+        started = time.monotonic()
+        rsync.ensure_ssh_master()
+        assert time.monotonic() - started < 5
+
+
+class TestSyncPaths:
+    class PartlyFailingRemote(CountingRsync):
+        def sync_path(self, base_path, base_filename):
+            if base_filename == 'b':
+                raise remotesync.retry.RemoteUnavailable("test")
+
+    def test_failure_is_reported_for_its_job_only(self, tmp_path):
+        engine = self.PartlyFailingRemote(rsync_host='somehost', rsync_path='/upload', upload_workers='3',
+                                          manifest_file=str(tmp_path / 'manifest.json'))
+        results = dict(engine.sync_paths([('/dl', 'a'), ('/dl', 'b'), ('/dl', 'c')]))
+        assert results[0] is None and results[2] is None
+        assert isinstance(results[1], remotesync.retry.RemoteUnavailable)
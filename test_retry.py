@@ -0,0 +1,155 @@
+import pytest
+
+import retry
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def failing(times, result='ok'):
+    """Returns a function that raises OSError 'times' times, then succeeds."""
+    calls = []
+
+    def func():
+        calls.append(None)
+        if len(calls) <= times:
+            raise OSError('unreachable')
+        return result
+    return func, calls
+
+
+class TestRetryPolicy:
+    def test_delay_grows_exponentially_up_to_the_cap(self):
+        policy = retry.RetryPolicy(5, 60, 10, rng=lambda: 0.999999)
+        assert [round(policy.delay(n)) for n in range(6)] == [5, 10, 20, 40, 60, 60]
+
+    def test_delay_is_jittered_above_the_minimum(self):
+        policy = retry.RetryPolicy(5, 60, 10, rng=lambda: 0.0)
+        assert policy.delay(3) == 0
+        assert policy.delay(3, min_delay=150) == 150
+
+
+class TestCall:
+    def test_retries_until_success(self):
+        func, calls = failing(2)
+        sleeps = []
+        breaker = retry.CircuitBreaker(10, 60)
+        assert retry.call(func, retry.RetryPolicy(1, 10, 5), breaker, 'test', OSError,
+                          sleep=sleeps.append) == 'ok'
+        assert len(calls) == 3
+        assert len(sleeps) == 2
+        assert breaker.failures == 0
+
+    def test_gives_up_when_the_budget_is_spent(self):
+        func, calls = failing(10)
+        with pytest.raises(retry.RemoteUnavailable):
+            retry.call(func, retry.RetryPolicy(1, 10, 3), retry.CircuitBreaker(10, 60),
+                       'test', OSError, sleep=lambda delay: None)
+        assert len(calls) == 3
+
+    def test_other_exceptions_are_not_retried(self):
+        def func():
+            raise KeyError('bug')
+        with pytest.raises(KeyError):
+            retry.call(func, retry.RetryPolicy(1, 10, 3), retry.CircuitBreaker(10, 60),
+                       'test', OSError, sleep=lambda delay: None)
+
+    def test_open_circuit_fails_fast_until_reset(self):
+        clock = FakeClock()
+        breaker = retry.CircuitBreaker(2, 60, clock=clock)
+        policy = retry.RetryPolicy(1, 10, 5)
+
+        func, calls = failing(10)
+        with pytest.raises(retry.RemoteUnavailable):
+            retry.call(func, policy, breaker, 'test', OSError, sleep=lambda delay: None)
+        assert len(calls) == 2
+
+        func, calls = failing(0)
+        with pytest.raises(retry.RemoteUnavailable):
+            retry.call(func, policy, breaker, 'test', OSError, sleep=lambda delay: None)
+        assert calls == []
+
+        clock.now = 61
+        assert retry.call(func, policy, breaker, 'test', OSError) == 'ok'
+        assert breaker.allow()
+
+    def test_does_not_wait_once_the_circuit_opened(self):
+        breaker = retry.CircuitBreaker(5, 60)
+        policy = retry.RetryPolicy(5, 300, 6, rng=lambda: 0.99)
+        func, calls = failing(10)
+        sleeps = []
+        with pytest.raises(retry.RemoteUnavailable, match='circuit open'):
+            retry.call(func, policy, breaker, 'test', OSError, sleep=sleeps.append)
+        assert len(calls) == 5
+        assert len(sleeps) == 4
+
+    def test_breaker_state_persists(self, tmp_path):
+        path = str(tmp_path / 'breaker.json')
+        clock = FakeClock()
+        breaker = retry.CircuitBreaker(2, 60, path, clock=clock)
+        breaker.record_failure()
+        breaker.record_failure()
+
+        breaker = retry.CircuitBreaker(2, 60, path, clock=clock)
+        assert not breaker.allow()
+        clock.now = 60
+        breaker.record_success()
+        assert retry.CircuitBreaker(2, 60, path, clock=clock).failures == 0
+
+
+class TestCallOnce:
+    @pytest.fixture
+    def queue(self):
+        clock = FakeClock()
+        return retry.RetryQueue(retry.RetryPolicy(10, 60, 3, rng=lambda: 0.5), clock=clock), clock
+
+    def test_failure_is_requeued_without_sleeping(self, queue):
+        queue, clock = queue
+        breaker = retry.CircuitBreaker(10, 60)
+        func, calls = failing(1)
+
+        with pytest.raises(retry.RemoteUnavailable):
+            retry.call_once(func, queue, 'a', breaker, 'test', OSError)
+        assert len(calls) == 1
+        assert queue.ready_keys() == []
+
+        # Backing off, so the transfer isn't attempted.
+        with pytest.raises(retry.RemoteUnavailable):
+            retry.call_once(func, queue, 'a', breaker, 'test', OSError)
+        assert len(calls) == 1
+
+        clock.now = 5
+        assert queue.ready_keys() == ['a']
+        assert retry.call_once(func, queue, 'a', breaker, 'test', OSError) == 'ok'
+        assert queue.ready_keys() == []
+        assert queue.failures('a') == 0
+
+    def test_backoff_grows_per_key(self, queue):
+        queue, clock = queue
+        assert queue.record_failure('a') == 5
+        clock.now = 5
+        assert queue.record_failure('a') == 10
+        assert queue.ready('b')
+
+    def test_queue_persists(self, tmp_path):
+        path = str(tmp_path / 'queue.json')
+        clock = FakeClock()
+        policy = retry.RetryPolicy(10, 60, 3, rng=lambda: 0.5)
+        retry.RetryQueue(policy, path, clock=clock).record_failure('a')
+
+        # The next run, from cron, still backs off.
+        queue = retry.RetryQueue(policy, path, clock=clock)
+        assert not queue.ready('a')
+        assert queue.failures('a') == 1
+        clock.now = 5
+        queue.record_success('a')
+        assert retry.RetryQueue(policy, path, clock=clock).ready_keys() == []
+
+    def test_min_delay(self, queue):
+        queue, clock = queue
+        assert queue.record_failure('a', min_delay=150) == 150
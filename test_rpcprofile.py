@@ -0,0 +1,27 @@
+import rpcprofile
+
+
+class TestRpcProfiler:
+    def test_disabled_profiler_records_nothing(self):
+        profiler = rpcprofile.RpcProfiler()
+        profiler.record('d.start', 0.1, 100, 200)
+        assert profiler.summary() == []
+
+    def test_calls_are_grouped_by_phase_and_sorted_by_cost(self):
+        profiler = rpcprofile.RpcProfiler(enabled=True)
+        with profiler.phase('snapshot'):
+            profiler.record('d.multicall2', 0.5, 100, 5000)
+        with profiler.phase('load'):
+            profiler.record('load.start', 0.1, 150, 50)
+            profiler.record('load.start', 0.1, 150, 50)
+        profiler.record('d.start', 0.01, 100, 50)
+
+        assert profiler.summary() == [
+            rpcprofile.CallStats('snapshot', 'd.multicall2', 1, 0.5, 100, 5000),
+            rpcprofile.CallStats('load', 'load.start', 2, 0.2, 300, 100),
+            rpcprofile.CallStats('other', 'd.start', 1, 0.01, 100, 50),
+        ]
+        assert profiler.report().startswith("RPC profile: 4 calls, 0.710 s, 500 bytes sent, 5150 bytes received")
+
+        profiler.reset()
+        assert profiler.summary() == []
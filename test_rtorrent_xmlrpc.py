@@ -0,0 +1,168 @@
+import asyncio
+import socket
+import threading
+import xmlrpc.client
+
+import pytest
+
+import rtorrent_aioxmlrpc
+import rtorrent_xmlrpc
+
+
+def scgi_response(body):
+    return b'Status: 200 OK\r\nContent-Type: text/xml\r\n\r\n' + body
+
+
+class ChunkedSocket:
+    """Serves a byte string through recv_into() a few bytes at a time."""
+    def __init__(self, data, chunk_size):
+        self.data = data
+        self.chunk_size = chunk_size
+
+    def recv_into(self, buffer):
+        chunk, self.data = self.data[:self.chunk_size], self.data[self.chunk_size:]
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+
+@pytest.fixture
+def scgi_server(tmp_path):
+    """Minimal SCGI server answering every request with a canned response."""
+    path = str(tmp_path / 'rpc.socket')
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(16)
+    state = {'response': None, 'requests': [], 'raw_requests': []}
+
+    def serve():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            with conn:
+                request = b''
+                while not request.rstrip().endswith(b'</methodCall>'):
+                    data = conn.recv(65536)
+                    if not data:
+                        break
+                    request += data
+                state['raw_requests'].append(request)
+                state['requests'].append(xmlrpc.client.loads(request.split(b',', 1)[1]))
+                conn.sendall(scgi_response(state['response']))
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    yield 'scgi://' + path, state
+    listener.close()
+
+
+class TestSCGITransport:
+    @pytest.mark.parametrize('chunk_size', [1, 7, 4096])
+    def test_parse_response_in_chunks(self, chunk_size):
+        body = xmlrpc.client.dumps(("café über",), methodresponse=True).encode('utf8')
+        sock = ChunkedSocket(scgi_response(body), chunk_size)
+
+        transport = rtorrent_xmlrpc.SCGITransport()
+        transport.verbose = False
+        assert transport.parse_response(sock) == ("café über",)
+
+    def test_buffer_is_reused_per_thread(self):
+        class RecordingSocket(ChunkedSocket):
+            def recv_into(self, buffer):
+                buffers.append(buffer)
+                return super().recv_into(buffer)
+
+        buffers = []
+        body = xmlrpc.client.dumps(("first",), methodresponse=True).encode('utf8')
+        transport = rtorrent_xmlrpc.SCGITransport()
+        transport.verbose = False
+        assert transport.parse_response(RecordingSocket(scgi_response(body), 4096)) == ("first",)
+        assert transport.parse_response(RecordingSocket(scgi_response(body), 4096)) == ("first",)
+        assert all(buffer is buffers[0] for buffer in buffers)
+
+        thread = threading.Thread(
+            target=transport.parse_response, args=(RecordingSocket(scgi_response(body), 4096),))
+        thread.start()
+        thread.join()
+        assert buffers[-1] is not buffers[0]
+
+
+class TestSCGIServerProxy:
+    def test_download_records(self, scgi_server):
+        url, state = scgi_server
+        state['response'] = xmlrpc.client.dumps((
+            [['ABCD', 1, 1500, '/dl/foo', 'foo', '/dl/foo', 4096, 4096, 2, 1024, 1, 524288, 3, 12, 0]],
+        ), methodresponse=True).encode('utf8')
+
+        server = rtorrent_xmlrpc.SCGIServerProxy(url)
+        [record] = server.download_records()
+
+        assert state['requests'][0][1] == 'd.multicall2'
+        assert record.hash == 'ABCD'
+        assert record.complete is True
+        assert record.ratio == 1.5
+        assert record.size_files == 2
+        assert record.down_rate == 524288
+        assert record.peers_complete == 3
+        assert record.peers_accounted == 12
+        assert record.is_hash_checking is False
+
+    def test_download_states(self, scgi_server):
+        url, state = scgi_server
+        state['response'] = xmlrpc.client.dumps((
+            [['ABCD', 1, 1500]],
+        ), methodresponse=True).encode('utf8')
+
+        server = rtorrent_xmlrpc.SCGIServerProxy(url)
+        assert server.download_states() == [rtorrent_xmlrpc.DownloadState('ABCD', True, 1.5)]
+        assert state['requests'] == [(('', 'main', 'd.hash=', 'd.complete=', 'd.ratio='), 'd.multicall2')]
+
+    def test_file_records(self, scgi_server):
+        url, state = scgi_server
+        state['response'] = xmlrpc.client.dumps((
+            [['a.mkv', 4096, 1, 1, 1], ['b.mkv', 8192, 0, 2, 0]],
+        ), methodresponse=True).encode('utf8')
+
+        server = rtorrent_xmlrpc.SCGIServerProxy(url)
+        files = server.file_records('ABCD')
+
+        assert [f.id for f in files] == ['ABCD:f0', 'ABCD:f1']
+        assert files[1].path == 'b.mkv'
+        assert files[1].size_chunks == 2
+        assert state['requests'] == [(
+            ('ABCD', '', 'f.path=', 'f.size_bytes=', 'f.completed_chunks=', 'f.size_chunks=', 'f.priority='),
+            'f.multicall',
+        )]
+
+    def test_observer_sees_every_call(self, scgi_server):
+        url, state = scgi_server
+        state['response'] = xmlrpc.client.dumps((1,), methodresponse=True).encode('utf8')
+        calls = []
+
+        server = rtorrent_xmlrpc.SCGIServerProxy(url, observer=lambda *args: calls.append(args))
+        server.d.is_active('ABCD')
+
+        [(method, seconds, exception, request_bytes, response_bytes)] = calls
+        assert method == 'd.is_active'
+        assert seconds >= 0
+        assert exception is None
+        assert request_bytes == len(state['raw_requests'][0])
+        assert response_bytes == len(scgi_response(state['response']))
+
+
+class TestAsyncSCGIServerProxy:
+    def test_concurrent_calls(self, scgi_server):
+        url, state = scgi_server
+        state['response'] = xmlrpc.client.dumps((1500,), methodresponse=True).encode('utf8')
+        server = rtorrent_aioxmlrpc.AsyncSCGIServerProxy(url, max_in_flight=2)
+
+        async def ratios():
+            return await asyncio.gather(*[server.d.ratio(h) for h in ['A', 'B', 'C']])
+
+        loop = asyncio.new_event_loop()
+        try:
+            assert loop.run_until_complete(ratios()) == [1500, 1500, 1500]
+        finally:
+            loop.close()
+        assert sorted(request[0][0] for request in state['requests']) == ['A', 'B', 'C']
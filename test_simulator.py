@@ -0,0 +1,63 @@
+import pytest
+
+import simulator
+
+GiB = simulator.GiB
+HOUR = 60 * 60
+
+
+def torrent(name, file_sizes, arrival=0.0, download_rate=GiB / HOUR, upload_rate=GiB / HOUR):
+    return simulator.WorkloadTorrent(name, arrival, file_sizes, download_rate, upload_rate, 4 * 2**20)
+
+
+def simulate(workload, space_limit, **kwargs):
+    sim = simulator.Simulator(workload, {'space_limit': str(space_limit)},
+                              remote_rate=GiB / HOUR, duration=simulator.DAY, **kwargs)
+    return sim.run()
+
+
+class TestSimulator:
+    def test_small_torrents_are_delivered(self):
+        report = simulate([torrent('a', [GiB]), torrent('b', [GiB])], 3 * GiB)
+
+        assert report.delivered_torrents == 2
+        assert report.bytes_per_day == 2 * GiB
+        # Both load at once, take an hour to download and another to seed,
+        # then queue for the remote one after the other.
+        assert report.mean_queue_latency == 0
+        assert report.mean_delivery_latency == 3.5 * HOUR
+        assert 0 < report.mean_disk_utilisation < report.peak_disk_utilisation == pytest.approx(2 / 3)
+
+    def test_torrents_wait_for_space(self):
+        report = simulate([torrent('a', [GiB]), torrent('b', [GiB])], GiB)
+
+        assert report.delivered_torrents == 2
+        assert report.mean_queue_latency > 0
+        assert report.peak_disk_utilisation <= 1
+
+    def test_torrents_still_waiting_count_towards_queue_latency(self):
+        # a takes two days to download, so b waits for the whole day.
+        report = simulate([torrent('a', [GiB], download_rate=GiB / (48 * HOUR)), torrent('b', [GiB])], GiB)
+
+        assert report.waiting_torrents == 1
+        assert report.mean_queue_latency == simulator.DAY / 2
+        assert 'counting 1 still waiting' in simulator.format_report(report)
+
+    def test_large_torrent_is_delivered_file_by_file(self):
+        report = simulate([torrent('big', [GiB // 2] * 6)], GiB + 2**20)
+
+        assert report.delivered_torrents == 1
+        assert report.delivered_bytes == 3 * GiB
+        assert report.peak_disk_utilisation <= 1
+
+    def test_intractable_torrent_is_undeliverable(self):
+        report = simulate([torrent('big', [2 * GiB, GiB])], GiB)
+
+        assert report.delivered_torrents == 0
+        assert report.undeliverable_torrents == 1
+
+    def test_workload_round_trip(self, tmp_path):
+        workload = simulator.synthetic_workload(20, seed=3)
+        path = str(tmp_path / 'workload.json')
+        simulator.save_workload(path, workload)
+        assert simulator.load_workload(path) == workload
@@ -0,0 +1,81 @@
+import os
+
+import pytest
+
+import benchmark
+import fake_rtorrent
+import rtorrent_xmlrpc
+import snapshot
+
+
+def download(hash_, complete):
+    return rtorrent_xmlrpc.Download(
+        hash_, complete, 0.0, '', '', '', 1, 1 if complete else 0, 1, 1, True, 0, 0, 0, False
+    )
+
+
+def torrent(hash_):
+    return {'hash': hash_, 'name': hash_.lower(), 'size': 1}
+
+
+@pytest.fixture
+def run_snapshot():
+    return snapshot.RunSnapshot(
+        {'AA': torrent('AA'), 'BB': torrent('BB'), 'CC': torrent('CC')},
+        {'AA': download('AA', True), 'BB': download('BB', False), 'XX': download('XX', True)},
+    )
+
+
+class TestRunSnapshot:
+    def test_complete_and_incomplete(self, run_snapshot):
+        assert run_snapshot.complete() == ['AA', 'XX']
+        assert run_snapshot.incomplete() == ['BB']
+
+    def test_managed_in(self, run_snapshot):
+        assert run_snapshot.managed_in(run_snapshot.complete()) == [torrent('AA')]
+
+    def test_loaded_downloads_are_incomplete(self, run_snapshot):
+        run_snapshot.loaded(torrent('CC'))
+        assert run_snapshot.downloads['CC'] is None
+        assert run_snapshot.incomplete() == ['BB', 'CC']
+        assert run_snapshot.managed_in(run_snapshot.incomplete()) == [torrent('BB'), torrent('CC')]
+
+    def test_erased_keeps_the_managed_torrent(self, run_snapshot):
+        run_snapshot.erased('BB')
+        run_snapshot.erased('unknown')
+        assert run_snapshot.incomplete() == []
+        assert 'BB' in run_snapshot.managed
+
+    def test_purged(self, run_snapshot):
+        run_snapshot.purged(torrent('AA'))
+        assert run_snapshot.complete() == ['XX']
+        assert 'AA' not in run_snapshot.managed
+
+
+class TestDriverSnapshot:
+    def test_run_keeps_the_snapshot_up_to_date(self, tmp_path):
+        # One download seeded enough to be purged, one waiting to be loaded.
+        workdir = str(tmp_path)
+        data = os.path.join(workdir, 'data')
+        os.makedirs(os.path.join(workdir, 'managed'))
+        os.makedirs(data)
+        metadata_service = fake_rtorrent.FakeMetadataService()
+        fake = fake_rtorrent.FakeRtorrent(os.path.join(workdir, 'rpc.socket'), data, metadata_service)
+        for i, name in enumerate(['done', 'new']):
+            benchmark.add_managed_torrent(workdir, metadata_service, '%040X' % i, name, 2**20)
+        open(os.path.join(data, 'done'), 'w').close()
+        fake.add_download(fake_rtorrent.FakeDownload(
+            '%040X' % 0, 'done', data, [fake_rtorrent.FakeFile('done', 2**20, 2**20, True)], 2**20,
+            complete=True, ratio=2.0
+        ))
+        fake.start()
+        try:
+            driver_ = benchmark.make_driver(workdir, fake, metadata_service, 64 * 2**20)
+            driver_.run()
+        finally:
+            fake.stop()
+
+        assert list(driver_.snapshot.managed) == ['%040X' % 1]
+        assert driver_.snapshot.downloads == {'%040X' % 1: None}
+        # A single d.multicall2 filled the snapshot.
+        assert fake.calls['d.multicall2'] == 1
@@ -0,0 +1,195 @@
+import os
+
+import pytest
+
+import benchmark
+import fake_rtorrent
+import persist
+import rtorrent_xmlrpc
+import swarm
+
+MiB = 2**20
+HOUR = 3600
+
+
+def download(hash_, completed_bytes, down_rate=0, seeders=0, peers=0, complete=False,
+             is_active=True, is_hash_checking=False):
+    return rtorrent_xmlrpc.Download(
+        hash_, complete, 0.0, '', '', '', 8 * MiB, completed_bytes, 1, MiB, is_active,
+        down_rate, seeders, peers, is_hash_checking
+    )
+
+
+class TestSwarmHistory:
+    def test_stalled_after_window_without_progress(self):
+        history = swarm.SwarmHistory()
+        history.observe([download('A', 0, seeders=0, peers=3)], 0)
+        history.observe([download('A', 0)], HOUR)
+        assert not history.stalled('A', HOUR, 2 * HOUR)
+        history.observe([download('A', 0)], 2 * HOUR)
+        assert history.stalled('A', 2 * HOUR, 2 * HOUR)
+
+    @pytest.mark.parametrize('state', [{'is_active': False}, {'is_hash_checking': True}])
+    def test_window_only_runs_while_the_download_runs(self, state):
+        history = swarm.SwarmHistory()
+        history.observe([download('A', 0)], 0)
+        history.observe([download('A', 0, **state)], 2 * HOUR)
+        assert not history.stalled('A', 2 * HOUR, HOUR)
+        history.observe([download('A', 0)], 2.5 * HOUR)
+        assert not history.stalled('A', 2.5 * HOUR, HOUR)
+        assert history.stalled('A', 3 * HOUR, HOUR)
+
+    def test_progress_resets_the_window(self):
+        history = swarm.SwarmHistory()
+        history.observe([download('A', 0)], 0)
+        history.observe([download('A', MiB)], 2 * HOUR)
+        assert not history.stalled('A', 3 * HOUR, 2 * HOUR)
+
+    def test_complete_and_new_downloads_are_skipped(self):
+        history = swarm.SwarmHistory()
+        history.observe([download('A', 8 * MiB, complete=True), None], 0)
+        assert history.get('A') is None
+
+    def test_rate_is_a_moving_average(self):
+        history = swarm.SwarmHistory()
+        history.observe([download('A', 0, down_rate=4 * MiB, seeders=1)], 0)
+        history.observe([download('A', MiB, down_rate=0, seeders=1)], HOUR)
+        # Samples of a download that isn't running don't count.
+        history.observe([download('A', MiB, down_rate=0, seeders=1, is_active=False)], HOUR)
+        assert history.expected_rate('A') == 2 * MiB
+        assert history.expected_rate('B') is None
+
+    def test_swarm_without_seeders_or_peers_is_unavailable(self):
+        history = swarm.SwarmHistory()
+        history.observe([download('A', 0, down_rate=MiB, seeders=0, peers=0),
+                         download('B', 0, down_rate=0, seeders=0, peers=5),
+                         download('C', 0, down_rate=MiB, seeders=0, peers=5)], 0)
+        assert not history.available('A')
+        assert history.expected_rate('A') == 0.0
+        # Peers, but no rate to go by yet.
+        assert history.available('B')
+        assert history.expected_rate('B') is None
+        assert history.expected_rate('C') == MiB
+
+    def test_park(self):
+        history = swarm.SwarmHistory()
+        history.observe([download('A', 0)], 0)
+        history.park('A', 3 * HOUR)
+        assert history.parked('A', 2 * HOUR)
+        assert not history.stalled('A', 2 * HOUR, HOUR)
+        assert not history.parked('A', 3 * HOUR)
+
+        # Loaded again, it gets a fresh window.
+        history.observe([download('A', 0)], 4 * HOUR)
+        assert not history.parked('A', 4 * HOUR)
+        assert not history.stalled('A', 4 * HOUR, HOUR)
+
+    def test_commit_persists_managed_torrents_only(self, tmp_path):
+        path = str(tmp_path / 'swarm.json')
+        history = swarm.SwarmHistory(path)
+        history.observe([download('A', 0, seeders=2), download('B', 0)], 0)
+        history.commit(['A'])
+
+        assert set(persist.load_json(path, {})) == {'A'}
+        assert swarm.SwarmHistory(path).get('A')['seeders'] == 2
+
+
+@pytest.fixture
+def stalled(tmp_path):
+    """A loaded download that never progresses, and a driver whose clock is
+    set by the test."""
+    workdir = str(tmp_path)
+    data = os.path.join(workdir, 'data')
+    os.makedirs(os.path.join(workdir, 'managed'))
+    os.makedirs(data)
+    metadata_service = fake_rtorrent.FakeMetadataService()
+    fake = fake_rtorrent.FakeRtorrent(os.path.join(workdir, 'rpc.socket'), data, metadata_service)
+    torrent_path = benchmark.add_managed_torrent(workdir, metadata_service, '%040X' % 1, 'dead', 8 * MiB)
+    with open(torrent_path, 'w') as f:
+        f.write('torrent')
+    open(os.path.join(data, 'dead'), 'w').close()
+    fake.add_download(fake_rtorrent.FakeDownload(
+        '%040X' % 1, 'dead', data, [fake_rtorrent.FakeFile('dead', 8 * MiB, MiB)], MiB,
+        peers_accounted=4
+    ))
+    fake.start()
+
+    def make(**cfg):
+        now = [0.0]
+        driver_ = benchmark.make_driver(workdir, fake, metadata_service, 64 * MiB,
+                                        stall_window=str(HOUR), **cfg)
+        driver_.clock = lambda: now[0]
+        return driver_, now
+
+    yield make, fake, torrent_path, data
+    fake.stop()
+
+
+class TestStalledTorrents:
+    def test_park(self, stalled):
+        make, fake, torrent_path, data = stalled
+        driver_, now = make()
+
+        driver_.run()
+        now[0] = HOUR
+        driver_.run()
+
+        assert fake.downloads == {}
+        assert not os.path.exists(os.path.join(data, 'dead'))
+        assert os.path.exists(torrent_path)
+        assert driver_.swarm.parked('%040X' % 1, now[0])
+
+        # Still parked, so not loaded again.
+        now[0] = 1.5 * HOUR
+        driver_.run()
+        assert fake.downloads == {}
+
+        now[0] = 2 * HOUR
+        driver_.run()
+        assert list(fake.downloads) == ['%040X' % 1]
+
+    def test_park_restores_torrent_file_deleted_by_rtorrent(self, stalled):
+        make, fake, torrent_path, data = stalled
+        driver_, now = make()
+        mtime = os.stat(torrent_path).st_mtime_ns
+        driver_.run()
+
+        erase = fake.methods['d.erase']
+        fake.methods['d.erase'] = lambda infohash: (os.remove(torrent_path), erase(infohash))[1]
+        now[0] = HOUR
+        driver_.run()
+
+        with open(torrent_path) as f:
+            assert f.read() == 'torrent'
+        assert os.stat(torrent_path).st_mtime_ns == mtime
+
+    def test_evict(self, stalled, tmp_path):
+        make, fake, torrent_path, data = stalled
+        evicted = str(tmp_path / 'stalled')
+        driver_, now = make(stall_action='evict', stalled_torrents_directory=evicted)
+
+        driver_.run()
+        now[0] = HOUR
+        driver_.run()
+
+        assert fake.downloads == {}
+        assert not os.path.exists(torrent_path)
+        assert os.listdir(evicted) == ['dead.torrent']
+        assert driver_.swarm.get('%040X' % 1) is None
+
+    def test_evict_needs_a_directory(self, stalled):
+        make, fake, torrent_path, data = stalled
+        with pytest.raises(SystemExit):
+            make(stall_action='evict')
+
+    def test_stopped_download_is_left_alone(self, stalled):
+        make, fake, torrent_path, data = stalled
+        driver_, now = make()
+
+        driver_.run()
+        fake.downloads['%040X' % 1].is_active = False
+        now[0] = 2 * HOUR
+        driver_.run()
+
+        assert list(fake.downloads) == ['%040X' % 1]
+        assert os.path.exists(os.path.join(data, 'dead'))
@@ -0,0 +1,44 @@
+import pytest
+
+import watcher
+
+
+def parse(path):
+    with open(path) as f:
+        return {'torrent_path': path, 'hash': f.read(), 'name': path, 'size': 0}
+
+
+@pytest.fixture
+def index(tmp_path):
+    (tmp_path / 'a.torrent').write_text('AAAA')
+    return watcher.ManagedTorrentIndex(str(tmp_path), parse)
+
+
+class TestManagedTorrentIndex:
+    def test_initial_scan(self, index):
+        assert list(index.torrents()) == ['AAAA']
+
+    def test_added_changed_and_removed_files(self, index, tmp_path):
+        (tmp_path / 'b.torrent').write_text('BBBB')
+        (tmp_path / 'a.torrent').write_text('CCCC')
+        index.refresh()
+        assert sorted(index.torrents()) == ['BBBB', 'CCCC']
+
+        (tmp_path / 'b.torrent').unlink()
+        index.refresh()
+        assert list(index.torrents()) == ['CCCC']
+
+    def test_collected_events_are_applied_on_refresh(self, index, tmp_path):
+        if index.fileno() is None:
+            pytest.skip("inotify is not available")
+        (tmp_path / 'b.torrent').write_text('BBBB')
+        index.collect()
+        assert 'BBBB' not in index.torrents()
+        index.refresh()
+        assert 'BBBB' in index.torrents()
+
+    def test_rescan_without_inotify(self, index, tmp_path):
+        index._inotify = None
+        (tmp_path / 'b.torrent').write_text('BBBB')
+        index.refresh()
+        assert sorted(index.torrents()) == ['AAAA', 'BBBB']
@@ -0,0 +1,175 @@
+import ctypes
+import ctypes.util
+from logging import debug, info, warning
+import errno
+import os
+import struct
+import threading
+
+# From <sys/inotify.h>.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event: wd, mask, cookie, len, followed by len bytes of name.
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    """Minimal non-blocking inotify binding watching a single directory."""
+    def __init__(self, path, mask):
+        """Inits Inotify.
+
+        Raises:
+            OSError: inotify isn't available, or the watch can't be added.
+        """
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        try:
+            init1, add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except AttributeError:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+
+        self.fd = init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if add_watch(self.fd, os.fsencode(path), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, "inotify_add_watch failed", path)
+
+    def fileno(self):
+        return self.fd
+
+    def read_events(self):
+        """Returns the pending events as (mask, name) tuples, maybe none."""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                events.append((mask, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ManagedTorrentIndex:
+    """Incremental in-memory index of the managed torrents directory.
+
+    With inotify, refresh() only parses files that were written or moved
+    into the directory since the last call, and drops files that were
+    removed; a quiet directory costs a single non-blocking read.  When the
+    kernel queue overflows, or inotify isn't available at all, it falls back
+    to a rescan, which still only parses files whose size or mtime changed.
+
+    An event loop can watch fileno() and call collect(), which only queues
+    events; they are applied by the next refresh(), possibly on another
+    thread.
+    """
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM
+
+    def __init__(self, directory, parse):
+        """Inits ManagedTorrentIndex and scans the directory once.
+
+        Args:
+            directory: Path to the managed torrents directory, string.
+            parse: Function taking the path of a torrent file and returning
+              its managed torrent dict, as used by the driver.
+        """
+        self.directory = directory
+        self.parse = parse
+        self._entries = {}
+        self._events = []
+        self._lock = threading.RLock()
+        try:
+            self._inotify = Inotify(directory, self.WATCH_MASK)
+        except OSError as e:
+            warning("Cannot watch %s, falling back to rescanning it: %s" % (directory, e))
+            self._inotify = None
+        self.rescan()
+
+    def fileno(self):
+        """Returns the inotify file descriptor, or None without inotify."""
+        return self._inotify.fileno() if self._inotify is not None else None
+
+    def torrents(self):
+        """Returns a new dict of the managed torrents, keyed by infohash."""
+        with self._lock:
+            return {datum['hash']: datum for stamp, datum in self._entries.values()}
+
+    def stamps(self):
+        """Returns a sorted list of (path, (size, mtime)) for every file."""
+        with self._lock:
+            return sorted((path, stamp) for path, (stamp, datum) in self._entries.items())
+
+    def collect(self):
+        """Queues pending inotify events for the next refresh()."""
+        with self._lock:
+            self._events.extend(self._inotify.read_events())
+
+    def refresh(self):
+        """Brings the index up to date with the directory."""
+        with self._lock:
+            if self._inotify is None:
+                self.rescan()
+            else:
+                self._apply(self._events + self._inotify.read_events())
+                self._events = []
+
+    def _apply(self, events):
+        # Only the last event per path matters.
+        pending = {}
+        for mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                info("Inotify queue overflowed, rescanning %s" % self.directory)
+                self.rescan()
+                return
+            path = os.path.join(self.directory, name)
+            pending[path] = bool(mask & (IN_DELETE | IN_MOVED_FROM))
+
+        for path, removed in pending.items():
+            if removed:
+                self.discard(path)
+            else:
+                self._update(path)
+
+    def rescan(self):
+        """Rebuilds the index from a full directory listing."""
+        with self._lock:
+            paths = set()
+            for entry in os.scandir(self.directory):
+                paths.add(entry.path)
+                self._update(entry.path)
+            for path in set(self._entries) - paths:
+                self.discard(path)
+
+    def discard(self, path):
+        """Drops a file from the index, e.g. once the driver deleted it."""
+        with self._lock:
+            if self._entries.pop(path, None) is not None:
+                debug("Dropped %s from the managed index" % path)
+
+    def _update(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self.discard(path)
+            return
+
+        stamp = (st.st_size, st.st_mtime_ns)
+        entry = self._entries.get(path)
+        if entry is None or entry[0] != stamp:
+            debug("Indexing %s" % path)
+            self._entries[path] = (stamp, self.parse(path))